@@ -9,44 +9,41 @@ from ase.io import read
 import ase
 import ase.neighborlist
 from scipy.stats.mstats import gmean,hmean
+from CANELa_NP.Element_Properties import get_radii
+from CANELa_NP.Profiling import profiled, span
+from CANELa_NP.Nanotools import get_cn_factors, get_bond_coeffs
 
 def get_ordering(atoms):
-    atom_types = list(np.unique(atoms.symbols))
-    atom_types.sort()
-    order = []
-    for sym in atoms.symbols:
-        order.append(atom_types.index(sym))
-    return np.array(order)
+    atom_types,order = np.unique(np.asarray(atoms.symbols),return_inverse=True)
+    return order.reshape(-1)
 
+@profiled
 def get_cutoffs(atoms,x):
     """Custom Cutoffs from custom Radii
-        Please add your own custom radii here (covalent radii may be a good place to start so I have implemented that as a default)"""
-    radii = {'Au':1.47*x,
-             'Pd':1.38*x,
-             'Pt':1.38*x}
-
-    df = pd.read_html('http://crystalmaker.com/support/tutorials/atomic-radii/index.html',header=0)[0]
-    for element in np.unique(atoms.symbols):
-        if element not in radii.keys():
-            radii[element] = float(df[df['ElementSymbol']==element]['"Crystal"Radius [Å]'].values[0])*x
+        Please add your own custom radii with Element_Properties.set_custom_radii (crystal radii from the bundled element table are used as a default)"""
+    radii = get_radii(np.unique(atoms.symbols),x,kind='crystal')
     return [radii[atom_type] for atom_type in atoms.symbols]
 
+@profiled
 def make_bcm(atoms,x=1.200,CN_Method = 'int'):
     radii = get_cutoffs(atoms,x)
-    bonds = build_bonds_arr(atoms,radii)
+    with span('build_bonds_arr'):
+        bonds = build_bonds_arr(atoms,radii)
     bcm = BCModel(atoms,bond_list=bonds,CN_Method=CN_Method)
     return bcm
 
 
 class BCM_Mod:
     """Original BCM Implementation"""
+    @profiled
     def __init__(self,atoms,gammas=False,ce_bulk=False,x=1.200):
         self.atoms = atoms # ASE Atoms object
 
         # self.bcm = make_bcm(atoms,x) # Build the BCM from original code
         
         # Updating the code for the atom types other than Au, Pd, Pt
-        self.bcm = BCModel(atoms,CN_Method='int') # Build the BCM from original code
+        with span('BCModel'):
+            self.bcm = BCModel(atoms,CN_Method='int') # Build the BCM from original code
         
         if not gammas:
             self.gammas = self.bcm.gammas # BCM gammas
@@ -62,10 +59,38 @@ class BCM_Mod:
 
         self.syms = atoms.symbols # atom symbols
         self.atom_types = np.sort(np.unique(atoms.symbols)) # unique atom types
+        self._get_precomps()
+
+    @profiled
+    def _get_precomps(self):
+        """Precompute the per-atom arrays and the bond class coefficients used by calc_ce
+
+        bond_coeffs[a,b] is the sum of sqrt(CN_i/Cb)/CN_i over every bond end i of type a bonded to an atom of type b,
+        so the BCM sum is just sum_ab gamma_ab*CE_bulk_a*bond_coeffs[a,b]
+        """
+        self.type_idx = np.searchsorted(self.atom_types,np.asarray(self.syms)) # atom type index of each atom
+        self.cn_factors = get_cn_factors(self.cns,self.Cb) # CN-dependent factor of each atom
+        bonds = np.asarray(self.bcm.bond_list).reshape(-1,2)
+        n_types = len(self.atom_types)
+        # Both ends of every bond contribute (part_1 and part_2 of the BCM sum)
+        self.bond_coeffs = (get_bond_coeffs(bonds,self.cns,self.type_idx,n_types,self.Cb)
+                            + get_bond_coeffs(bonds[:,::-1],self.cns,self.type_idx,n_types,self.Cb))
 
+    def get_param_matrix(self):
+        """gamma_ab*CE_bulk_a for every pair of atom types (object array if the gammas are sympy symbols)"""
+        params = [[self.gammas[A][B]*self.ce_bulk[A] for B in self.atom_types] for A in self.atom_types]
+        if all(isinstance(p,(int,float,np.number)) for row in params for p in row):
+            return np.array(params,dtype=float)
+        return np.array(params,dtype=object)
 
+    @profiled
     def calc_ce(self):
-        """Calculate the CE of the metal nanoparticle with the modified BCM"""
+        """Calculate the CE of the metal nanoparticle with the modified BCM (works with numeric or sympy gammas)"""
+        num_sum = (self.get_param_matrix()*self.bond_coeffs).sum()
+        return (num_sum/(len(self.atoms)*2)) # CE of the metal nanoparticle
+
+    def calc_ce_loop(self):
+        """Calculate the CE of the metal nanoparticle with the modified BCM one bond at a time (reference implementation of calc_ce)"""
         num_sum = 0
         for i,j in self.bcm.bond_list:
             A = self.atoms.symbols[i]
@@ -74,4 +99,3 @@ class BCM_Mod:
             part_2 = self.gammas[B][A]*(self.ce_bulk[B]/self.cns[j])*np.sqrt(self.cns[j]/self.Cb) 
             num_sum += (part_1 + part_2)
         return (num_sum/(len(self.atoms)*2)) # CE of the metal nanoparticle
-    
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""Composition sweeps: optimize the chemical ordering of one geometry over a grid of compositions (binary lines or ternary maps)
+
+Example)
+    python -m CANELa_NP.Composition_Sweep Example_Data/AuPdPt.xyz Au Pd Pt --divisions 10 -o AuPdPt_sweep.jsonl
+"""
+import argparse
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations_with_replacement
+
+import numpy as np
+from ase.io import read
+
+from ce_expansion.atomgraph.adjacency import build_bonds_arr
+from ce_expansion.ga.ga import GA
+
+from CANELa_NP.Nanotools import make_bcm, make_bcm_int, get_cutoffs, get_core_shell_index, get_shell_counts
+
+def composition_grid(n_atoms,elements,divisions):
+    """Evenly spaced compositions on the simplex of the given elements (a line for binaries, a triangle for ternaries)
+
+    Args:
+        n_atoms (int): number of atoms in the nanoparticle
+        elements (list): element symbols
+        divisions (int): number of intervals along each edge of the simplex
+
+    Returns:
+        compositions (list): list of {element: count} dicts (counts sum to n_atoms)
+    """
+    compositions = []
+    seen = set()
+    for combo in combinations_with_replacement(range(len(elements)),divisions):
+        fractions = np.bincount(combo,minlength=len(elements))/divisions
+        counts = np.floor(fractions*n_atoms).astype(int)
+        # give the atoms lost to rounding to the elements with the largest remainders
+        remainders = fractions*n_atoms - counts
+        counts[np.argsort(-remainders,kind='stable')[:n_atoms - counts.sum()]] += 1
+        key = tuple(counts)
+        if key not in seen:
+            seen.add(key)
+            compositions.append({el:int(n) for el,n in zip(elements,counts)})
+    return compositions
+
+def composition_id(composition):
+    """Key used to match results to compositions (ex: 'Au50Pd97')"""
+    return ''.join(f'{el}{n}' for el,n in sorted(composition.items()) if n)
+
+# Geometry precomputations shared by all compositions, set once per worker process by _init_worker
+_worker = {}
+
+def _init_worker(atoms,x,method):
+    _worker['atoms'] = atoms
+    _worker['x'] = x
+    _worker['method'] = method
+    _worker['bonds'] = build_bonds_arr(atoms,get_cutoffs(atoms,x))
+    shell_map = make_bcm_int(atoms).shell_map
+    _worker['shell_idx'] = get_core_shell_index(shell_map,len(atoms))
+    _worker['n_shells'] = len(shell_map) - 1
+
+def _optimize_composition(composition,seed,max_gens,max_nochange):
+    """Optimize the ordering of one composition on the shared geometry"""
+    np.random.seed(seed)
+    random.seed(seed)
+    elements = sorted(el for el,n in composition.items() if n)
+    counts = [composition[el] for el in elements]
+    atoms = _worker['atoms'].copy()
+    atoms.symbols = np.repeat(elements,counts)
+    bcm = make_bcm(atoms,x=_worker['x'],CN_Method=_worker['method'],bond_list=_worker['bonds'])
+    if len(elements) > 1:
+        ga = GA(bcm,counts,composition_id(composition))
+        ga.run(max_gens=max_gens,max_nochange=max_nochange)
+        ordering = np.asarray(ga.pop[0].arr)
+    else:
+        ordering = np.zeros(len(atoms),dtype=int)
+    ce = float(bcm.calc_ce(ordering))
+
+    shell_idx,n_shells = _worker['shell_idx'],_worker['n_shells']
+    counts = get_shell_counts(shell_idx,ordering,len(elements),n_shells)[0]
+    totals = counts.sum(axis=1)
+    shell_comps = {el:(counts[:,i]/totals).tolist() for i,el in enumerate(elements)}
+    return {'id':composition_id(composition),
+            'composition':composition,
+            'ce':ce,
+            'elements':elements,
+            'ordering':ordering.tolist(),
+            'shells':list(range(1,len(totals) + 1)),
+            'shell_comps':shell_comps,
+            'totals':totals.tolist()}
+
+def load_results(results_path):
+    """Read the results written so far by run_sweep
+
+    Returns:
+        results (dict): {composition id: result record}
+    """
+    results = {}
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError: # partially written last line of an interrupted run
+                        continue
+                    results[record['id']] = record
+    return results
+
+def run_sweep(structure,compositions,results_path,x=1.20,method='frac',max_gens=-1,max_nochange=2000,seed=0,n_jobs=None):
+    """Optimize the chemical ordering of one geometry for every composition in parallel.  Each result is appended to
+    results_path (json lines) as soon as it is done, and compositions already in results_path are skipped so a sweep can be resumed.
+
+    The bond list is built once from the template structure and reused for every composition (the GA also keeps the bonds fixed
+    while it changes the ordering).
+
+    Args:
+        structure (str): path to the xyz file or the atoms object (the template geometry)
+        compositions (list): list of {element: count} dicts (see composition_grid)
+        results_path (str): json lines file the results are streamed to
+        x (float, optional): scaling factor for the cutoffs. Defaults to 1.20.
+        method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
+        max_gens (int, optional): max number of GA generations (-1 for no limit). Defaults to -1.
+        max_nochange (int, optional): max number of GA generations without a change in the best fitness. Defaults to 2000.
+        seed (int, optional): base seed (every composition gets its own seed derived from it). Defaults to 0.
+        n_jobs (int, optional): number of worker processes. Defaults to None (all cores).
+
+    Returns:
+        results (dict): {composition id: result record} for every composition
+    """
+    atoms = read(structure) if isinstance(structure,str) else structure
+    for composition in compositions:
+        if sum(composition.values()) != len(atoms):
+            raise ValueError(f"Composition {composition_id(composition)} does not have {len(atoms)} atoms")
+    results = load_results(results_path)
+    todo = [c for c in compositions if composition_id(c) not in results]
+    if not todo:
+        return results
+
+    with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_worker,initargs=(atoms,x,method)) as pool, \
+         open(results_path,'a+') as f:
+        if f.tell() > 0: # start on a new line after the partially written last line of an interrupted run
+            f.seek(f.tell() - 1)
+            if f.read(1) != '\n':
+                f.write('\n')
+        futures = []
+        for composition in todo:
+            counts = [composition[el] for el in sorted(composition)]
+            point_seed = int(np.random.SeedSequence([seed,*counts]).generate_state(1)[0])
+            futures.append(pool.submit(_optimize_composition,composition,point_seed,max_gens,max_nochange))
+        for future in as_completed(futures):
+            record = future.result()
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            results[record['id']] = record
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Optimize the chemical ordering of one NP geometry over a grid of compositions')
+    parser.add_argument('structure', type=str, help='xyz file of the template geometry')
+    parser.add_argument('elements', type=str, nargs='+', help='Elements of the sweep (2 for a binary line, 3 for a ternary map)')
+    parser.add_argument('-d', '--divisions', type=int, default=10, help='Intervals along each edge of the composition simplex (default=10)')
+    parser.add_argument('-o', '--output', type=str, default='sweep_results.jsonl', help='Results file (json lines), resumed if it exists')
+    parser.add_argument('-x', type=float, default=1.20, help='Scaling factor for the cutoffs (default=1.20)')
+    parser.add_argument('--method', type=str, default='frac', help="Method for calculating coordination number (default='frac')")
+    parser.add_argument('--max_gens', type=int, default=-1, help='Max number of GA generations (default=-1, no limit)')
+    parser.add_argument('--max_nochange', type=int, default=2000, help='Max number of GA generations without improvement (default=2000)')
+    parser.add_argument('--seed', type=int, default=0, help='Base seed (default=0)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    n_atoms = len(read(args.structure))
+    compositions = composition_grid(n_atoms,args.elements,args.divisions)
+    results = run_sweep(args.structure,compositions,args.output,x=args.x,method=args.method,max_gens=args.max_gens,
+                        max_nochange=args.max_nochange,seed=args.seed,n_jobs=args.jobs)
+    for composition in compositions:
+        record = results[composition_id(composition)]
+        print(f"{record['id']}: {record['ce']:.5f} eV/atom")
@@ -0,0 +1,233 @@
+"""Indexed store of the DFT (PBE+D3) single atom and NP energies
+
+The Excel and csv tables are parsed once into arrays (element counts of every NP, NP energies and single atom energies)
+that are cached on disk next to a signature of the source files, so later runs and worker processes load them in
+milliseconds and look energies up by composition in microseconds.  Cohesive energies of every row are computed in one
+vectorized pass, for any composition and size.
+
+Structures are named after their formula and, for the generated training sets, a tag with their shape and number of shells
+(ex: Au74Pd73-decahedron-4, see Setup_NPs_for_DFT.get_file_name), so NPs with the same composition but different shapes
+have their own energies.  The names of the original structures have no tag.
+
+Example)
+    store = load_energy_store()
+    store.get_ce('Au74Pd73')
+    store.get_ce('Au74Pd73-decahedron-4')
+    store.cohesive_energies() # every NP in the table
+"""
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from ase.formula import Formula
+
+Ha_to_eV = 27.2114
+store_version = 2
+data_folder = os.path.join(os.path.dirname(__file__), "Data")
+atom_energies_path = os.path.join(data_folder, "single_atom_energies.xlsx") # single point energies (Ha) of the atoms
+NP_energies_path = os.path.join(data_folder, "NP_energies.csv") # energies (eV) of the NPs
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'CANELa_NP', 'dft_energies')
+
+def find_base(x):
+    """find the base filename from the path
+
+    Args:
+        x (str): path to the file
+
+    Returns:
+        sol (str): Base filename without the RESTART_ generated by cp2k_helper
+    """
+    sol = os.path.basename(x)
+    if 'RESTART' in sol:
+        sol = sol.replace('RESTART_',"")
+    return sol
+
+def split_name(name):
+    """Split the name of a structure (path of the calculation or xyz file) into its formula and its tag
+
+    Ex) split_name('Data/PdAu-decahedron/Au74Pd73-decahedron-4.xyz') == ('Au74Pd73', 'decahedron-4')
+
+    Args:
+        name (str): structure name or path
+
+    Returns:
+        formula (str): chemical formula
+        tag (str): shape and number of shells ('' for the untagged original structures)
+    """
+    base = find_base(name)
+    if base.endswith('.xyz'):
+        base = base[:-len('.xyz')]
+    formula,_,tag = base.partition('-')
+    return formula,tag
+
+def composition_key(formula):
+    """Order independent key for a composition ('Pd74Ag73' and 'Ag73Pd74' give the same key)
+
+    Args:
+        formula (str or dict): chemical formula or {element: count}
+
+    Returns:
+        key (tuple): sorted ((element, count), ...)
+    """
+    if isinstance(formula,str):
+        formula = Formula(formula).count()
+    return tuple(sorted((str(el),int(n)) for el,n in formula.items() if n))
+
+class EnergyStore:
+    def __init__(self,elements,atom_energies,counts,energies,names,tags=None):
+        """DFT energies indexed by composition and tag
+
+        Args:
+            elements (list): element symbols (columns of counts)
+            atom_energies (np.ndarray): (elements,) single atom energy (eV) of each element, nan if unknown
+            counts (np.ndarray): (rows, elements) number of atoms of each element in every NP
+            energies (np.ndarray): (rows,) NP energies (eV)
+            names (list): (rows,) name of every NP (the base folder name of the calculation)
+            tags (list, optional): (rows,) tag of every NP (see split_name). Defaults to None (untagged).
+        """
+        self.elements = [str(el) for el in elements]
+        self.atom_energies = np.asarray(atom_energies,dtype=float)
+        self.counts = np.asarray(counts,dtype=np.int64)
+        self.energies = np.asarray(energies,dtype=float)
+        self.names = [str(name) for name in names]
+        self.tags = ['']*len(self.names) if tags is None else [str(tag) for tag in tags]
+        self.column = {el:i for i,el in enumerate(self.elements)}
+        # later rows win when a structure was calculated more than once (same as the original tables)
+        self.index = {(self._row_key(row),tag):i for i,(row,tag) in enumerate(zip(self.counts,self.tags))}
+
+    def _row_key(self,row):
+        return tuple((self.elements[j],int(row[j])) for j in np.flatnonzero(row))
+
+    @staticmethod
+    def _key(formula,tag=''):
+        """(composition_key, tag) of a formula, structure name ('Au74Pd73-decahedron-4'), {element: count} or atoms object"""
+        if hasattr(formula,'get_chemical_formula'):
+            formula = formula.get_chemical_formula()
+        if isinstance(formula,str):
+            formula,name_tag = split_name(formula)
+            tag = tag or name_tag
+        return composition_key(formula),tag
+
+    @classmethod
+    def from_tables(cls,atom_energies=atom_energies_path,NP_energies=NP_energies_path):
+        """Parse the single atom (Excel, Ha) and NP (csv, eV) energy tables"""
+        df_single_atom = pd.read_excel(atom_energies)
+        d_energies = {str(el):float(e)*Ha_to_eV for el,e in zip(df_single_atom['NP'],df_single_atom['Energy (Ha)'])}
+        df = pd.read_csv(NP_energies)
+        names = [find_base(name) for name in df['Folder_Name']]
+        formulas,tags = zip(*[split_name(name) for name in names]) if names else ((),())
+        compositions = [dict(composition_key(formula)) for formula in formulas]
+        elements = sorted(set(d_energies).union(*compositions))
+        counts = np.array([[c.get(el,0) for el in elements] for c in compositions],dtype=np.int64).reshape(len(names),len(elements))
+        atom_e = np.array([d_energies.get(el,np.nan) for el in elements])
+        return cls(elements,atom_e,counts,df['Energy (eV)'].to_numpy(dtype=float),names,tags)
+
+    def save(self,path):
+        """Write the store as an .npz file (atomic)"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        fd,tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            np.savez(f,elements=np.array(self.elements),atom_energies=self.atom_energies,counts=self.counts,
+                     energies=self.energies,names=np.array(self.names),tags=np.array(self.tags))
+        os.replace(tmp_path,path)
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as data:
+            return cls(data['elements'],data['atom_energies'],data['counts'],data['energies'],data['names'],data['tags'])
+
+    def __len__(self):
+        return len(self.energies)
+
+    def __contains__(self,formula):
+        return self._key(formula) in self.index
+
+    def get_energy(self,formula,tag=''):
+        """DFT energy (eV) of a structure (formula string or name, {element: count}), None if it was not calculated"""
+        row = self.index.get(self._key(formula,tag))
+        return None if row is None else float(self.energies[row])
+
+    def get_ce(self,formula,tag=''):
+        """Cohesive energy (eV/atom) of a structure (formula string or name, {element: count} or atoms object), None if it was not calculated"""
+        key,tag = self._key(formula,tag)
+        row = self.index.get((key,tag))
+        if row is None:
+            return None
+        return float((self.energies[row] - sum(n*self.atom_energies[self.column[el]] for el,n in key))/sum(n for el,n in key))
+
+    def cohesive_energies(self,rows=None):
+        """Cohesive energies (eV/atom) of many rows at once: (E_NP - counts @ E_atoms)/N
+
+        Args:
+            rows (array-like, optional): rows (indices or boolean mask) to compute. Defaults to None (every row).
+
+        Returns:
+            ces (np.ndarray): cohesive energy of each row (nan if a single atom energy is missing)
+        """
+        counts = self.counts if rows is None else self.counts[rows]
+        energies = self.energies if rows is None else self.energies[rows]
+        atom_e = np.where(np.isnan(self.atom_energies),0.0,self.atom_energies)
+        ces = (energies - counts @ atom_e)/counts.sum(axis=1)
+        missing = (counts[:,np.isnan(self.atom_energies)] > 0).any(axis=1)
+        ces[missing] = np.nan
+        return ces
+
+    def select(self,elements=None,n_atoms=None):
+        """Boolean mask of the rows made only of the given elements and/or with the given number of atoms"""
+        mask = np.ones(len(self),dtype=bool)
+        if elements is not None:
+            others = [self.column[el] for el in self.elements if el not in set(elements)]
+            mask &= (self.counts[:,others] == 0).all(axis=1)
+        if n_atoms is not None:
+            mask &= self.counts.sum(axis=1) == n_atoms
+        return mask
+
+    def to_tables(self):
+        """The store as the dictionaries of Gamma_Value_Calc.load_energy_tables
+
+        Returns:
+            d_energies (dict): {element: single atom energy (eV)}
+            np_energies (dict): {(composition_key, tag): NP energy (eV)}
+        """
+        d_energies = {el:float(e) for el,e in zip(self.elements,self.atom_energies) if not np.isnan(e)}
+        np_energies = {key:float(self.energies[row]) for key,row in self.index.items()}
+        return d_energies,np_energies
+
+def _signature(*paths):
+    """Changes whenever one of the source tables changes"""
+    h = hashlib.sha1(f'{store_version}'.encode())
+    for path in paths:
+        stat = os.stat(path)
+        h.update(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+@lru_cache(maxsize=None)
+def _load_energy_store(signature,atom_energies,NP_energies,cache_dir):
+    if cache_dir is None:
+        return EnergyStore.from_tables(atom_energies,NP_energies)
+    path = os.path.join(cache_dir,signature + '.npz')
+    try:
+        return EnergyStore.load(path)
+    except (FileNotFoundError,OSError,ValueError,KeyError):
+        store = EnergyStore.from_tables(atom_energies,NP_energies)
+        try:
+            store.save(path)
+        except OSError: # read only home, the store is still kept in memory
+            pass
+        return store
+
+def load_energy_store(atom_energies=atom_energies_path,NP_energies=NP_energies_path,cache_dir=default_cache_dir):
+    """Load the DFT energies (parsed once, then read from the on-disk cache and kept in memory until the tables change)
+
+    Args:
+        atom_energies (str, optional): path to the single atom energies (Ha). Defaults to Data/single_atom_energies.xlsx.
+        NP_energies (str, optional): path to the NP energies (eV). Defaults to Data/NP_energies.csv.
+        cache_dir (str, optional): folder of the cached stores, None to always parse the tables. Defaults to ~/.cache/CANELa_NP/dft_energies.
+
+    Returns:
+        store (EnergyStore): the indexed energies
+    """
+    return _load_energy_store(_signature(atom_energies,NP_energies),os.path.abspath(atom_energies),os.path.abspath(NP_energies),cache_dir)
@@ -0,0 +1,104 @@
+"""Offline element property registry (covalent radii, crystal radii and CPK colors).
+
+The table is bundled with the package in Data/element_properties.csv so building a
+Nanoparticle never needs network access.  It is parsed once and memoized.
+
+Covalent radii are from Cordero et al. (Dalton Trans., 2008), crystal radii are the
+12-coordinate metallic radii of the elemental crystals and colors are the Jmol CPK colors.
+"""
+import csv
+import os
+from functools import lru_cache
+
+element_data_path = os.path.join(os.path.dirname(__file__), "Data", "element_properties.csv")
+
+# Custom radii (in Angstroms, before scaling) that take priority over the bundled table.
+# Please add your own custom radii here or with set_custom_radii.
+custom_radii = {'Au':1.47,
+                'Pd':1.38,
+                'Pt':1.38}
+
+@lru_cache(maxsize=None)
+def load_element_table(path=element_data_path):
+    """Read the bundled element property table (only done once per path)
+
+    Args:
+        path (str, optional): path to the csv table. Defaults to the bundled Data/element_properties.csv.
+
+    Returns:
+        table (dict): {symbol: {'covalent': float, 'crystal': float or None, 'color': str}}
+    """
+    table = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            crystal = row['Crystal Radius [A]']
+            table[row['Symbol']] = {'covalent': float(row['Covalent Radius [A]']),
+                                    'crystal': float(crystal) if crystal else None,
+                                    'color': row['CPK Color']}
+    return table
+
+def _lookup(element):
+    table = load_element_table()
+    if element not in table:
+        raise KeyError(f"No element properties available for '{element}'")
+    return table[element]
+
+def set_custom_radii(radii, replace=False):
+    """Override the radii used for building bonds
+
+    Args:
+        radii (dict): {symbol: radius in Angstroms (unscaled)}
+        replace (bool, optional): Whether to drop all previous custom radii first. Defaults to False.
+    """
+    if replace:
+        custom_radii.clear()
+    custom_radii.update(radii)
+
+def get_covalent_radius(element):
+    """Covalent radius of an element in Angstroms"""
+    return _lookup(element)['covalent']
+
+def get_crystal_radius(element):
+    """Crystal radius of an element in Angstroms (falls back to the covalent radius if unknown)"""
+    props = _lookup(element)
+    return props['crystal'] if props['crystal'] is not None else props['covalent']
+
+def get_cpk_color(element):
+    """CPK color of an element as a '#RRGGBB' string"""
+    return "#" + _lookup(element)['color']
+
+def get_radii(elements, x=1.0, kind='covalent'):
+    """Get the scaled radii for a set of elements.  Custom radii take priority over the bundled table.
+
+    Args:
+        elements (iterable): element symbols
+        x (float, optional): scaling factor for the radii. Defaults to 1.0.
+        kind (str, optional): 'covalent' or 'crystal' radii for elements without custom radii. Defaults to 'covalent'.
+
+    Returns:
+        radii (dict): {symbol: scaled radius}
+    """
+    if kind == 'covalent':
+        default = get_covalent_radius
+    elif kind == 'crystal':
+        default = get_crystal_radius
+    else:
+        raise ValueError(f"Unknown radius kind '{kind}', use 'covalent' or 'crystal'")
+    radii = {}
+    for element in set(elements):
+        radius = custom_radii[element] if element in custom_radii else default(element)
+        radii[element] = radius*x
+    return radii
+
+def get_colors_table(elements=None):
+    """CPK colors as a DataFrame with 'Element' and 'Hexadecimal Web Color' columns
+
+    Args:
+        elements (iterable, optional): element symbols to include. Defaults to all elements in the table.
+    """
+    import pandas as pd
+    table = load_element_table()
+    if elements is None:
+        elements = list(table)
+    return pd.DataFrame({'Element': list(elements),
+                         'Hexadecimal Web Color': [table[el]['color'] for el in elements]})
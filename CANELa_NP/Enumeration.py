@@ -0,0 +1,259 @@
+"""Exhaustive, symmetry-reduced enumeration of the chemical orderings of small nanoparticles
+
+For small clusters (13, 55 atoms) and dilute dopings every ordering can be scored, which gives the exact global
+optimum instead of a GA estimate.  Most orderings are equivalent under the point group of the cluster (120 operations
+for an icosahedron, 48 for a cuboctahedron), so only one ordering of every symmetry class is generated:
+
+    1. the point group operations are found from the positions (centered on the center atom of bcm_int.shell_map) and
+       kept as atom permutations if they also map the bonds, the CNs and the shells onto themselves, so that
+       equivalent orderings have exactly the same BCM CE
+    2. the dopants are placed one at a time on every host site of the distinct orderings of the previous step and every
+       new ordering is reduced to its canonical form (the smallest of its images under the group), a set of canonical
+       forms removes the duplicates
+    3. the distinct orderings are scored with the vectorized batch CE (calc_ce_batch) and ranked
+
+Example)
+    orderings,ces,degeneracy = enumerate_nanoparticle(NP,{'Au':12,'Pd':1})
+    NP.update_ordering(orderings[0]) # global optimum
+"""
+from math import factorial
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from CANELa_NP.Nanotools import calc_ce_batch, get_ordering_of
+from CANELa_NP.Profiling import profiled
+
+def _atom_classes(positions,center,invariants,tol):
+    """Class of every atom (same distance to the center and same invariants), only atoms of the same class can be swapped"""
+    radii = np.linalg.norm(positions - center,axis=1)
+    order = np.argsort(radii)
+    radius_class = np.empty(len(radii),dtype=np.int64)
+    radius_class[order] = np.concatenate([[0],np.cumsum(np.diff(radii[order]) > tol)])
+    columns = [radius_class] + [np.asarray(inv).reshape(-1) for inv in invariants]
+    return np.unique(np.column_stack(columns),axis=0,return_inverse=True)[1].reshape(-1),radii
+
+def _frame(a,b):
+    """Orthonormal frame (as columns) with a along the first axis and b in the first two axes"""
+    e1 = a/np.linalg.norm(a)
+    e2 = b - (b @ e1)*e1
+    e2 /= np.linalg.norm(e2)
+    return np.column_stack([e1,e2,np.cross(e1,e2)])
+
+@profiled
+def get_symmetry_permutations(positions,center=None,bonds=None,invariants=(),tol=1e-3):
+    """Atom permutations of the point group operations (rotations and reflections) of a cluster
+
+    Args:
+        positions (np.ndarray): (N, 3) atom positions
+        center (np.ndarray, optional): (3,) fixed point of the operations. Defaults to None (the centroid).
+        bonds (np.ndarray, optional): (bonds, 2) bond list that every permutation must map onto itself. Defaults to None.
+        invariants (list, optional): (N,) arrays (CNs, shell numbers, ...) that every permutation must keep. Defaults to ().
+        tol (float, optional): tolerance (Ang) on the positions. Defaults to 1e-3.
+
+    Returns:
+        perms (np.ndarray): (G, N) permutations (the first one is the identity), the atom on site i moves to site perms[g, i]
+    """
+    positions = np.asarray(positions,dtype=float)
+    n_atoms = len(positions)
+    identity = np.arange(n_atoms)[None]
+    center = positions.mean(axis=0) if center is None else np.asarray(center,dtype=float)
+    pos = positions - center
+    classes,radii = _atom_classes(positions,center,invariants,tol)
+    class_sizes = np.bincount(classes)
+
+    # reference atoms: a in the smallest class off the center, b not collinear with a (smallest class again)
+    off_center = np.flatnonzero(radii > tol)
+    if len(off_center) == 0:
+        return identity
+    a = off_center[np.argmin(class_sizes[classes[off_center]])]
+    sines = np.linalg.norm(np.cross(pos[a],pos[off_center]),axis=1)/(radii[a]*radii[off_center])
+    not_collinear = off_center[sines > 0.1]
+    if len(not_collinear) == 0: # linear cluster
+        return identity
+    b = not_collinear[np.argmin(class_sizes[classes[not_collinear]])]
+    frame = _frame(pos[a],pos[b])
+
+    tree = cKDTree(pos)
+    bond_codes = None
+    if bonds is not None:
+        bonds = np.asarray(bonds).reshape(-1,2)
+        bond_codes = np.sort(bonds[:,0]*n_atoms + bonds[:,1])
+    perms = []
+    dot = pos[a] @ pos[b]
+    for new_a in np.flatnonzero(classes == classes[a]):
+        for new_b in np.flatnonzero(classes == classes[b]):
+            if abs(pos[new_a] @ pos[new_b] - dot) > 2*tol*(radii[a] + radii[b]) or new_a == new_b:
+                continue
+            new_frame = _frame(pos[new_a],pos[new_b])
+            for handedness in (1,-1): # rotation, then rotation + reflection
+                rotation = (new_frame*[1,1,handedness]) @ frame.T
+                dist,perm = tree.query(pos @ rotation.T,distance_upper_bound=tol)
+                if np.isinf(dist).any() or len(np.unique(perm)) != n_atoms:
+                    continue
+                if (classes[perm] != classes).any():
+                    continue
+                if bond_codes is not None and not np.array_equal(np.sort(perm[bonds[:,0]]*n_atoms + perm[bonds[:,1]]),bond_codes):
+                    continue
+                perms.append(perm)
+    perms = np.unique(np.array(perms,dtype=np.int64).reshape(-1,n_atoms),axis=0)
+    # identity first
+    return np.concatenate([identity,perms[(perms != identity).any(axis=1)]])
+
+def _site_bits(perms,n_words):
+    """(G, N, n_words) uint64 bit of the site every atom moves to under every operation"""
+    n_atoms = perms.shape[1]
+    bits = np.zeros((n_atoms,n_words),dtype=np.uint64)
+    bits[np.arange(n_atoms),np.arange(n_atoms)//64] = np.uint64(1) << (np.arange(n_atoms) % 64).astype(np.uint64)
+    return bits[perms]
+
+def canonical_keys(orderings,perms,host=0,n_types=None,chunk_size=4096,return_stabilizer=False):
+    """Canonical form of many orderings of the same composition (the same key for every ordering of a symmetry class)
+
+    An ordering is stored as one bit mask of the sites of every type but the host, so only the dopant sites are permuted
+    (G x dopants per ordering instead of G x N).  The canonical form is the smallest image of the masks under the group.
+
+    Args:
+        orderings (np.ndarray): (M, N) orderings, all with the same composition
+        perms (np.ndarray): (G, N) permutations of the point group (see get_symmetry_permutations)
+        host (int, optional): type left out of the masks (use the most abundant one). Defaults to 0.
+        n_types (int, optional): number of atom types. Defaults to None (the largest type + 1).
+        chunk_size (int, optional): number of orderings reduced at a time. Defaults to 4096.
+        return_stabilizer (bool, optional): Whether to also return the number of operations that leave every ordering unchanged. Defaults to False.
+
+    Returns:
+        keys (np.ndarray): (M, W) uint64 masks of the canonical orderings (see keys_to_orderings)
+        stabilizer (np.ndarray): (M,) order of the stabilizer of every ordering (G/stabilizer equivalent orderings), if return_stabilizer
+    """
+    orderings = np.atleast_2d(np.asarray(orderings))
+    perms = np.asarray(perms)
+    n_atoms = orderings.shape[1]
+    n_words = -(-n_atoms//64)
+    if n_types is None:
+        n_types = int(orderings.max()) + 1
+    dopant_types = [t for t in range(n_types) if t != host]
+    counts = [int((orderings[0] == t).sum()) for t in dopant_types]
+    if any(((orderings == t).sum(axis=1) != n).any() for t,n in zip(dopant_types,counts)):
+        raise ValueError("canonical_keys needs orderings of the same composition")
+    site_bits = _site_bits(perms,n_words)
+    keys = np.empty((len(orderings),n_words*len(dopant_types)),dtype=np.uint64)
+    stabilizer = np.empty(len(orderings),dtype=np.int64)
+    for start in range(0,len(orderings),chunk_size):
+        chunk = orderings[start:start+chunk_size]
+        masks = []
+        for t,n in zip(dopant_types,counts):
+            sites = np.nonzero(chunk == t)[1].reshape(len(chunk),n)
+            masks.append(site_bits[:,sites].sum(axis=2,dtype=np.uint64)) # (G, chunk, n_words), the bits are disjoint
+        words = np.concatenate(masks,axis=2)
+        smallest = np.ones(words.shape[:2],dtype=bool) # images equal to the smallest one so far
+        for w in range(words.shape[2]):
+            column = np.where(smallest,words[:,:,w],np.iinfo(np.uint64).max)
+            keys[start:start+chunk_size,w] = column.min(axis=0)
+            smallest &= column == keys[start:start+chunk_size,w]
+        stabilizer[start:start+chunk_size] = smallest.sum(axis=0)
+    if return_stabilizer:
+        return keys,stabilizer
+    return keys
+
+def keys_to_orderings(keys,n_atoms,host=0,n_types=None):
+    """(M, N) uint8 orderings of keys from canonical_keys (same host and n_types)"""
+    keys = np.asarray(keys,dtype=np.uint64).reshape(len(keys),-1)
+    n_words = -(-n_atoms//64)
+    n_types = keys.shape[1]//n_words + 1 if n_types is None else n_types
+    bits = ((keys[:,:,None] >> np.arange(64,dtype=np.uint64)) & np.uint64(1)).astype(bool).reshape(len(keys),-1,n_words*64)
+    orderings = np.full((len(keys),n_atoms),host,dtype=np.uint8)
+    for i,t in enumerate(t for t in range(n_types) if t != host):
+        orderings[bits[:,i,:n_atoms]] = t
+    return orderings
+
+def count_orderings(counts):
+    """Number of orderings (without symmetry) of a composition, N!/prod(n_t!)"""
+    total = factorial(int(sum(counts)))
+    for n in counts:
+        total //= factorial(int(n))
+    return total
+
+@profiled
+def enumerate_orderings(perms,counts,max_orderings=2_000_000,chunk_size=4096):
+    """Every symmetry-distinct ordering of a composition
+
+    Args:
+        perms (np.ndarray): (G, N) permutations of the point group (see get_symmetry_permutations)
+        counts (list): number of atoms of every type (sums to N)
+        max_orderings (int, optional): refuse compositions with more than about this many distinct orderings. Defaults to 2_000_000.
+        chunk_size (int, optional): orderings reduced at a time (see canonical_keys). Defaults to 4096.
+
+    Returns:
+        orderings (np.ndarray): (M, N) uint8 canonical orderings
+        degeneracy (np.ndarray): (M,) number of equivalent orderings in every symmetry class (sums to count_orderings(counts))
+    """
+    perms = np.asarray(perms)
+    counts = [int(n) for n in counts]
+    n_atoms = perms.shape[1]
+    if sum(counts) != n_atoms:
+        raise ValueError(f"The composition has {sum(counts)} atoms, the nanoparticle has {n_atoms}")
+    if count_orderings(counts)//len(perms) > max_orderings: # lower bound on the number of symmetry classes
+        raise ValueError(f"About {count_orderings(counts)//len(perms):.3g} distinct orderings (> max_orderings), use run_ga instead")
+    host = int(np.argmax(counts)) # the dopants are placed on the most abundant type
+    n_types = len(counts)
+    keys,stabilizer = canonical_keys(np.full((1,n_atoms),host),perms,host=host,n_types=n_types,return_stabilizer=True)
+    for t,n in enumerate(counts):
+        if t == host:
+            continue
+        for _ in range(n):
+            current = keys_to_orderings(keys,n_atoms,host=host,n_types=n_types)
+            rows,sites = np.nonzero(current == host)
+            seen = {} # canonical form: stabilizer order, for every ordering found so far with this number of dopants
+            for start in range(0,len(rows),chunk_size):
+                new = current[rows[start:start+chunk_size]]
+                new[np.arange(len(new)),sites[start:start+chunk_size]] = t
+                new_keys,new_stabilizer = canonical_keys(new,perms,host=host,n_types=n_types,return_stabilizer=True)
+                seen.update(zip(map(bytes,new_keys),new_stabilizer.tolist()))
+            keys = np.frombuffer(b''.join(seen),dtype=np.uint64).reshape(len(seen),-1)
+            stabilizer = np.array(list(seen.values()),dtype=np.int64)
+    orderings = keys_to_orderings(keys,n_atoms,host=host,n_types=n_types)
+    return orderings,len(perms)//stabilizer
+
+def get_nanoparticle_symmetry(NP,tol=1e-3):
+    """Point group permutations of a Nanoparticle that keep its bonds, CNs and shells (so they keep the BCM CE)
+
+    Args:
+        NP (Nanoparticle): the nanoparticle
+        tol (float, optional): tolerance (Ang) on the positions, raise it for relaxed structures. Defaults to 1e-3.
+
+    Returns:
+        perms (np.ndarray): (G, N) permutations
+    """
+    positions = NP.atoms.get_positions()
+    center_atoms = NP.bcm_int.shell_map[0]
+    center = positions[center_atoms[0]] if len(center_atoms) == 1 else None
+    return get_symmetry_permutations(positions,center=center,bonds=NP.bcm.bond_list,
+                                     invariants=[NP.shell_idx,np.round(np.asarray(NP.bcm.cn,dtype=float),8)],tol=tol)
+
+def enumerate_nanoparticle(NP,composition=None,n_best=None,perms=None,max_orderings=2_000_000):
+    """Exact ranking of every symmetry-distinct ordering of a Nanoparticle by BCM CE (the bonds are kept fixed, as in the GA)
+
+    Args:
+        NP (Nanoparticle): the nanoparticle (its geometry, bonds and metals are used)
+        composition (dict, optional): {metal: number of atoms}, metals in NP.unique_metals. Defaults to the current composition.
+        n_best (int, optional): number of orderings returned. Defaults to None (all of them).
+        perms (np.ndarray, optional): point group permutations. Defaults to None (NP.symmetry_perms).
+        max_orderings (int, optional): see enumerate_orderings. Defaults to 2_000_000.
+
+    Returns:
+        orderings (np.ndarray): (n_best, N) uint8 orderings (values index into NP.unique_metals), lowest CE first
+        ces (np.ndarray): (n_best,) cohesive energies (eV/atom)
+        degeneracy (np.ndarray): (n_best,) number of equivalent orderings of each
+    """
+    if composition is None:
+        counts = np.bincount(get_ordering_of(NP.atoms,NP.unique_metals),minlength=len(NP.unique_metals))
+    else:
+        unknown = set(composition) - set(NP.unique_metals)
+        if unknown:
+            raise ValueError(f"Cannot enumerate new metals {sorted(unknown)}, build a Nanoparticle with them instead")
+        counts = [composition.get(metal,0) for metal in NP.unique_metals]
+    perms = NP.symmetry_perms if perms is None else perms
+    orderings,degeneracy = enumerate_orderings(perms,counts,max_orderings=max_orderings)
+    ces = calc_ce_batch(NP.ce_precomps,orderings)
+    rank = np.argsort(ces,kind='stable')[:n_best]
+    return orderings[rank],ces[rank],degeneracy[rank]
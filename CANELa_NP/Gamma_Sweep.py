@@ -0,0 +1,148 @@
+"""CE of fixed structures for many gamma/bulk CE parameter sets at once (sensitivity and uncertainty studies)
+
+For a fixed structure the BCM cohesive energy is linear in gamma_ab*CE_bulk_a:
+
+    CE = sum_ab gamma_ab*CE_bulk_a*C_ab,    C_ab = sum over bonds i->j (i of type a, j of type b) of sqrt(CN_i/12)/CN_i / N
+
+so once the bond class coefficients C are known, the CE of M structures for K parameter sets is a single (M, T^2) x (T^2, K)
+matrix product and the derivatives are dCE/dgamma_ab = CE_bulk_a*C_ab and dCE/dCE_bulk_a = sum_b gamma_ab*C_ab.
+
+Example)
+    sweep = GammaSweep([NP1, NP2])
+    gammas, ce_bulk = sweep.sample(10000, gamma_std=0.05)
+    ces = sweep.calc_ce(gammas, ce_bulk) # (2, 10000)
+"""
+import numpy as np
+
+from CANELa_NP.Nanotools import Nanoparticle, make_bcm, get_ordering_of, get_bond_coeffs
+
+class GammaSweep:
+    def __init__(self,structures,metal_types=None,x=1.20,method='frac'):
+        """Precompute the bond class coefficients of every structure
+
+        Args:
+            structures (list): Nanoparticle objects (their bonds are reused) and/or atoms objects
+            metal_types (list, optional): atom types of the parameter arrays. Defaults to every metal of the structures (sorted).
+            x (float, optional): scaling factor for the cutoffs of atoms objects. Defaults to 1.20.
+            method (str, optional): Method for calculating coordination number of atoms objects. Defaults to 'frac'.
+        """
+        bcms,atoms_list = [],[]
+        for structure in structures:
+            if isinstance(structure,Nanoparticle):
+                bcms.append(structure.bcm)
+                atoms_list.append(structure.atoms)
+            else:
+                bcms.append(make_bcm(structure,x=x,CN_Method=method))
+                atoms_list.append(structure)
+        if metal_types is None:
+            metal_types = sorted(set(str(s) for atoms in atoms_list for s in atoms.symbols))
+        self.metal_types = list(metal_types)
+        n_types = len(self.metal_types)
+        self.coeffs = np.array([get_bond_coeffs(bcm.bond_list,bcm.cn,get_ordering_of(atoms,self.metal_types),n_types)/len(atoms)
+                                for bcm,atoms in zip(bcms,atoms_list)]).reshape(len(bcms),n_types,n_types)
+        # parameters of the model the structures were built with (np_gammas.json and ce_bulk_pbe_d3)
+        bcm = bcms[0]
+        self.gammas = np.array([[bcm.gammas[A][B] for B in self.metal_types] for A in self.metal_types],dtype=float)
+        self.ce_bulk = np.array([bcm.ce_bulk[A] for A in self.metal_types],dtype=float)
+
+    def __len__(self):
+        return len(self.coeffs)
+
+    def get_params(self,gammas=None,ce_bulk=None):
+        """Parameter arrays (defaults filled in, broadcast to K sets)
+
+        Args:
+            gammas (dict or np.ndarray, optional): {A: {B: gamma_AB}}, (T, T) or (K, T, T) gammas. Defaults to the current gammas.
+            ce_bulk (dict or np.ndarray, optional): {A: CE_bulk_A}, (T,) or (K, T) bulk CEs. Defaults to the current values.
+
+        Returns:
+            gammas (np.ndarray): (K, T, T)
+            ce_bulk (np.ndarray): (K, T)
+        """
+        if gammas is None:
+            gammas = self.gammas
+        elif isinstance(gammas,dict):
+            gammas = np.array([[gammas[A][B] for B in self.metal_types] for A in self.metal_types],dtype=float)
+        if ce_bulk is None:
+            ce_bulk = self.ce_bulk
+        elif isinstance(ce_bulk,dict):
+            ce_bulk = np.array([ce_bulk[A] for A in self.metal_types],dtype=float)
+        gammas = np.asarray(gammas,dtype=float)
+        ce_bulk = np.asarray(ce_bulk,dtype=float)
+        gammas = gammas.reshape((-1,) + gammas.shape[-2:])
+        ce_bulk = ce_bulk.reshape(-1,ce_bulk.shape[-1])
+        n_sets = max(len(gammas),len(ce_bulk))
+        return np.broadcast_to(gammas,(n_sets,) + gammas.shape[1:]),np.broadcast_to(ce_bulk,(n_sets,ce_bulk.shape[1]))
+
+    def calc_ce(self,gammas=None,ce_bulk=None):
+        """CE of every structure for every parameter set (one matrix product)
+
+        Args:
+            gammas (optional): gammas of the parameter sets, see get_params. Defaults to the current gammas.
+            ce_bulk (optional): bulk CEs of the parameter sets, see get_params. Defaults to the current values.
+
+        Returns:
+            ces (np.ndarray): (structures, K) cohesive energies (eV/atom)
+        """
+        gammas,ce_bulk = self.get_params(gammas,ce_bulk)
+        params = gammas*ce_bulk[:,:,None] # gamma_ab*CE_bulk_a
+        n_types = len(self.metal_types)
+        return self.coeffs.reshape(len(self),n_types**2) @ params.reshape(len(params),n_types**2).T
+
+    def gradient(self,gammas=None,ce_bulk=None,sum_constraint=False):
+        """Analytic derivatives of the CE of every structure at one parameter set
+
+        Args:
+            gammas (optional): gammas, see get_params. Defaults to the current gammas.
+            ce_bulk (optional): bulk CEs, see get_params. Defaults to the current values.
+            sum_constraint (bool, optional): Whether gamma_ba = 2 - gamma_ab, so d_gamma[:,a,b] (a < b) is the total derivative
+            with respect to the pair and the lower triangle is zero. Defaults to False.
+
+        Returns:
+            d_gamma (np.ndarray): (structures, T, T) dCE/dgamma_ab
+            d_ce_bulk (np.ndarray): (structures, T) dCE/dCE_bulk_a
+        """
+        gammas,ce_bulk = self.get_params(gammas,ce_bulk)
+        if len(gammas) != 1:
+            raise ValueError("gradient takes a single parameter set")
+        gammas,ce_bulk = gammas[0],ce_bulk[0]
+        d_gamma = ce_bulk[None,:,None]*self.coeffs
+        d_ce_bulk = (gammas[None]*self.coeffs).sum(axis=2)
+        if sum_constraint:
+            upper = np.triu(np.ones_like(gammas,dtype=bool),k=1)
+            d_gamma = np.where(upper,d_gamma - d_gamma.transpose(0,2,1),0.0)
+        return d_gamma,d_ce_bulk
+
+    def sample(self,n_samples,gamma_std=0.05,ce_bulk_std=0.0,sum_constraint=True,seed=None):
+        """Normally distributed parameter sets around the current gammas and bulk CEs (for uncertainty propagation)
+
+        Args:
+            n_samples (int): number of parameter sets K
+            gamma_std (float, optional): standard deviation of the mixed gammas (gamma_aa stays 1). Defaults to 0.05.
+            ce_bulk_std (float, optional): standard deviation of the bulk CEs (eV/atom). Defaults to 0.0.
+            sum_constraint (bool, optional): Whether to keep gamma_ab + gamma_ba = 2 (as in the fits). Defaults to True.
+            seed (int, optional): seed of the random generator. Defaults to None.
+
+        Returns:
+            gammas (np.ndarray): (K, T, T)
+            ce_bulk (np.ndarray): (K, T)
+        """
+        rng = np.random.default_rng(seed)
+        n_types = len(self.metal_types)
+        noise = rng.normal(0.0,gamma_std,(n_samples,n_types,n_types))
+        noise[:,np.arange(n_types),np.arange(n_types)] = 0.0
+        if sum_constraint: # gamma_ba moves opposite to gamma_ab
+            noise = np.triu(noise,k=1) - np.triu(noise,k=1).transpose(0,2,1)
+        gammas = self.gammas[None] + noise
+        ce_bulk = self.ce_bulk[None] + rng.normal(0.0,ce_bulk_std,(n_samples,n_types))
+        return gammas,ce_bulk
+
+    def uncertainty(self,n_samples=10000,gamma_std=0.05,ce_bulk_std=0.0,sum_constraint=True,seed=None):
+        """Mean and standard deviation of the CE of every structure over sampled parameter sets (see sample)
+
+        Returns:
+            mean (np.ndarray): (structures,) mean CE
+            std (np.ndarray): (structures,) standard deviation of the CE
+        """
+        ces = self.calc_ce(*self.sample(n_samples,gamma_std=gamma_std,ce_bulk_std=ce_bulk_std,sum_constraint=sum_constraint,seed=seed))
+        return ces.mean(axis=1),ces.std(axis=1)
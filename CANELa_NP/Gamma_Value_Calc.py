@@ -1,23 +1,42 @@
+"""Fit the gamma values of the BCM to the DFT cohesive energies of the NP structures in Data and store them in Data/np_gammas.json
+
+By default the gammas are a least-squares fit to the CE of every structure.  The gammas shipped in Data/np_gammas.json
+were fit with --combine (the sum of the CEs of each pair, the original scheme): refitting with --combine reproduces them,
+the default fit gives slightly different gammas for the pairs with more than two structures.
+
+Example)
+    python -m CANELa_NP.Gamma_Value_Calc Au Ag
+    python -m CANELa_NP.Gamma_Value_Calc --all -j 4
+    python -m CANELa_NP.Gamma_Value_Calc --all --combine # reproduces Data/np_gammas.json
+"""
 import pandas as pd
 import math
 from ase.io import read
 import numpy as np
 from ce_expansion.atomgraph.bcm import BCModel
-from BCM_Sandbox import BCM_Mod
+from CANELa_NP.BCM_Sandbox import BCM_Mod
 from ce_expansion.atomgraph.adjacency import build_bonds_arr
-from sympy.solvers import solve
-from sympy import Symbol
 import collections.abc
 import json
 from os.path import exists
 import os
 import argparse
+import glob
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from ase.formula import Formula
+from CANELa_NP.Profiling import profiled, enable as enable_profiling
+from CANELa_NP.DFT_Energies import find_base, composition_key, split_name, load_energy_store
+from CANELa_NP.Setup_NPs_for_DFT import cluster_shapes
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 
 # Constants 
 """Please add your own Bulk CE values here for whatever metals you are using"""
 ce_bulk_pbe_d3 = {'Ag': 0.0, 'Al': 0.0, 'Au': 0.0, 'Cu': 0.0, 'Fe': 0.0, 'Ni': 0.0, 'Pd': 0.0, 'Pt': 0.0, 'Rh': 0.0, 'Ru': 0.0, 'Ti': 0.0, 'Zn': 0.0}
 ce_bulk_pbe_d3 = {'Au':-3.64,'Pd':-4.20,'Pt':-6.20,"Ag":-2.96,"Cu":-3.95,"Ni":-5.11,"Ir":-7.95}
-Ha_to_eV = 27.2114
 
 # HELPER FUNCTIONS
 def recursive_update(d: dict, u: dict) -> dict:
@@ -48,18 +67,92 @@ def custom_calc_ce(atoms,gammas,ce_bulk):
     bcm_custom = BCM_Mod(atoms,gammas=gammas,ce_bulk=ce_bulk)
     return bcm_custom.calc_ce()
 
-def calc_gammas(atoms,CEs):
-    gamma_a = Symbol('gamma_a')
-    gamma_b = Symbol('gamma_b')
-    A,B = np.unique(atoms[0].symbols)
-    gammas = {A:{A:1,B:gamma_a},B:{B:1,A:gamma_b}}
+@profiled
+def get_gamma_system(atoms,CEs,ce_bulk=ce_bulk_pbe_d3,sum_constraint=True):
+    """Build the linear system for the gamma values.  The BCM CE is linear in the gammas:
+    CE = sum_ab gamma_ab*CE_bulk_a*bond_coeffs[a,b]/(2N), with gamma_aa = 1.
+
+    Args:
+        atoms (list): list of ase.Atoms objects (any number of structures and element pairs)
+        CEs (list): cohesive energies (eV/atom) of the structures
+        ce_bulk (dict, optional): bulk cohesive energies. Defaults to ce_bulk_pbe_d3.
+        sum_constraint (bool, optional): Whether to enforce gamma_ab + gamma_ba = 2 for each pair. Defaults to True.
+
+    Returns:
+        coeffs (np.ndarray): (structures, unknowns) coefficient matrix
+        rhs (np.ndarray): (structures,) right hand side
+        unknowns (list): (A, B) pair of each unknown gamma_AB
+    """
+    bcms = [BCM_Mod(a,ce_bulk=ce_bulk) for a in atoms]
+    pairs = sorted({(str(A),str(B)) for bcm in bcms for A in bcm.atom_types for B in bcm.atom_types if A != B})
+    if sum_constraint: # gamma_BA = 2 - gamma_AB so only one unknown per pair
+        unknowns = [(A,B) for A,B in pairs if A < B]
+    else:
+        unknowns = pairs
+    column = {pair:i for i,pair in enumerate(unknowns)}
+
+    coeffs = np.zeros((len(atoms),len(unknowns)))
+    rhs = np.array(CEs,dtype=float)
+    for s,bcm in enumerate(bcms):
+        scale = 1/(2*len(bcm.atoms))
+        types = list(bcm.atom_types)
+        for a,A in enumerate(types):
+            for b,B in enumerate(types):
+                term = ce_bulk[A]*bcm.bond_coeffs[a,b]*scale # CE contribution per unit gamma_AB
+                if A == B:
+                    rhs[s] -= term
+                elif (A,B) in column:
+                    coeffs[s,column[(A,B)]] += term
+                else: # gamma_AB = 2 - gamma_BA
+                    rhs[s] -= 2*term
+                    coeffs[s,column[(B,A)]] -= term
+    return coeffs,rhs,unknowns
+
+@profiled
+def fit_gammas(atoms,CEs,ce_bulk=ce_bulk_pbe_d3,sum_constraint=True,combine=False):
+    """Least-squares fit of the gamma values to the DFT cohesive energies of any number of structures
+
+    Args:
+        atoms (list): list of ase.Atoms objects
+        CEs (list): cohesive energies (eV/atom) of the structures
+        ce_bulk (dict, optional): bulk cohesive energies. Defaults to ce_bulk_pbe_d3.
+        sum_constraint (bool, optional): Whether to enforce gamma_ab + gamma_ba = 2 for each pair. Defaults to True.
+        combine (bool, optional): Whether to fit the sum of the CEs instead of each CE (the original two structure scheme). Defaults to False.
+
+    Returns:
+        gammas (dict): fitted gamma values {A: {A: 1, B: gamma_AB}, ...}
+        residuals (np.ndarray): BCM CE - DFT CE (eV/atom) for each structure
+    """
+    coeffs,rhs,unknowns = get_gamma_system(atoms,CEs,ce_bulk=ce_bulk,sum_constraint=sum_constraint)
+    if combine:
+        sol = np.linalg.lstsq(coeffs.sum(axis=0,keepdims=True),[rhs.sum()],rcond=None)[0]
+    else:
+        sol = np.linalg.lstsq(coeffs,rhs,rcond=None)[0]
+    residuals = coeffs @ sol - rhs
+
+    gammas = {}
+    for (A,B),gamma in zip(unknowns,sol):
+        recursive_update(gammas,{A:{A:1,B:float(gamma)},B:{B:1}})
+        if sum_constraint:
+            gammas[B][A] = float(2 - gamma)
+    return gammas,residuals
+
+def calc_gammas(atoms,CEs,combine=False):
+    """Least-squares fit of the gamma values of one element pair to the CEs of every structure
+
+    Args:
+        atoms (list): list of ase.Atoms objects
+        CEs (list): cohesive energies (eV/atom) of the structures
+        combine (bool, optional): Whether to fit the sum of the CEs (one equation, only to reproduce the gammas of the original
+        sympy scheme) instead of each CE. Defaults to False.
 
-    sol = solve([custom_calc_ce(atoms[0],gammas,ce_bulk_pbe_d3) + custom_calc_ce(atoms[1],gammas,ce_bulk_pbe_d3) - sum(CEs),
-                gamma_a+gamma_b - 2])
-    # compare the custom calc ce to the ce values
-    new_gammas = {A:{A:1,B:float(sol[gamma_a])},B:{B:1,A:float(sol[gamma_b])}}
+    Returns:
+        new_gammas (dict): fitted gamma values
+    """
+    new_gammas,residuals = fit_gammas(atoms,CEs,combine=combine)
     print("CEs: ",CEs)
-    print("CEs from BCM: ",custom_calc_ce(atoms[0],new_gammas,ce_bulk_pbe_d3),custom_calc_ce(atoms[1],new_gammas,ce_bulk_pbe_d3))
+    print("CEs from BCM: ",*[custom_calc_ce(a,new_gammas,ce_bulk_pbe_d3) for a in atoms])
+    print("Residuals (eV/atom): ",residuals)
 
     for i in range(len(CEs)):
         comp = atoms[i].get_chemical_formula()
@@ -67,85 +160,221 @@ def calc_gammas(atoms,CEs):
 
     return new_gammas
 
+# DATA HELPERS
+gamma_folder_name = os.path.join(os.path.dirname(__file__), "Data") # Path to the folder containing all the data
+gamma_values_path = os.path.join(gamma_folder_name, "np_gammas.json") # Path to the file where the gamma values will be stored
+atom_energies_path = os.path.join(gamma_folder_name, "single_atom_energies.xlsx") # This should contain the single point energies of all the atoms in the system
+NP_energies_path = os.path.join(gamma_folder_name, "NP_energies.csv") # This should contain the energies of all the NP's you want to calculate the gamma values for
+
+@profiled
+def load_energy_tables(atom_energies=atom_energies_path,NP_energies=NP_energies_path):
+    """Read the single atom and NP energy tables (parsed once and cached, see DFT_Energies.load_energy_store)
+
+    Args:
+        atom_energies (str, optional): path to the single atom energies (Ha). Defaults to Data/single_atom_energies.xlsx.
+        NP_energies (str, optional): path to the NP energies (eV). Defaults to Data/NP_energies.csv.
+
+    Returns:
+        d_energies (dict): {element: single atom energy (eV)}
+        np_energies (dict): {(composition_key, tag): NP energy (eV)}
+    """
+    return load_energy_store(atom_energies,NP_energies).to_tables()
+
+def get_dft_ce(atoms,d_energies,np_energies,tag=''):
+    """Cohesive energy (eV/atom) of a structure from the DFT (PBE+D3) energies
+
+    Args:
+        atoms (ase.Atoms): the structure
+        d_energies (dict): single atom energies from load_energy_tables
+        np_energies (dict): NP energies from load_energy_tables
+        tag (str, optional): shape and number of shells of the structure (see DFT_Energies.split_name). Defaults to '' (untagged).
+
+    Returns:
+        ce (float or None): cohesive energy, None if the NP energy is not in the table
+    """
+    counts = Formula(atoms.get_chemical_formula()).count()
+    key = (composition_key(counts),tag)
+    if key not in np_energies:
+        return None
+    return (np_energies[key] - sum(n*d_energies[el] for el,n in counts.items()))/len(atoms)
+
+def discover_pair_folders(data_folder=gamma_folder_name):
+    """Find the folders of NP structures for each element pair (ex: Data/AuAg).  Every shape folder of a pair
+    (ex: PdAu-decahedron, see Setup_NPs_for_DFT.get_folder_name) is used.  Of the other folders of a pair (ex: PtAu and
+    PtAu-final) the untagged one is used, or the first tagged one if there is no untagged folder.
+
+    Returns:
+        folders (dict): {(A, B): [folder paths]} with A < B
+    """
+    folders,others = {},{}
+    for name in sorted(os.listdir(data_folder)):
+        path = os.path.join(data_folder,name)
+        if not os.path.isdir(path) or not glob.glob(os.path.join(path,'*.xyz')):
+            continue
+        base,_,tag = name.partition('-')
+        try:
+            elements = tuple(sorted(Formula(base).count()))
+        except ValueError:
+            continue
+        if len(elements) != 2:
+            continue
+        if tag in cluster_shapes:
+            folders.setdefault(elements,[]).append(path)
+        elif not tag or elements not in others:
+            others[elements] = path # the untagged folder replaces a tagged one
+    for elements,path in others.items():
+        folders.setdefault(elements,[]).insert(0,path)
+    return {elements:folders[elements] for elements in sorted(folders)}
+
+def load_pair_structures(folders,d_energies,np_energies,total_atoms=None):
+    """Read the structures of one pair that have a DFT energy
+
+    Args:
+        folders (str or list): folder(s) with the xyz files
+        d_energies (dict): single atom energies from load_energy_tables
+        np_energies (dict): NP energies from load_energy_tables
+        total_atoms (int, optional): only use structures with this many atoms. Defaults to None (all).
+
+    Returns:
+        structures (list): ase.Atoms objects
+        CEs (list): DFT cohesive energies (eV/atom) of the structures
+    """
+    if isinstance(folders,str):
+        folders = [folders]
+    structures,CEs = [],[]
+    for folder in folders:
+        for xyz in sorted(glob.glob(os.path.join(folder,'*.xyz'))):
+            atoms = read(xyz)
+            if total_atoms is not None and len(atoms) != total_atoms:
+                continue
+            ce = get_dft_ce(atoms,d_energies,np_energies,tag=split_name(xyz)[1])
+            if ce is not None:
+                structures.append(atoms)
+                CEs.append(ce)
+    return structures,CEs
+
+@profiled
+def fit_pair_folder(folder,d_energies,np_energies,total_atoms=None,combine=False):
+    """Fit the gamma values of the structures of one pair
+
+    Args:
+        folder (str or list): folder(s) with the xyz files (ex: every shape folder of the pair)
+        d_energies (dict): single atom energies from load_energy_tables
+        np_energies (dict): NP energies from load_energy_tables
+        total_atoms (int, optional): only use structures with this many atoms. Defaults to None (all).
+        combine (bool, optional): fit the sum of the CEs (the original scheme, see fit_gammas). Defaults to False.
+
+    Returns:
+        gammas (dict): fitted gamma values
+        residuals (np.ndarray): BCM CE - DFT CE (eV/atom) for each structure used
+    """
+    structures,CEs = load_pair_structures(folder,d_energies,np_energies,total_atoms)
+    if not structures:
+        raise ValueError(f"No structures with DFT energies found in {folder}")
+    return fit_gammas(structures,CEs,combine=combine)
+
+@profiled
+def update_gamma_file(new_gammas,path=gamma_values_path):
+    """Merge new gamma values into the gamma json file with a single locked, atomic write
+
+    Args:
+        new_gammas (dict): gamma values to merge
+        path (str, optional): gamma json file. Defaults to Data/np_gammas.json.
+
+    Returns:
+        gamma_dict (dict): the updated gamma values
+    """
+    with open(path + '.lock','w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock,fcntl.LOCK_EX) # other writers wait here
+        gamma_dict = {}
+        if exists(path):
+            with open(path) as f:
+                gamma_dict = json.load(f)
+        gamma_dict = recursive_update(gamma_dict,new_gammas)
+        fd,tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),suffix='.json')
+        try:
+            with os.fdopen(fd,'w') as f:
+                json.dump(gamma_dict,f)
+            os.replace(tmp_path,path) # readers see either the old or the new file
+        except BaseException:
+            os.remove(tmp_path) # a failed write leaves the old file as it was
+            raise
+    return gamma_dict
+
+@profiled
+def fit_all_pairs(data_folder=gamma_folder_name,total_atoms=None,n_jobs=None,write=True,path=gamma_values_path,combine=False):
+    """Fit the gamma values of every element pair folder in parallel
+
+    Args:
+        data_folder (str, optional): folder with one sub folder of structures per pair. Defaults to Data.
+        total_atoms (int, optional): only use structures with this many atoms. Defaults to None (all).
+        n_jobs (int, optional): number of worker processes. Defaults to None (all cores).
+        write (bool, optional): Whether to merge the results into the gamma json file. Defaults to True.
+        path (str, optional): gamma json file. Defaults to Data/np_gammas.json.
+        combine (bool, optional): fit the sum of the CEs of each pair (the original scheme, see fit_gammas). Defaults to False.
+
+    Returns:
+        results (dict): {(A, B): (gammas, residuals)} for every pair that could be fit
+    """
+    d_energies,np_energies = load_energy_tables() # read once and shared with all workers
+    folders = discover_pair_folders(data_folder)
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pair:pool.submit(fit_pair_folder,pair_folders,d_energies,np_energies,total_atoms,combine) for pair,pair_folders in folders.items()}
+        for pair,future in futures.items():
+            try:
+                results[pair] = future.result()
+            except ValueError as e:
+                print(f"Skipping {'-'.join(pair)}: {e}")
+    if write and results:
+        merged = {}
+        for gammas,residuals in results.values():
+            recursive_update(merged,gammas)
+        update_gamma_file(merged,path=path)
+    return results
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Calculate Gamma Values for a given set of CEs')
     # Parse the command line arguments
-    parser.add_argument('Atom_Type_1', type=str, help='The first atom type')
-    parser.add_argument('Atom_Type_2', type=str, help='The second atom type')
+    parser.add_argument('Atom_Type_1', type=str, nargs='?', help='The first atom type')
+    parser.add_argument('Atom_Type_2', type=str, nargs='?', help='The second atom type')
     parser.add_argument('-n', '--total_atoms', type=int, default=147, help='The total number of atoms = 147')
+    parser.add_argument('--all', action='store_true', help='Fit every element pair folder in Data in parallel')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes for --all (default: all cores)')
+    parser.add_argument('--combine', action='store_true', help='Fit the sum of the CEs of each pair (reproduces the shipped np_gammas.json)')
+    parser.add_argument('--profile', action='store_true', help='Print the time spent in each stage (see CANELa_NP.Profiling)')
     
     # Collect the arguments
     args = parser.parse_args()
-    Atom_Type_1 = args.Atom_Type_1
-    Atom_Type_2 = args.Atom_Type_2
     number_of_atoms = args.total_atoms
 
-    Atoms_folder = Atom_Type_2 + Atom_Type_1
-    
-    atoms_1_comp = Atom_Type_1 + str(math.floor(number_of_atoms/2)) + Atom_Type_2 + str(math.ceil(number_of_atoms/2))
-    atoms_1_name = atoms_1_comp  + '.xyz'
-    atoms_2_comp = Atom_Type_1 + str(math.ceil(number_of_atoms/2)) + Atom_Type_2 + str(math.floor(number_of_atoms/2)) # + '.xyz'
-    atoms_2_name = atoms_2_comp + '.xyz'
-
-    # Find paths to all the files
-    gamma_folder_name = os.path.join(os.path.dirname(__file__), "Data") # Path to the folder containing all the data
-    gamma_values_path = os.path.join(gamma_folder_name, "np_gammas.json") # Path to the file where the gamma values will be stored
-    atom_energies = os.path.join(gamma_folder_name, "single_atom_energies.xlsx") # This should contain the single point energies of all the atoms in the system
-    NP_energies = os.path.join(gamma_folder_name, "NP_energies.csv") # This should contain the energies of all the NP's you want to calculate the gamma values for
-    NP1 = os.path.join(gamma_folder_name, Atoms_folder,atoms_1_name) # This should be the path to the A_{(n-1)/2}B_{(n+1)/2} NP file
-    NP2 = os.path.join(gamma_folder_name, Atoms_folder,atoms_2_name) # This should be the path to the A_{(n+1)/2}B_{(n-1)/2} NP file
-    
-    # Reading the NPs
-    atoms1,atoms2 = read(NP1),read(NP2)
-    # Reading the single atom energies
-    df_single_atom = pd.read_excel(atom_energies)
-    # Reading the NP energies
-    df = pd.read_csv(NP_energies)
-
-    def find_base(x):
-        """find the base filename from the path
-
-        Args:
-            x (str): path to the file
-
-        Returns:
-            sol (str): Base filename without the RESTART_ generated by cp2k_helper
-        """
-        sol = os.path.basename(x)
-        if 'RESTART' in sol:
-            sol = sol.replace('RESTART_',"")
-        return sol
-
-    # Cleaning the data to get the NP names
-    df['Folder_Name'] = df['Folder_Name'].apply(find_base) # Get the base folder names
-
-    # Getting the single atom energies
-    Pd = float(df_single_atom[df_single_atom['NP']=='Pd']['Energy (Ha)'])*Ha_to_eV
-    Pt = float(df_single_atom[df_single_atom['NP']=='Pt']['Energy (Ha)'])*Ha_to_eV
-    Au = float(df_single_atom[df_single_atom['NP']=='Au']['Energy (Ha)'])*Ha_to_eV
-    Ag = float(df_single_atom[df_single_atom['NP']=='Ag']['Energy (Ha)'])*Ha_to_eV
-    Cu = float(df_single_atom[df_single_atom['NP']=='Cu']['Energy (Ha)'])*Ha_to_eV
-    d_energies = {'Pd':Pd,'Pt':Pt,'Au':Au,'Ag':Ag,'Cu':Cu}
-
-    # Calculating the NP cohesive energies from DFT (PBE+D3) Calculations
-    try: 
-        CE_AB1 = ((float(df[df['Folder_Name']==atoms_1_comp]['Energy (eV)']) - (73*d_energies[Atom_Type_1]+74*d_energies[Atom_Type_2]))/147)
-        CE_AB2 = ((float(df[df['Folder_Name']==atoms_2_comp]['Energy (eV)']) - (74*d_energies[Atom_Type_1]+73*d_energies[Atom_Type_2]))/147)
-    except: # Naming order issue
-        atoms_1_comp = Atom_Type_2 + str(math.floor(number_of_atoms/2)) + Atom_Type_1 + str(math.ceil(number_of_atoms/2))
-        atoms_2_comp = Atom_Type_2 + str(math.ceil(number_of_atoms/2)) + Atom_Type_1 + str(math.floor(number_of_atoms/2)) 
-        CE_AB1 = ((float(df[df['Folder_Name']==atoms_1_comp]['Energy (eV)']) - (73*d_energies[Atom_Type_2]+74*d_energies[Atom_Type_1]))/147)
-        CE_AB2 = ((float(df[df['Folder_Name']==atoms_2_comp]['Energy (eV)']) - (74*d_energies[Atom_Type_2]+73*d_energies[Atom_Type_1]))/147)
-
-    # Solving for the gamma values
-    solution = calc_gammas([atoms1,atoms2],[CE_AB1,CE_AB2])
-
-    print(solution)
-    #  Update gamma dict 
-    with open(gamma_values_path) as f:
-        gamma_dict = json.load(f)
-        updated_gammas = recursive_update(gamma_dict,solution)
-
-    # Write the updated gamma dict to the file
-    with open(gamma_values_path, 'w') as f:
-        json.dump(updated_gammas, f)
+    prof = enable_profiling() if args.profile else None
+    if args.all:
+        results = fit_all_pairs(total_atoms=number_of_atoms,n_jobs=args.jobs,combine=args.combine)
+        for pair,(gammas,residuals) in results.items():
+            print(f"{'-'.join(pair)}: {gammas} residuals (eV/atom): {residuals}")
+    else:
+        if args.Atom_Type_1 is None or args.Atom_Type_2 is None:
+            parser.error('Atom_Type_1 and Atom_Type_2 are required unless --all is used')
+        Atom_Type_1 = args.Atom_Type_1
+        Atom_Type_2 = args.Atom_Type_2
+
+        # The folders are named Atom_Type_2+Atom_Type_1 (or the other way around), plus one folder per extra shape
+        Atoms_folders = discover_pair_folders(gamma_folder_name).get(tuple(sorted([Atom_Type_1,Atom_Type_2])),[])
+
+        # Reading the single atom and NP energies
+        d_energies,np_energies = load_energy_tables()
+
+        # Reading the NPs and calculating their cohesive energies from DFT (PBE+D3) Calculations
+        structures,CEs = load_pair_structures(Atoms_folders,d_energies,np_energies,number_of_atoms)
+
+        # Solving for the gamma values
+        solution = calc_gammas(structures,CEs,combine=args.combine)
+
+        print(solution)
+        #  Update gamma dict and write it to the file
+        update_gamma_file(solution)
+
+    if prof is not None:
+        print(prof.report())
@@ -0,0 +1,120 @@
+"""Island model for the GA: independent GA populations run in a process pool and periodically exchange their best orderings"""
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+import numpy as np
+
+from ce_expansion.ga.ga import GA
+from ce_expansion.ga.ga import Nanoparticle as NP_GA
+
+from CANELa_NP.Nanotools import make_bcm
+
+# Set in each worker process by _init_worker: the BCModel is only built once per worker and the GA of every island the
+# worker owns is kept between epochs ({island: GA})
+_worker = {}
+
+def _init_worker(atoms,x,method,composition,describe,generate_ga,bond_list=None,metal_types=None,spike=None):
+    _worker['bcm'] = make_bcm(atoms,x=x,CN_Method=method,bond_list=bond_list,metal_types=metal_types)
+    _worker['composition'] = composition
+    _worker['spike'] = spike
+    _worker['describe'] = describe
+    _worker['generate_ga'] = generate_ga
+    _worker['islands'] = {}
+
+def _run_epoch(island,seed,migrants,gens,n_migrants):
+    """Run one island for a number of generations (the island's GA is built on its first epoch and kept by the worker)
+
+    Args:
+        island (int): island number
+        seed (int): seed for this island and epoch
+        migrants (list): orderings from the previous island that replace the worst individuals
+        gens (int): number of generations to run
+        n_migrants (int): number of orderings sent to the next island
+
+    Returns:
+        best (list): the n_migrants best orderings of the island, best first
+        best_ce (float): cohesive energy of the best ordering
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    bcm,composition = _worker['bcm'],_worker['composition']
+    ga = _worker['islands'].get(island)
+    if ga is None:
+        ga = _worker['islands'][island] = _worker['generate_ga'](bcm,composition,_worker['describe'])
+        if _worker['spike'] is not None: # start from the current ordering
+            ga.pop[0] = NP_GA(bcm,composition,np.array(_worker['spike']))
+    if migrants:
+        ga.sort_pop()
+        ga.pop[-len(migrants):] = [NP_GA(bcm,composition,ordering) for ordering in migrants]
+    ga.sort_pop()
+    ga.run(max_gens=gens,max_nochange=gens + 1) # only stop on max_gens
+    return [np.array(p.arr) for p in ga.pop[:n_migrants]],float(ga.pop[0].ce)
+
+def _generate_ga(bcm,composition,describe):
+    return GA(bcm,composition,describe)
+
+def run_islands(atoms,composition,x=1.20,method='frac',describe="none",seeds=(0,1,2,3),max_gens=-1,max_nochange=2000,
+                migrate_every=50,n_migrants=1,n_jobs=None,generate_ga=_generate_ga,bond_list=None,metal_types=None,spike=None):
+    """Run an island model GA.  Every island is an independent GA population with its own seed.  Every migrate_every generations
+    each island sends its n_migrants best orderings to the next island (ring topology).  The GA of every island stays in the
+    worker that runs it, only the migrants and the best CEs are sent between processes, and the result only depends on the
+    seeds (not on n_jobs).
+
+    Args:
+        atoms (ase.Atoms): atoms object (the geometry to optimize)
+        composition (list): number of atoms of each (sorted) metal type
+        x (float, optional): scaling factor for the cutoffs. Defaults to 1.20.
+        method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
+        describe (str, optional): description for the GA. Defaults to "none".
+        seeds (iterable, optional): one seed per island. Defaults to (0, 1, 2, 3).
+        max_gens (int, optional): max number of generations per island (-1 for no limit). Defaults to -1.
+        max_nochange (int, optional): stop once the global best has not improved for this many generations. Defaults to 2000.
+        migrate_every (int, optional): number of generations between migrations. Defaults to 50.
+        n_migrants (int, optional): number of orderings sent to the next island. Defaults to 1.
+        n_jobs (int, optional): number of worker processes. Defaults to None (one per island, up to the number of cores).
+        generate_ga (callable, optional): builds a GA from (bcm, composition, describe). Defaults to ce_expansion's GA.
+        bond_list (np.ndarray, optional): bonds of the geometry (ex: Nanoparticle.bcm.bond_list), so the islands score the same
+        bonds as the caller. Defaults to None (built from atoms).
+        metal_types (list, optional): sorted metal types of the composition (may include metals that are not in atoms). Defaults to None (the metals in atoms).
+        spike (np.ndarray, optional): ordering (indices into metal_types) put in the first population of every island. Defaults to None.
+
+    Returns:
+        best_ordering (np.ndarray): best ordering found on any island
+        best_ce (float): cohesive energy of the best ordering
+        history (list): global best CE after every epoch
+    """
+    seeds = list(seeds)
+    n_islands = len(seeds)
+    n_workers = min(n_jobs or os.cpu_count() or 1,n_islands)
+    migrants = [[] for _ in range(n_islands)]
+    best_ordering,best_ce = None,np.inf
+    history = []
+    gens,nochange,epoch = 0,0,0
+    with ExitStack() as stack:
+        # one single process pool per worker so that island k always runs on worker k % n_workers, next to its GA
+        workers = [stack.enter_context(ProcessPoolExecutor(max_workers=1,initializer=_init_worker,
+                                                           initargs=(atoms,x,method,composition,describe,generate_ga,
+                                                                     bond_list,metal_types,spike)))
+                   for _ in range(n_workers)]
+        while nochange < max_nochange and (max_gens < 0 or gens < max_gens):
+            epoch_gens = migrate_every if max_gens < 0 else min(migrate_every,max_gens - gens)
+            # Every island gets its own deterministic seed for every epoch
+            epoch_seeds = [int(np.random.SeedSequence([seed,epoch]).generate_state(1)[0]) for seed in seeds]
+            futures = [workers[k % n_workers].submit(_run_epoch,k,epoch_seeds[k],migrants[k],epoch_gens,n_migrants)
+                       for k in range(n_islands)]
+            results = [future.result() for future in futures]
+
+            migrants = [results[k - 1][0] for k in range(n_islands)] # ring: island k receives from island k-1
+            epoch_best = min(range(n_islands),key=lambda k: results[k][1])
+            if results[epoch_best][1] < best_ce - 1e-12:
+                best_ce = results[epoch_best][1]
+                best_ordering = results[epoch_best][0][0]
+                nochange = 0
+            else:
+                nochange += epoch_gens
+            history.append(best_ce)
+            gens += epoch_gens
+            epoch += 1
+    return best_ordering,best_ce,history
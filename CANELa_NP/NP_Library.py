@@ -0,0 +1,213 @@
+"""Compact, memory mappable library of nanoparticles (GA results, DFT candidate sets, ...)
+
+A library is a folder of .npy files: every distinct geometry is stored once and every structure only stores its
+geometry id, its ordering (uint8 indices into the element list of the library) and its CE.  All arrays are opened with
+np.load(mmap_mode='r') so opening a library reads nothing but the small json header, whatever the number of structures.
+
+Layout)
+    header.json       format version, element list, number of entries and geometries
+    positions.npy     (atoms of all geometries, 3) float64, geometry g is positions[geom_offsets[g]:geom_offsets[g+1]]
+    geom_offsets.npy  (geometries + 1,) int64
+    entries.npy       structured array with the geometry id, the start of the ordering and the CE of every entry
+    orderings.npy     (atoms of all entries,) uint8
+    compositions.npy  (entries, elements) number of atoms of each element
+    descriptions.json description of every entry (only read when it is used)
+
+Only the positions and chemical symbols are kept (no cell, charges or other per atom arrays).
+
+Example)
+    python -m CANELa_NP.NP_Library AuAg.npl CANELa_NP/Data/AuAg/
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from ase import Atoms
+from ase.io import read
+
+library_version = 1
+entry_dtype = np.dtype([('geometry',np.int32),('start',np.int64),('ce',np.float64)])
+
+class NPLibraryWriter:
+    def __init__(self,path,elements=None,decimals=6):
+        """Collect structures and write them as a library when closed (use it as a context manager)
+
+        Args:
+            path (str): folder of the library (created, existing library files are overwritten)
+            elements (list, optional): element list of the library (orderings index into it). Defaults to the elements of the structures added.
+            decimals (int, optional): positions are rounded to this many decimals (Ang) to find identical geometries. Defaults to 6.
+        """
+        self.path = path
+        self.elements = list(elements) if elements is not None else []
+        self.decimals = decimals
+        self.geometry_ids = {}
+        self.positions = []
+        self.entries = []
+        self.orderings = []
+        self.descriptions = []
+        self.n_ordered = 0 # atoms in all the orderings so far
+
+    def add(self,atoms,ce=np.nan,description=''):
+        """Add a structure
+
+        Args:
+            atoms (ase.Atoms): the structure
+            ce (float, optional): cohesive energy (eV/atom). Defaults to nan.
+            description (str, optional): description of the structure. Defaults to ''.
+
+        Returns:
+            index (int): entry number of the structure
+        """
+        positions = np.round(atoms.get_positions(),self.decimals) + 0.0 # + 0.0 turns -0.0 into 0.0
+        key = hashlib.sha1(positions.tobytes()).hexdigest()
+        if key not in self.geometry_ids:
+            self.geometry_ids[key] = len(self.positions)
+            self.positions.append(positions)
+        atom_types,order = np.unique(np.asarray(atoms.symbols),return_inverse=True)
+        for el in atom_types:
+            if el not in self.elements:
+                self.elements.append(str(el))
+        if len(self.elements) > 256:
+            raise ValueError("A library can hold at most 256 elements (orderings are stored as uint8)")
+        ordering = np.array([self.elements.index(el) for el in atom_types],dtype=np.uint8)[order.reshape(-1)]
+        self.entries.append((self.geometry_ids[key],self.n_ordered,ce))
+        self.n_ordered += len(ordering)
+        self.orderings.append(ordering)
+        self.descriptions.append(description)
+        return len(self.entries) - 1
+
+    def close(self):
+        """Write the library files"""
+        os.makedirs(self.path,exist_ok=True)
+        geom_offsets = np.zeros(len(self.positions) + 1,dtype=np.int64)
+        geom_offsets[1:] = np.cumsum([len(p) for p in self.positions])
+        orderings = np.concatenate(self.orderings) if self.orderings else np.zeros(0,dtype=np.uint8)
+        compositions = np.zeros((len(self.orderings),len(self.elements)),dtype=np.int32)
+        for i,ordering in enumerate(self.orderings):
+            compositions[i] = np.bincount(ordering,minlength=len(self.elements))
+        arrays = {'positions':np.concatenate(self.positions) if self.positions else np.zeros((0,3)),
+                  'geom_offsets':geom_offsets,
+                  'entries':np.array(self.entries,dtype=entry_dtype),
+                  'orderings':orderings,
+                  'compositions':compositions}
+        for name,array in arrays.items():
+            np.save(os.path.join(self.path,name + '.npy'),array)
+        with open(os.path.join(self.path,'descriptions.json'),'w') as f:
+            json.dump(self.descriptions,f)
+        # the header is written last, so a library is only valid once every array is in place
+        with open(os.path.join(self.path,'header.json'),'w') as f:
+            json.dump({'format':'CANELa_NP library','version':library_version,'elements':self.elements,
+                       'n_entries':len(self.entries),'n_geometries':len(self.positions)},f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,*args):
+        if exc_type is None:
+            self.close()
+
+def write_library(path,structures,ces=None,descriptions=None,elements=None):
+    """Write a library from many structures
+
+    Args:
+        path (str): folder of the library
+        structures (list): atoms objects and/or paths to structure files
+        ces (list, optional): cohesive energy of every structure. Defaults to None (nan).
+        descriptions (list, optional): description of every structure. Defaults to None (the file name, or '').
+        elements (list, optional): element list of the library. Defaults to the elements of the structures.
+
+    Returns:
+        n_entries (int): number of structures written
+    """
+    with NPLibraryWriter(path,elements=elements) as writer:
+        for i,structure in enumerate(structures):
+            atoms = read(structure) if isinstance(structure,str) else structure
+            description = descriptions[i] if descriptions is not None else (os.path.basename(structure) if isinstance(structure,str) else '')
+            writer.add(atoms,ce=np.nan if ces is None else ces[i],description=description)
+    return len(writer.entries)
+
+class NPLibrary:
+    def __init__(self,path):
+        """Open a library (every array is memory mapped, nothing is read until it is used)
+
+        Args:
+            path (str): folder of the library
+        """
+        self.path = path
+        with open(os.path.join(path,'header.json')) as f:
+            self.header = json.load(f)
+        if self.header.get('format') != 'CANELa_NP library' or self.header['version'] > library_version:
+            raise ValueError(f"{path} is not a CANELa_NP library this version can read")
+        self.elements = self.header['elements']
+        load = lambda name: np.load(os.path.join(path,name + '.npy'),mmap_mode='r')
+        self.positions = load('positions')
+        self.geom_offsets = load('geom_offsets')
+        self.entries = load('entries')
+        self.orderings = load('orderings')
+        self.compositions = load('compositions')
+        self._descriptions = None
+
+    def __len__(self):
+        return self.header['n_entries']
+
+    @property
+    def ce(self):
+        """(entries,) CE of every entry (memory mapped)"""
+        return self.entries['ce']
+
+    @property
+    def geometry(self):
+        """(entries,) geometry id of every entry (memory mapped)"""
+        return self.entries['geometry']
+
+    @property
+    def descriptions(self):
+        if self._descriptions is None:
+            with open(os.path.join(self.path,'descriptions.json')) as f:
+                self._descriptions = json.load(f)
+        return self._descriptions
+
+    def get_positions(self,i):
+        """(N, 3) positions of entry i (read only view of the memory map)"""
+        g = self.entries['geometry'][i]
+        return self.positions[self.geom_offsets[g]:self.geom_offsets[g + 1]]
+
+    def get_ordering(self,i):
+        """(N,) uint8 ordering of entry i (read only view of the memory map, values index into self.elements)"""
+        g = self.entries['geometry'][i]
+        start = self.entries['start'][i]
+        return self.orderings[start:start + self.geom_offsets[g + 1] - self.geom_offsets[g]]
+
+    def get_symbols(self,i):
+        return np.array(self.elements)[self.get_ordering(i)]
+
+    def get_composition(self,i):
+        """{element: number of atoms} of entry i"""
+        return {el:int(n) for el,n in zip(self.elements,self.compositions[i]) if n}
+
+    def get_atoms(self,i):
+        """Atoms object of entry i"""
+        return Atoms(symbols=self.get_symbols(i),positions=self.get_positions(i))
+
+    def get_nanoparticle(self,i,**kwargs):
+        """Nanoparticle of entry i (kwargs are passed to Nanoparticle)"""
+        from CANELa_NP.Nanotools import Nanoparticle
+        return Nanoparticle.from_library(self,i,**kwargs)
+
+    def __getitem__(self,i):
+        return self.get_atoms(i)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack structure files into a memory mappable NP library')
+    parser.add_argument('library', type=str, help='Folder of the library to write')
+    parser.add_argument('inputs', type=str, nargs='+', help='Structure files or directories of structures')
+    parser.add_argument('--pattern', type=str, default='*.xyz', help="Files to read from directories (default='*.xyz')")
+    args = parser.parse_args()
+
+    from CANELa_NP.Trajectory_Analysis import find_structure_files
+    files = find_structure_files(args.inputs,pattern=args.pattern)
+    n_entries = write_library(args.library,files)
+    library = NPLibrary(args.library)
+    print(f"Wrote {n_entries} structures ({library.header['n_geometries']} geometries) to {args.library}")
@@ -0,0 +1,162 @@
+"""Compact records of Nanoparticle results for large screening campaigns
+
+A NanoparticleResult keeps only the ordering (uint8), the CE, the shell compositions and the diameter of a nanoparticle
+and points to a shared, read only Geometry instead of holding its own atoms, cuts, BCModels and GA.  Records of the same
+geometry share one Geometry object, lists of records are saved to a single .npz file, and any record can be turned back
+into a full Nanoparticle when it is needed.
+
+Example)
+    results = [NP.to_result() for NP in screened]
+    save_results('screen.npz', results)
+    best = min(load_results('screen.npz'), key=lambda r: r.ce).to_nanoparticle()
+"""
+import hashlib
+import weakref
+
+import numpy as np
+from ase import Atoms
+
+_geometries = weakref.WeakValueDictionary()
+
+class Geometry:
+    """Read only atom positions shared by every result of the same geometry (use get_geometry to create them)"""
+    __slots__ = ('positions','key','__weakref__')
+
+    def __init__(self,positions,key):
+        self.positions = positions
+        self.key = key
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __reduce__(self): # unpickled geometries are shared too
+        return (get_geometry,(np.asarray(self.positions),))
+
+def get_geometry(positions,decimals=6):
+    """Shared Geometry of a set of positions (the same object is returned for identical positions)
+
+    Args:
+        positions (np.ndarray): (N, 3) atom positions
+        decimals (int, optional): positions are rounded to this many decimals (Ang) to compare geometries. Defaults to 6.
+
+    Returns:
+        geometry (Geometry): the shared geometry
+    """
+    positions = np.round(np.asarray(positions,dtype=np.float64),decimals) + 0.0 # + 0.0 turns -0.0 into 0.0
+    key = hashlib.sha1(positions.tobytes()).hexdigest()
+    geometry = _geometries.get(key)
+    if geometry is None:
+        positions.flags.writeable = False
+        geometry = Geometry(positions,key)
+        _geometries[key] = geometry
+    return geometry
+
+class NanoparticleResult:
+    __slots__ = ('geometry','metal_types','ordering','ce','shell_comps','diameter','describe')
+
+    def __init__(self,geometry,metal_types,ordering,ce,shell_comps,diameter,describe='none'):
+        """Compact record of a nanoparticle
+
+        Args:
+            geometry (Geometry): shared positions (see get_geometry)
+            metal_types (tuple): sorted atom types (ordering values index into it)
+            ordering (np.ndarray): (N,) uint8 type index of every atom
+            ce (float): cohesive energy (eV/atom)
+            shell_comps (np.ndarray): (shells, types) float32 composition of each shell (1=Core first)
+            diameter (float): diameter (Ang)
+            describe (str, optional): description of the nanoparticle. Defaults to 'none'.
+        """
+        self.geometry = geometry
+        self.metal_types = tuple(metal_types)
+        self.ordering = np.asarray(ordering,dtype=np.uint8)
+        self.ce = float(ce)
+        self.shell_comps = np.asarray(shell_comps,dtype=np.float32)
+        self.diameter = float(diameter)
+        self.describe = describe
+
+    @classmethod
+    def from_nanoparticle(cls,NP):
+        """Record of a Nanoparticle (computes its CE, shell compositions and diameter if they are not cached yet)"""
+        from CANELa_NP.Nanotools import get_ordering_of
+        shells,comps,totals = NP.core_shell_info()
+        shell_comps = np.array([comps[metal] for metal in NP.unique_metals],dtype=np.float32).T.reshape(len(shells),len(NP.unique_metals))
+        return cls(get_geometry(NP.atoms.get_positions()),NP.unique_metals,get_ordering_of(NP.atoms,NP.unique_metals),
+                   NP.calc_ce(),shell_comps,NP.get_diam(),describe=NP.describe)
+
+    def __len__(self):
+        return len(self.ordering)
+
+    def __repr__(self):
+        return f"NanoparticleResult({self.formula}, ce={self.ce:.5f}, diameter={self.diameter:.2f})"
+
+    @property
+    def composition(self):
+        """{metal: number of atoms}"""
+        return {metal:int(n) for metal,n in zip(self.metal_types,np.bincount(self.ordering,minlength=len(self.metal_types)))}
+
+    @property
+    def formula(self):
+        return ''.join(f'{metal}{n}' for metal,n in self.composition.items())
+
+    @property
+    def nbytes(self):
+        """Memory held by this record alone (the shared geometry is not counted)"""
+        return self.ordering.nbytes + self.shell_comps.nbytes
+
+    def get_atoms(self):
+        """Atoms object of the record"""
+        return Atoms(symbols=np.array(self.metal_types)[self.ordering],positions=self.geometry.positions)
+
+    def to_nanoparticle(self,**kwargs):
+        """Rebuild the full Nanoparticle (kwargs are passed to Nanoparticle)"""
+        from CANELa_NP.Nanotools import Nanoparticle
+        kwargs.setdefault('describe',self.describe)
+        return Nanoparticle(self.get_atoms(),**kwargs)
+
+def save_results(path,results):
+    """Save records to one .npz file (every geometry is written once)
+
+    Args:
+        path (str): .npz file
+        results (list): NanoparticleResult records
+    """
+    geometry_ids = {}
+    for result in results:
+        geometry_ids.setdefault(result.geometry.key,(len(geometry_ids),result.geometry))
+    geometries = [geometry for i,geometry in sorted(geometry_ids.values(),key=lambda item: item[0])]
+    offsets = lambda sizes: np.concatenate([[0],np.cumsum(sizes,dtype=np.int64)])
+    np.savez(path,
+             positions=np.concatenate([g.positions for g in geometries]) if geometries else np.zeros((0,3)),
+             geom_offsets=offsets([len(g) for g in geometries]),
+             geometry=np.array([geometry_ids[r.geometry.key][0] for r in results],dtype=np.int32),
+             metal_types=np.array([','.join(r.metal_types) for r in results]),
+             orderings=np.concatenate([r.ordering for r in results]) if results else np.zeros(0,dtype=np.uint8),
+             ce=np.array([r.ce for r in results]),
+             diameter=np.array([r.diameter for r in results]),
+             shell_comps=np.concatenate([r.shell_comps.ravel() for r in results]) if results else np.zeros(0,dtype=np.float32),
+             n_shells=np.array([len(r.shell_comps) for r in results],dtype=np.int32),
+             describe=np.array([r.describe for r in results]))
+
+def load_results(path):
+    """Load the records written by save_results
+
+    Returns:
+        results (list): NanoparticleResult records (records of the same geometry share one Geometry)
+    """
+    with np.load(path) as npz:
+        data = {name:npz[name] for name in npz.files} # every access of an NpzFile reads the array again
+    geom_offsets = data['geom_offsets']
+    geometries = [get_geometry(data['positions'][start:end]) for start,end in zip(geom_offsets[:-1],geom_offsets[1:])]
+    results = []
+    atom_start = comp_start = 0
+    for g,metals,ce,diameter,n_shells,describe in zip(data['geometry'],data['metal_types'],data['ce'],data['diameter'],
+                                                       data['n_shells'],data['describe']):
+        metal_types = str(metals).split(',')
+        n_atoms = len(geometries[g])
+        n_comps = n_shells*len(metal_types)
+        results.append(NanoparticleResult(geometries[g],metal_types,data['orderings'][atom_start:atom_start + n_atoms],ce,
+                                          data['shell_comps'][comp_start:comp_start + n_comps].reshape(n_shells,len(metal_types)),
+                                          diameter,describe=str(describe)))
+        atom_start += n_atoms
+        comp_start += n_comps
+    return results
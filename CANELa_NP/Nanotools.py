@@ -1,31 +1,36 @@
 from ce_expansion.atomgraph.bcm import BCModel
 from ce_expansion.atomgraph.adjacency import build_bonds_arr
-from ce_expansion.ga.ga import GA
-from ce_expansion.ga.ga import Nanoparticle as NP_GA
 
-import ase.cluster as ac
-from ase.io import read
-from ase.visualize import view
-
-import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
 
 import sys
 import os
-from collections import defaultdict, Counter
+from collections import defaultdict
 import collections.abc 
 import argparse
 import json
-from IPython.display import HTML,display, Image
-import molgif
+from functools import lru_cache
+# The GA (ce_expansion.ga), ase.io and the visualization packages (matplotlib, molgif, IPython, ase.visualize) are imported
+# where they are used so that CE only workers start fast (see benchmarks/bench_import.py)
+
+from CANELa_NP.Element_Properties import get_radii, get_colors_table
+from CANELa_NP.Topology_Cache import get_cache, shell_map_to_index
+from CANELa_NP.Profiling import profiled, span
 
 
 gamma_folder_name = os.path.join(os.path.dirname(__file__), "Data")
 gamma_values_path = os.path.join(gamma_folder_name, "np_gammas.json")
 
-with open(gamma_values_path) as f:
-    gammas_np = json.load(f)
+@lru_cache(maxsize=None)
+def load_gammas(path=gamma_values_path):
+    """Gamma values of the gamma json file (read on first use and memoized, call load_gammas.cache_clear() after changing the file)"""
+    with open(path) as f:
+        return json.load(f)
+
+def __getattr__(name):
+    if name == 'gammas_np': # the gamma table is only read when it is first needed
+        return load_gammas()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 ce_bulk_pbe_d3 = {'Au':-3.64,'Pd':-4.20,'Pt':-6.20,"Ag":-2.96,"Cu":-3.95,"Ni":-5.11,"Ir":-7.95} # eV/atom PBE-D3 SOURCE: https://aip.scitation.org/doi/suppl/10.1063/1.4948636/suppl_file/supplementary_material.pdf and https://onlinelibrary.wiley.com/doi/full/10.1002/jcc.23037
 
@@ -59,51 +64,131 @@ def get_ordering(atoms):
         atoms (ase.Atoms): atoms object
 
     Returns:
-        ordering (list): list of the ordering of the atoms in the xyz file
+        ordering (np.ndarray): index of each atom's type in the sorted list of unique atom types
+    """
+    atom_types,order = np.unique(np.asarray(atoms.symbols),return_inverse=True)
+    return order.reshape(-1)
+
+def get_cn_factors(cns,cb=12):
+    """CN dependent factor sqrt(CN_i/Cb)/CN_i of each atom in the BCM sum
+
+    Args:
+        cns (list): coordination number of every atom
+        cb (int, optional): bulk coordination number. Defaults to 12 (FCC).
+
+    Returns:
+        cn_factors (np.ndarray): (N,) factor of every atom
     """
+    cns = np.asarray(cns,dtype=float)
+    return np.sqrt(cns/cb)/cns
 
-    atom_types = list(np.unique(atoms.symbols))
-    atom_types.sort()
-    order = []
-    for sym in atoms.symbols:
-        order.append(atom_types.index(sym))
-    return np.array(order)
+def get_bond_coeffs(bond_list,cns,ordering,n_types,cb=12):
+    """Bond class coefficients of one ordering: coeffs[a,b] is the sum of sqrt(CN_i/Cb)/CN_i over the bonds i->j of bond_list
+    with i of type a and j of type b, so that the BCM sum is sum_ab gamma_ab*CE_bulk_a*coeffs[a,b]
 
+    Args:
+        bond_list (np.ndarray): (B, 2) bonded atom pairs
+        cns (list): coordination number of every atom
+        ordering (np.ndarray): (N,) type index of every atom
+        n_types (int): number of atom types
+        cb (int, optional): bulk coordination number. Defaults to 12 (FCC).
+
+    Returns:
+        coeffs (np.ndarray): (T, T) bond class coefficients
+    """
+    bonds = np.asarray(bond_list).reshape(-1,2)
+    ordering = np.asarray(ordering)
+    bond_class = ordering[bonds[:,0]]*n_types + ordering[bonds[:,1]]
+    weights = get_cn_factors(cns,cb)[bonds[:,0]]
+    return np.bincount(bond_class,weights=weights,minlength=n_types**2).reshape(n_types,n_types)
+
+def get_ce_precomps(bcm,metal_types):
+    """Precompute the arrays needed to evaluate the BCM cohesive energy of many orderings at once
+
+    CE = sum_bonds gamma[A][B]*CE_bulk[A]*sqrt(CN_i/12)/CN_i / N for every bond i->j in bcm.bond_list
+
+    Args:
+        bcm (BCModel): BCModel object
+        metal_types (list): sorted atom types (index i of an ordering refers to metal_types[i])
+
+    Returns:
+        precomps (dict): 'params' (flattened gamma*CE_bulk matrix), 'a1', 'a2' (bonded atom columns),
+                         'weights' (CN factor of each bond) and 'n_types'
+    """
+    bonds = np.asarray(bcm.bond_list).reshape(-1,2)
+    cn_factors = get_cn_factors(bcm.cn)
+    params = np.array([[bcm.gammas[A][B]*bcm.ce_bulk[A] for B in metal_types] for A in metal_types],dtype=float)
+    return {'params':params.ravel(),
+            'a1':bonds[:,0],
+            'a2':bonds[:,1],
+            'weights':cn_factors[bonds[:,0]],
+            'n_types':len(metal_types)}
+
+@profiled
+def calc_ce_batch(precomps,orderings,chunk_size=256):
+    """Calculate the cohesive energy of many orderings of the same geometry in one vectorized pass
+
+    Args:
+        precomps (dict): output of get_ce_precomps
+        orderings (np.ndarray): (M, N) integer array of orderings
+        chunk_size (int, optional): number of orderings evaluated at a time (bounds the memory to chunk_size x bonds). Defaults to 256.
+
+    Returns:
+        ces (np.ndarray): (M,) cohesive energies
+    """
+    orderings = np.atleast_2d(np.asarray(orderings))
+    n_atoms = orderings.shape[1]
+    a1,a2,n_types = precomps['a1'],precomps['a2'],precomps['n_types']
+    ces = np.empty(len(orderings))
+    for start in range(0,len(orderings),chunk_size):
+        chunk = orderings[start:start+chunk_size]
+        bond_types = chunk[:,a1]*n_types + chunk[:,a2]
+        ces[start:start+chunk_size] = precomps['params'][bond_types] @ precomps['weights']
+    return ces/n_atoms
+
+@profiled
 def get_cutoffs(atoms,x):
     """Custom Cutoffs from custom Radii
-        Please add your own custom radii here (covalent radii may be a good place to start so I have implemented that as a default)"""
-    radii = {'Au':1.47*x,
-             'Pd':1.38*x,
-             'Pt':1.38*x}
-
-    # If we have not implemented the radii for the metal in the atoms object, we will use the covalent radii
-    df = pd.read_html('http://crystalmaker.com/support/tutorials/atomic-radii/index.html',header=0)[0]
-    for element in np.unique(atoms.symbols):
-        if element not in radii.keys():
-            try:
-                radii[element] = float(df[df['ElementSymbol']==element]['CovalentRadius [Å]'].values[0])*x
-            except:
-                radii[element] = float(df[df['Element Symbol']==element]['Covalent Radius [Å]'].values[0])*x
+        Please add your own custom radii with Element_Properties.set_custom_radii (covalent radii from the bundled element table are used as a default)"""
+    radii = get_radii(np.unique(atoms.symbols),x)
     return [radii[atom_type] for atom_type in atoms.symbols]
 
-def make_bcm(atoms,x=1.200,CN_Method = 'frac',metal=True):
+@profiled
+def make_bcm(atoms,x=1.200,CN_Method = 'frac',metal=True,bond_list=None,metal_types=None):
     """Make a BCModel object.  The BCModel object is helpful for calculating the CE of the atoms object as well as to calculate the coordination numbers of the atoms object and finding the shell numbers.  
 
     Args:
         atoms (ase.Atoms): atoms object
         x (float, optional): scaling factor for the cutoffs. Defaults to 1.200.
         CN_Method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
+        bond_list (np.ndarray, optional): precomputed bond list of the geometry (skips building the bonds). Defaults to None.
+        metal_types (list, optional): metal types of the model (may include metals that are not in atoms). Defaults to None (the metals in atoms).
 
     Returns:
         bcm (BCModel): BCModel object
     """
-    radii = get_cutoffs(atoms,x)
-    bonds = build_bonds_arr(atoms,radii)
-    bcm = BCModel(atoms,bond_list=bonds,CN_Method=CN_Method,metal=metal)
+    cache,key = get_cache(),None
+    if bond_list is not None:
+        bonds = bond_list
+    else:
+        entry = None
+        cutoffs = get_cutoffs(atoms,x)
+        if cache is not None: # Reuse the bonds of a known geometry with the same cutoff on every atom
+            key = cache.make_key(atoms.get_positions(),cutoffs,CN_Method)
+            entry = cache.load(key)
+        if entry is not None:
+            bonds = entry['bonds'].astype(np.int64)
+        else:
+            with span('build_bonds_arr'):
+                bonds = build_bonds_arr(atoms,cutoffs)
+            if key is not None: # only save new entries
+                cache.save(key,bonds=np.asarray(bonds,dtype=np.int32))
+    with span('BCModel'):
+        bcm = BCModel(atoms,metal_types=metal_types,bond_list=bonds,CN_Method=CN_Method,metal=metal)
     # Updating the gamma dictionary with the new gamma values (if new gamma values are available)
     if metal:
         old_gammas = bcm.gammas
-        new_gammas = recursive_update(old_gammas,gammas_np)
+        new_gammas = recursive_update(old_gammas,load_gammas())
         bcm.gammas = new_gammas
         ce_bulk_old = bcm.ce_bulk
         ce_bulk_new = recursive_update(ce_bulk_old,ce_bulk_pbe_d3)
@@ -111,6 +196,97 @@ def make_bcm(atoms,x=1.200,CN_Method = 'frac',metal=True):
         bcm._get_precomps()
     return bcm
 
+@profiled
+def make_bcm_int(atoms,metal=True):
+    """Make the BCModel with integer coordination numbers (default bonds) used for the shell map.  Uses the topology cache if it is enabled.
+
+    Args:
+        atoms (ase.Atoms): atoms object
+        metal (bool, optional): Whether the nanoparticle is metallic. Defaults to True.
+
+    Returns:
+        bcm_int (BCModel): BCModel object
+    """
+    cache = get_cache()
+    if cache is None:
+        return BCModel(atoms,CN_Method='int',metal=metal)
+    key = cache.make_key(atoms.get_positions(),atoms.get_atomic_numbers(),'int',kind='int')
+    entry = cache.load(key)
+    if entry is not None:
+        return BCModel(atoms,bond_list=entry['bonds'].astype(np.int64),CN_Method='int',metal=metal)
+    bcm_int = BCModel(atoms,CN_Method='int',metal=metal)
+    cache.save(key,bonds=np.asarray(bcm_int.bond_list,dtype=np.int32))
+    return bcm_int
+
+def get_ordering_of(atoms,metal_types):
+    """Get the ordering of the atoms with respect to a given list of metal types (get_ordering uses the metals in atoms)
+
+    Args:
+        atoms (ase.Atoms): atoms object
+        metal_types (list): sorted metal types
+
+    Returns:
+        ordering (np.ndarray): index of each atom's type in metal_types
+    """
+    return np.searchsorted(np.asarray(metal_types),np.asarray(atoms.symbols))
+
+def get_core_shell_index(shell_map,n_atoms):
+    """Shell number of each atom from a BCModel shell map, with the center (shell 0) merged into the core (shell 1)
+
+    Args:
+        shell_map (dict): {shell: atom indices} from a BCModel
+        n_atoms (int): number of atoms
+
+    Returns:
+        shell_idx (np.ndarray): (N,) shell number of each atom
+    """
+    return np.maximum(shell_map_to_index(shell_map,n_atoms),1)
+
+@profiled
+def get_shell_counts(shell_idx,orderings,n_types,n_shells):
+    """Count the atoms of every type in every shell for many orderings with a single bincount
+
+    Args:
+        shell_idx (np.ndarray): (N,) shell number of each atom (see get_core_shell_index)
+        orderings (np.ndarray): (M, N) or (N,) integer orderings
+        n_types (int): number of atom types
+        n_shells (int): number of shells (shells 1 to n_shells are counted)
+
+    Returns:
+        counts (np.ndarray): (M, n_shells, n_types) number of atoms of each type in each shell
+    """
+    orderings = np.atleast_2d(np.asarray(orderings))
+    counted = shell_idx <= n_shells
+    orderings,shell_idx = orderings[:,counted],shell_idx[counted]
+    n_orderings = len(orderings)
+    bins = (np.arange(n_orderings)[:,None]*(n_shells + 1) + shell_idx[None,:])*n_types + orderings
+    counts = np.bincount(bins.ravel(),minlength=n_orderings*(n_shells + 1)*n_types)
+    return counts.reshape(n_orderings,n_shells + 1,n_types)[:,1:]
+
+@profiled
+def plane_mask(positions,normal,origin,offset=0.0,thickness=None,dir='pos'):
+    """Boolean mask of the atoms kept by a planar cut or slab
+
+    Args:
+        positions (np.ndarray): (N, 3) atom positions
+        normal (array-like): unit normal of the plane
+        origin (array-like): point the plane is measured from
+        offset (float, optional): distance of the plane from the origin along the normal. Defaults to 0.0.
+        thickness (float, optional): thickness of a slab centered on the plane. Defaults to None (a half space).
+        dir (str, optional): 'pos' removes the atoms above the plane, 'neg' the ones below it. Defaults to 'pos'.
+
+    Returns:
+        mask (np.ndarray): (N,) True for the atoms that are kept
+    """
+    height = (positions - origin) @ np.asarray(normal,dtype=float) - offset
+    if thickness is not None:
+        return np.abs(height) <= thickness/2
+    if dir == 'pos': # delete all the atoms in the positive direction of the normal
+        return height <= 0
+    elif dir == 'neg': # delete all the atoms in the negative direction of the normal
+        return height >= 0
+    raise ValueError(f"dir must be 'pos' or 'neg', got '{dir}'")
+
 def get_comps(atoms,unique_metals):
     """Get the composition of the atoms object
 
@@ -126,8 +302,69 @@ def get_comps(atoms,unique_metals):
         COMPS.append(sum(atoms.symbols==j))
     return COMPS
 
+def plot_core_shell(ax,shells,comps,totals,unique_metals,df_colors):
+    """Draw the core/shell composition bar plot on a matplotlib axis (also used by the headless renderer)
+
+    Args:
+        ax (matplotlib.axes.Axes): axis to draw on
+        shells (list): list of shell numbers
+        comps (dict): composition of each shell for every metal
+        totals (list): number of atoms in each shell
+        unique_metals (list): metals of the NP (legend)
+        df_colors (pd.DataFrame): colors table from Element_Properties.get_colors_table
+
+    Returns:
+        ax2 (matplotlib.axes.Axes): the twin axis with the number of atoms in each shell
+    """
+    ax2 = ax.twiny()
+    bottom = np.zeros(len(comps[list(comps.keys())[0]]))
+    for i, key in enumerate(list(comps.keys())):
+        value = comps[key]
+        element_color = "#" + df_colors[df_colors['Element']==key]['Hexadecimal Web Color'].values[0]
+        ax.bar(shells,value,width=1,bottom=bottom,color= element_color,linewidth=1,edgecolor='black')
+        bottom += np.array(value)
+    
+    ax.set_ylim([0,1])
+    ax.set_xlim([0.5,shells[-1]+0.5])
+    ax.set_xticks(shells)
+    ax.set_xticklabels(shells)
+    ax.figure.tight_layout()
+    ax.set_xlabel(f'Shell Number (1=Core, {shells[-1]}=Surface)',size=20,weight='bold')
+    ax.set_ylabel(f'Shell Compositions',size=20,weight='bold')
+    ax.legend(unique_metals,loc='lower left',fontsize=18)
+    ax2.set_xlim(ax.get_xlim()) # ensure the independant x-axes now span the same range
+    ax2.set_xticks(shells) # copy over the locations of the x-ticks from the first axes
+    ax2.set_xticklabels(totals) # But give them a different meaning
+    # change the fontsize of the xticks and yticks
+    ax.tick_params(labelsize=18)
+    ax2.tick_params(labelsize=18)
+    ax2.set_xlabel(f'Number of Atoms',size=20,weight='bold')
+    return ax2
+
+class lazy_member:
+    """Nanoparticle member that is built on first access and cached until the atoms of the Nanoparticle change"""
+    def __init__(self,builder):
+        self.builder = builder
+        self.name = builder.__name__
+        self.__doc__ = builder.__doc__
+
+    def __set_name__(self,owner,name):
+        self.name = name
+
+    def __get__(self,obj,objtype=None):
+        if obj is None:
+            return self
+        cache = obj._lazy_cache
+        if self.name not in cache:
+            cache[self.name] = self.builder(obj)
+        return cache[self.name]
+
+    def __set__(self,obj,value):
+        obj._lazy_cache[self.name] = value
+
 class Nanoparticle:
-    def __init__(self,structure,x=1.20,describe="none",method='frac',spike=False,metal=True,cut_coord='x'):
+    @profiled
+    def __init__(self,structure,x=1.20,describe="none",method='frac',spike=False,metal=True,cut_coord='x',lazy=False):
         """Initialize the Nanoparticle object.  This is a wrapper for the BCModel object and the GA object.  The BCModel object is helpful for calculating the CE of the atoms object as well as to calculate the coordination numbers of the atoms object and finding the shell numbers.  The GA object is helpful for finding the optimal chemical ordering of the atoms object using the BCModel.
 
         Args:
@@ -136,9 +373,14 @@ class Nanoparticle:
             describe (str, optional): description of the nanoparticle. Defaults to "none".
             method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
             spike (bool, optional): Whether or not to spike the GA initial generation with the current NP ordering. Defaults to False.
+            metal (bool, optional): Whether the nanoparticle is metallic. Defaults to True.
+            cut_coord (str, optional): Coordinate ('x', 'y' or 'z') used to slice the NP. Defaults to 'x'.
+            lazy (bool, optional): Whether to build the GA, the shell info, the colors and bcm_int only when they are first used. Defaults to False.
+            The slices (atom_cut, atom_cut_neg) are only built when they are first used in either case.
         """
         # If the xyz file is a string, then read the file, if it is an atoms object, then just use it
         if isinstance(structure,str):
+            from ase.io import read
             self.atoms = read(structure)
         else:
             self.atoms = structure
@@ -150,29 +392,160 @@ class Nanoparticle:
         self.cn_method = method # Coordination number method
         self.x = x # Scaling factor for the cutoffs
         self.describe = describe # Description of the nanoparticle
+        self.metal = metal
+        self.spike = spike
+        self.cut_coord = cut_coord
         self.unique_metals = list(np.unique(self.atoms.symbols))
         self.unique_metals.sort()
         self.composition = get_comps(self.atoms,self.unique_metals)
         self.bcm = make_bcm(self.atoms,x=x,CN_Method=method,metal=metal)
-        self.bcm_int = BCModel(self.atoms,CN_Method='int',metal=metal)
-        self.atom_cut = self.x_cut(self.atoms,coordinate=cut_coord)
-        self.atom_cut_neg = self.x_cut(self.atoms,dir='neg',coordinate=cut_coord)
-        self.shells,self.comps,self.totals = self.core_shell_info()
-        self.df_colors = pd.read_html('https://sciencenotes.org/molecule-atom-colors-cpk-colors/',header=0)[1] # Web-scraping the CPK colors for the atoms
-        
-        if metal:
-            self.GA_init = self.Generate_GA(self.bcm,self.composition,x=x,describe=describe,method=method)
-            if spike:
-                self.NP_spike = NP_GA(self.bcm,self.composition,get_ordering(self.atoms))
-                self.GA_init.pop[0] = self.NP_spike
-                self.GA_init.sort_pop()
-            
 
-        
+        if not lazy: # Build everything up front
+            for member in ['bcm_int','shell_info','df_colors']:
+                getattr(self,member)
+            if metal:
+                self.GA_init
+
+    @classmethod
+    def from_library(cls,library,i,**kwargs):
+        """Open entry i of an NP library without parsing any text (see NP_Library)
+
+        Args:
+            library (str or NPLibrary): folder of the library or the opened library
+            i (int): entry number
+            **kwargs: passed to Nanoparticle (x, method, lazy, ...)
+
+        Returns:
+            NP (Nanoparticle): the nanoparticle of entry i
+        """
+        if isinstance(library,str):
+            from CANELa_NP.NP_Library import NPLibrary
+            library = NPLibrary(library)
+        return cls(library.get_atoms(i),**kwargs)
+
+    @property
+    def atoms(self):
+        """ase.Atoms object of the nanoparticle (setting it clears all of the lazily built members)"""
+        return self._atoms
+
+    @atoms.setter
+    def atoms(self,atoms):
+        self._atoms = atoms
+        self._lazy_cache = {}
+
+    @property
+    def bcm(self):
+        """BCModel used for the cohesive energy (setting it clears the batch CE precomputations)"""
+        return self._bcm
+
+    @bcm.setter
+    def bcm(self,bcm):
+        self._bcm = bcm
+        for member in ['ce_precomps','symmetry_perms']:
+            self._lazy_cache.pop(member,None)
+
+    @lazy_member
+    def ce_precomps(self):
+        """Arrays used by calc_ce_batch (see get_ce_precomps)"""
+        return get_ce_precomps(self.bcm,self.unique_metals)
+
+    @lazy_member
+    def symmetry_perms(self):
+        """(G, N) atom permutations of the point group operations that keep the bonds, CNs and shells (see Enumeration)"""
+        from CANELa_NP.Enumeration import get_nanoparticle_symmetry
+        return get_nanoparticle_symmetry(self)
+
+    @lazy_member
+    def bcm_int(self):
+        """BCModel with integer coordination numbers (used for the shell map)"""
+        return make_bcm_int(self.atoms,metal=self.metal)
+
+    @lazy_member
+    def atom_cut(self):
+        """Slice of the NP with the atoms in the positive direction of cut_coord removed"""
+        return self.x_cut(self.atoms,coordinate=self.cut_coord)
+
+    @lazy_member
+    def atom_cut_neg(self):
+        """Slice of the NP with the atoms in the negative direction of cut_coord removed"""
+        return self.x_cut(self.atoms,dir='neg',coordinate=self.cut_coord)
+
+    @lazy_member
+    def shell_info(self):
+        """(shells, comps, totals) from core_shell_info"""
+        return self.core_shell_info()
+
+    @property
+    def shells(self):
+        return self.shell_info[0]
+
+    @property
+    def comps(self):
+        return self.shell_info[1]
+
+    @property
+    def totals(self):
+        return self.shell_info[2]
+
+    @lazy_member
+    def df_colors(self):
+        """CPK colors for the atoms from the bundled element table"""
+        return get_colors_table(self.unique_metals)
+
+    @lazy_member
+    @profiled
+    def GA_init(self):
+        """GA object for the current composition (spiked with the current ordering if spike=True)"""
+        ga = self.Generate_GA(self.bcm,self.composition,x=self.x,describe=self.describe,method=self.cn_method)
+        if self.spike:
+            from ce_expansion.ga.ga import Nanoparticle as NP_GA
+            self.NP_spike = NP_GA(self.bcm,self.composition,get_ordering_of(self.atoms,self.unique_metals))
+            ga.pop[0] = self.NP_spike
+            ga.sort_pop()
+        return ga
     
     def __len__(self):
         return len(self.atoms)
     
+    def update_ordering(self,ordering):
+        """Change the chemical ordering without rebuilding the topology (see relabel)
+
+        Args:
+            ordering (np.ndarray): (N,) index of each atom's type in self.unique_metals
+        """
+        ordering = np.asarray(ordering)
+        if ordering.shape != (len(self),):
+            raise ValueError(f"Ordering must have {len(self)} entries, got shape {ordering.shape}")
+        if ordering.min() < 0 or ordering.max() >= len(self.unique_metals):
+            raise ValueError(f"Ordering values must index into {self.unique_metals}")
+        self.relabel(np.array(self.unique_metals)[ordering])
+
+    def relabel(self,symbols):
+        """Change the chemical symbols of the atoms while keeping the geometry dependent state (bonds, CNs, shell map, bcm_int
+        and the BCM precomputations).  Only the composition, the shell compositions, the slices and the GA are refreshed.
+        The bonds are kept as they are, just like the GA keeps them fixed while it changes the ordering.
+
+        Args:
+            symbols (list): (N,) new chemical symbols (only metals in self.unique_metals)
+        """
+        symbols = np.asarray(symbols)
+        if len(symbols) != len(self):
+            raise ValueError(f"Expected {len(self)} symbols, got {len(symbols)}")
+        unknown = set(np.unique(symbols)) - set(self.unique_metals)
+        if unknown:
+            raise ValueError(f"Cannot relabel with new metals {sorted(unknown)}, build a new Nanoparticle instead")
+        atoms = self._atoms.copy() # never change the atoms object the caller passed in
+        atoms.symbols = symbols
+        self._atoms = atoms # bypass the atoms setter so the cached topology is kept
+        self.composition = get_comps(self.atoms,self.unique_metals)
+        for member in ['atom_cut','atom_cut_neg','shell_info','GA_init']: # shell_idx only depends on the geometry
+            self._lazy_cache.pop(member,None)
+
+    @lazy_member
+    def shell_idx(self):
+        """Shell number of each atom (1=Core, which includes the center, up to the surface)"""
+        return get_core_shell_index(self.bcm_int.shell_map,len(self))
+
     def core_shell_info(self):
         """Collecting core/shell information from the xyz file
 
@@ -181,79 +554,154 @@ class Nanoparticle:
             comps (dict): dictionary of compositions for each shell
             totals (list): list of total number of atoms in each shell
         """
-        shells = []
-        comp = []
-        totals = []
-        comps = defaultdict(list)
-        bcm_int = self.bcm_int
-        for i in range(len(bcm_int.shell_map)):
-            if i == 0:
-                continue
-            if i == 1:
-                shell_map_core = np.append(bcm_int.shell_map[0],bcm_int.shell_map[i])
-                total = len(shell_map_core) 
-                totals.append(total)
-                for metal_type in self.unique_metals:
-                    comps[metal_type].append(sum(self.atoms[shell_map_core].symbols==metal_type)/total)
-                shells.append(i)
-            else:
-                total = len(bcm_int.shell_map[i]) 
-                totals.append(total)
-                for metal_type in self.unique_metals:
-                    comps[metal_type].append(sum(self.atoms[bcm_int.shell_map[i]].symbols==metal_type)/total)
-                shells.append(i)
-        
-        return  shells,comps,totals
+        shells,comps,totals = self.core_shell_info_batch(get_ordering_of(self.atoms,self.unique_metals))
+        comps_dict = defaultdict(list)
+        for t,metal_type in enumerate(self.unique_metals if shells else []):
+            comps_dict[metal_type] = list(comps[0,:,t])
+        return shells,comps_dict,totals
+
+    def to_result(self):
+        """Compact record of this nanoparticle (ordering, CE, shell compositions and diameter on a shared geometry, see NP_Result)"""
+        from CANELa_NP.NP_Result import NanoparticleResult
+        return NanoparticleResult.from_nanoparticle(self)
+
+    @profiled
+    def core_shell_info_batch(self,orderings):
+        """Core/shell compositions of many orderings of this geometry at once (ex: a whole GA population or a trajectory)
+
+        Args:
+            orderings (np.ndarray): (M, N) integer array of orderings (values index into self.unique_metals)
+
+        Returns:
+            shells (list): list of shell numbers
+            comps (np.ndarray): (M, shells, metals) composition of each shell, comps[m,:,t] matches core_shell_info()[1][unique_metals[t]]
+            totals (list): list of total number of atoms in each shell
+        """
+        n_shells = len(self.bcm_int.shell_map) - 1
+        counts = get_shell_counts(self.shell_idx,orderings,len(self.unique_metals),n_shells)
+        totals = np.bincount(self.shell_idx,minlength=n_shells + 1)[1:n_shells + 1]
+        return list(range(1,n_shells + 1)),counts/totals[None,:,None],totals.tolist()
 
     def Generate_GA(self,bcm,COMPS,x=1.20,describe="none",method='frac'):
+        from ce_expansion.ga.ga import GA
         return GA(bcm,COMPS,describe)
     
+    @lazy_member
+    def slice_masks(self):
+        """Cache of the boolean masks made by slice_mask (they only depend on the geometry)"""
+        return {}
+
+    def slice_mask(self,normal=None,miller=None,offset=0.0,thickness=None,dir='pos',origin=None):
+        """Boolean mask of the atoms kept by a planar cut or slab.  Masks are cached so repeated slices are free.
+
+        Args:
+            normal (array-like, optional): normal vector of the plane (Cartesian). Defaults to the x axis.
+            miller (tuple, optional): Miller index (h, k, l) of the plane, used as the normal in the Cartesian frame of the (cubic) cluster.
+            offset (float, optional): distance (Ang) of the plane from the origin along the normal. Defaults to 0.0.
+            thickness (float, optional): thickness (Ang) of a slab centered on the plane.  Defaults to None (a half space).
+            dir (str, optional): 'pos' removes the atoms in the positive direction of the normal, 'neg' the ones in the negative direction
+            (ignored for slabs). Defaults to 'pos'.
+            origin (array-like, optional): point the plane is measured from. Defaults to the core atom.
+
+        Returns:
+            mask (np.ndarray): (N,) True for the atoms that are kept
+        """
+        if miller is not None:
+            normal = miller
+        elif normal is None:
+            normal = (1,0,0)
+        normal = np.asarray(normal,dtype=float)
+        normal = normal/np.linalg.norm(normal)
+        if origin is None:
+            origin = self.atoms.positions[self.bcm_int.shell_map[0][0]] # core atom
+        origin = np.asarray(origin,dtype=float)
+        key = (tuple(np.round(normal,12)),tuple(np.round(origin,12)),float(offset),thickness,dir if thickness is None else None)
+        if key not in self.slice_masks:
+            self.slice_masks[key] = plane_mask(self.atoms.get_positions(),normal,origin,offset=offset,thickness=thickness,dir=dir)
+        return self.slice_masks[key]
+
+    def get_slice(self,normal=None,miller=None,offset=0.0,thickness=None,dir='pos',origin=None):
+        """Atoms object of a planar cut or slab of the NP (see slice_mask for the arguments)"""
+        return self.atoms[self.slice_mask(normal=normal,miller=miller,offset=offset,thickness=thickness,dir=dir,origin=origin)]
+
+    @profiled
     def x_cut(self,original_atoms,dir='pos',coordinate='x'):
-        atoms = original_atoms.copy()
-        core_atom = atoms[self.bcm_int.shell_map[0]][0]
-        if coordinate=='x':
-            coord_idx = 0
-            cutoff = core_atom.a # x coordinate of atom in the core
-        elif coordinate=='y':
-            coord_idx = 1
-            cutoff = core_atom.b # y coordinate of atom in the core
-        elif coordinate=='z':
-            coord_idx = 2
-            cutoff = core_atom.c # z coordinate of atom in the core
-        
-        if dir=='pos': # If we want to delete all the atoms that are greater than the cutoff (i.e. the atoms in the positive direction)
-            atoms_to_del = np.where(atoms.get_positions()[:,coord_idx]>cutoff)[0] # Finding all the atom idxs that have a x coord greater than the centers
-        elif dir=='neg': # If we want to delete all the atoms that are less than the cutoff (i.e. the atoms in the negative direction)
-            atoms_to_del = np.where(atoms.get_positions()[:,coord_idx]<cutoff)[0]
+        """Cut the atoms object through the core atom along x, y or z
 
-        del atoms[atoms_to_del]
-        return atoms
+        Args:
+            original_atoms (ase.Atoms): atoms object to cut (same geometry as the NP)
+            dir (str, optional): 'pos' removes the atoms in the positive direction, 'neg' the ones in the negative direction. Defaults to 'pos'.
+            coordinate (str, optional): 'x', 'y' or 'z'. Defaults to 'x'.
 
-    def run_ga(self,max_gens=-1,max_nochange=2000):
+        Returns:
+            atoms (ase.Atoms): the remaining atoms
+        """
+        normal = {'x':(1,0,0),'y':(0,1,0),'z':(0,0,1)}[coordinate]
+        if original_atoms is self.atoms:
+            return original_atoms[self.slice_mask(normal=normal,dir=dir)]
+        core_atom = original_atoms.positions[self.bcm_int.shell_map[0][0]]
+        return original_atoms[plane_mask(original_atoms.get_positions(),normal,core_atom,dir=dir)]
+
+    @profiled
+    def run_ga(self,max_gens=-1,max_nochange=2000,seeds=None,migrate_every=50,n_migrants=1,n_jobs=None):
         """Run the GA to find the optimal chemical ordering.  This function will run the GA until the max number of generations is reached 
             or the max number of generations without a change in the best fitness is reached.
 
         Args:
-            COMPS (dict): dictionary of compositions
-            x (float, optional): scaling factor for the cutoffs. Defaults to 1.20.
-            describe (str, optional): description for the GA. Defaults to "none".
-            method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
-
-        Returns:
-            ga (GA): GA object
+            max_gens (int, optional): max number of generations (-1 for no limit). Defaults to -1.
+            max_nochange (int, optional): max number of generations without a change in the best fitness. Defaults to 2000.
+            seeds (iterable, optional): one seed per island to run an island model GA in a process pool (see Island_GA.run_islands).
+            Defaults to None (a single GA, GA_init, in this process).  Every island is spiked with the current ordering if spike=True.
+            migrate_every (int, optional): generations between migrations of the island model. Defaults to 50.
+            n_migrants (int, optional): orderings sent to the next island at each migration. Defaults to 1.
+            n_jobs (int, optional): number of worker processes for the island model. Defaults to None (one per island).
         """
+        if seeds is not None:
+            from CANELa_NP.Island_GA import run_islands
+            seeds = list(seeds)
+            spike = get_ordering_of(self.atoms,self.bcm.metal_types) if self.spike else None
+            # the workers score the same bonds and metal types as self.bcm (metals dropped by relabel are kept)
+            ordering,ce,history = run_islands(self.atoms,self.composition,x=self.x,method=self.cn_method,describe=self.describe,
+                                              seeds=seeds,max_gens=max_gens,max_nochange=max_nochange,migrate_every=migrate_every,
+                                              n_migrants=n_migrants,n_jobs=n_jobs,bond_list=self.bcm.bond_list,
+                                              metal_types=self.bcm.metal_types,spike=spike)
+            print(f"Best CE from {len(seeds)} islands: {ce:.5f} eV/atom")
+            print("Saving optimized structure...")
+            self.ga_history = history
+            self.update_ordering(ordering) # keeps the bonds, CNs and shell map
+            print("Done!")
+            return
         ga = self.GA_init
-        ga.run(max_gens=max_gens,max_nochange=max_nochange)
+        with span('GA.run'):
+            ga.run(max_gens=max_gens,max_nochange=max_nochange)
         print("Saving optimized structure...")
         self.ga = ga
-        self.atoms = self.ga.make_atoms_object()
-        self.bcm = make_bcm(self.atoms,x=self.x,CN_Method=self.cn_method)
-        self.shells,self.comps,self.totals = self.core_shell_info()
-        self.atom_cut = self.x_cut(self.atoms)
+        self.relabel(self.ga.make_atoms_object().symbols) # keeps the bonds, CNs and shell map
+        self.GA_init = ga
         print("Done!")
 
+    def enumerate_orderings(self,composition=None,n_best=10,max_orderings=2_000_000,update=False):
+        """Score every symmetry-distinct ordering (exact global optimum for small NPs and dilute dopings, see Enumeration)
+
+        Args:
+            composition (dict, optional): {metal: number of atoms}, metals in self.unique_metals. Defaults to the current composition.
+            n_best (int, optional): number of orderings returned. Defaults to 10 (None for all of them).
+            max_orderings (int, optional): refuse compositions with more than about this many distinct orderings. Defaults to 2_000_000.
+            update (bool, optional): Whether to apply the lowest CE ordering to the nanoparticle. Defaults to False.
 
-    def view(self,cut=False,rotate=False,path=None,colors=None,positive=True):
+        Returns:
+            orderings (np.ndarray): (n_best, N) orderings (values index into self.unique_metals), lowest CE first
+            ces (np.ndarray): (n_best,) cohesive energies (eV/atom)
+            degeneracy (np.ndarray): (n_best,) number of equivalent orderings of each
+        """
+        from CANELa_NP.Enumeration import enumerate_nanoparticle
+        orderings,ces,degeneracy = enumerate_nanoparticle(self,composition,n_best=n_best,max_orderings=max_orderings)
+        if update:
+            self.update_ordering(orderings[0]) # keeps the bonds, CNs and shell map
+        return orderings,ces,degeneracy
+
+    @profiled
+    def view(self,cut=False,rotate=False,path=None,colors=None,positive=True,normal=None,miller=None,offset=0.0,thickness=None):
         """View the atoms object
 
         Args:
@@ -264,41 +712,53 @@ class Nanoparticle:
             If true a gif will be created with molgif before visualizing the structure.
             Defaults to False.
             path (str, optional): Path to save the gif. Defaults to None.
+            normal, miller, offset, thickness (optional): plane or slab to cut with instead of the cut_coord cut (see slice_mask).
 
 
         Returns:
             view (ASE): ASE view object
         """
-        if cut and not rotate:
-            if positive == True:
-                view(self.atom_cut)
+        if cut:
+            if normal is not None or miller is not None or offset != 0.0 or thickness is not None:
+                atoms = self.get_slice(normal=normal,miller=miller,offset=offset,thickness=thickness,dir='pos' if positive else 'neg')
+            elif positive == True:
+                atoms = self.atom_cut
             else:
-                view(self.atom_cut_neg)
-        elif cut and rotate:
+                atoms = self.atom_cut_neg
+        else:
+            atoms = self.atoms
+
+        if rotate:
             if path is None:
-                path = "atoms_gif.gif"
+                path = "atoms_gif.gif" if cut else "atoms_full_gif.gif"
             
             if os.path.exists(path):
                 os.remove(path)
-            if positive == True:
-                molgif.rot_gif(self.atom_cut,optimize=True,save_path=path,overwrite=True,draw_bonds=False,draw_legend=True,colors=colors);
-            else:
-                molgif.rot_gif(self.atom_cut_neg,optimize=True,save_path=path,overwrite=True,draw_bonds=False,draw_legend=True,colors=colors);
-            plt.clf()
-            plt.close()
-            display(Image(filename=path))
-        elif rotate:
-            if path is None:
-                path = "atoms_full_gif.gif"
-                
-            if os.path.exists(path):
-                os.remove(path)
-            molgif.rot_gif(self.atoms,optimize=True,save_path=path,overwrite=True,draw_bonds=False,draw_legend=True,colors=colors);
+            import molgif
+            import matplotlib.pyplot as plt
+            from IPython.display import display, Image
+            molgif.rot_gif(atoms,optimize=True,save_path=path,overwrite=True,draw_bonds=False,draw_legend=True,colors=colors);
             plt.clf()
             plt.close()
             display(Image(filename=path))
         else:
-            view(self.atoms)
+            from ase.visualize import view
+            view(atoms)
+
+    def render(self,view='full',out_dir='renders',**settings):
+        """Render a view of the NP to a file without displaying it.  Renders are cached by a hash of the structure
+        and the settings, so an unchanged view is never rendered twice (see Rendering.render_np).
+
+        Args:
+            view (str, optional): 'full', 'cut' or 'core_shell'. Defaults to 'full'.
+            out_dir (str, optional): folder of the rendered files. Defaults to 'renders'.
+            **settings: render settings (ex: fmt='gif' for a molgif rotation, miller=(1,1,1) for the cut)
+
+        Returns:
+            path (str): path of the rendered file
+        """
+        from CANELa_NP.Rendering import render_np
+        return render_np(self,view=view,out_dir=out_dir,**settings)
         
     def write(self,filename):
         """Write the atoms object to a file
@@ -308,25 +768,70 @@ class Nanoparticle:
         """
         self.atoms.write(filename)
 
+    @profiled
     def calc_ce(self):
         """Calculate the cohesive energy of the nanoparticle
 
         Returns:
             ce (float): cohesive energy of the nanoparticle
         """
-        ce = self.bcm.calc_ce(get_ordering(self.atoms))
+        ce = self.bcm.calc_ce(get_ordering_of(self.atoms,self.unique_metals)) # indices into the metals of the bcm, even if relabel dropped one
         return ce
+
+    def calc_ce_batch(self,orderings,chunk_size=256):
+        """Calculate the cohesive energy of many orderings of this nanoparticle's geometry at once
+
+        Args:
+            orderings (np.ndarray): (M, N) integer array of orderings (values index into self.unique_metals)
+            chunk_size (int, optional): number of orderings evaluated at a time. Defaults to 256.
+
+        Returns:
+            ces (np.ndarray): (M,) cohesive energies
+        """
+        orderings = np.atleast_2d(np.asarray(orderings))
+        if orderings.shape[1] != len(self):
+            raise ValueError(f"Orderings must have {len(self)} columns, got {orderings.shape[1]}")
+        return calc_ce_batch(self.ce_precomps,orderings,chunk_size=chunk_size)
     
-    def get_diam(self):
-        """Calculate the diameter of the nanoparticle in Angstroms"""
-        #cn_surfaces,surf_atoms = get_surface_atoms(atoms)
-        cns = list(self.bcm_int.cn)
-
-        corner_idx = cns.index(min(Counter(cns)))
-        dist = max(self.atoms.get_all_distances()[corner_idx]) # Ang 
-        return dist
+    @profiled
+    def get_diam(self,kind='corner'):
+        """Calculate the diameter of the nanoparticle in Angstroms (O(N) memory)
+
+        Args:
+            kind (str, optional): 'corner' for the largest distance from the lowest coordinated (corner) atom,
+            or 'min', 'max' or 'mean' for the extents along the principal axes (see get_principal_diams). Defaults to 'corner'.
+
+        Returns:
+            diam (float): diameter of the nanoparticle in Angstroms
+        """
+        if kind == 'corner':
+            corner_idx = int(np.argmin(self.bcm_int.cn)) # first atom with the lowest CN
+            positions = self.atoms.get_positions()
+            return float(np.sqrt(((positions - positions[corner_idx])**2).sum(axis=1)).max()) # Ang
+        diams = self.get_principal_diams()
+        if kind == 'min':
+            return float(diams.min())
+        elif kind == 'max':
+            return float(diams.max())
+        elif kind == 'mean':
+            return float(diams.mean())
+        raise ValueError(f"Unknown diameter kind '{kind}', use 'corner', 'min', 'max' or 'mean'")
+
+    def get_principal_diams(self):
+        """Extent of the nanoparticle along each of its principal axes in Angstroms
+
+        Returns:
+            diams (np.ndarray): (3,) extents sorted from largest to smallest
+        """
+        positions = self.atoms.get_positions()
+        centered = positions - positions.mean(axis=0)
+        eig_vals,axes = np.linalg.eigh(centered.T @ centered) # 3x3 gyration tensor
+        projected = centered @ axes
+        diams = projected.max(axis=0) - projected.min(axis=0)
+        return np.sort(diams)[::-1]
     
     
+    @profiled
     def core_shell_plot(self,save=False,saveas='NP_Comp',dpi=300):
         """Plotting core/shell composition on a bar plot
         
@@ -339,31 +844,9 @@ class Nanoparticle:
             fig (matplotlib): matplotlib figure object
         """
         
+        import matplotlib.pyplot as plt
         f, ax = plt.subplots(1, 1, sharey=False)
-        ax2 = ax.twiny()
-        bottom = np.zeros(len(self.comps[list(self.comps.keys())[0]]))
-        for i, key in enumerate(list(self.comps.keys())):
-            value = self.comps[key]
-            element_color = "#" + self.df_colors[self.df_colors['Element']==key]['Hexadecimal Web Color'].values[0]
-            ax.bar(self.shells,value,width=1,bottom=bottom,color= element_color,linewidth=1,edgecolor='black')
-            bottom += np.array(value)
-        
-        surface_num =self.shells[-1]
-        ax.set_ylim([0,1])
-        ax.set_xlim([0.5,self.shells[-1]+0.5])
-        ax.set_xticks(self.shells)
-        ax.set_xticklabels(self.shells)
-        plt.tight_layout()
-        ax.set_xlabel(f'Shell Number (1=Core, {self.shells[-1]}=Surface)',size=20,weight='bold')
-        ax.set_ylabel(f'Shell Compositions',size=20,weight='bold')
-        ax.legend(self.unique_metals,loc='lower left',fontsize=18)
-        ax2.set_xlim(ax.get_xlim()) # ensure the independant x-axes now span the same range
-        ax2.set_xticks(self.shells) # copy over the locations of the x-ticks from the first axes
-        ax2.set_xticklabels(self.totals) # But give them a different meaning
-        # change the fontsize of the xticks and yticks
-        ax.tick_params(labelsize=18)
-        ax2.tick_params(labelsize=18)
-        ax2.set_xlabel(f'Number of Atoms',size=20,weight='bold')
+        plot_core_shell(ax,self.shells,self.comps,self.totals,self.unique_metals,self.df_colors)
         if save:
             plt.savefig(f'{saveas}.png',dpi=dpi,bbox_inches='tight')
         plt.show()
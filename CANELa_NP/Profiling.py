@@ -0,0 +1,194 @@
+"""Opt-in timing and memory instrumentation for the Nanoparticle workflows
+
+Named spans record the wall time, number of calls and peak memory allocated (tracemalloc) of every stage.  Nothing is
+recorded unless profiling is on, and a disabled span costs one attribute lookup.
+
+Example)
+    from CANELa_NP.Profiling import profile
+    with profile(memory=True) as prof:
+        NP = Nanoparticle(atoms)
+        NP.run_ga()
+    print(prof.report())
+
+Memory is read with tracemalloc.get_traced_memory and the tracemalloc peak is never reset, so a tracemalloc session that
+was already running is left as it was.  The peak of a span is exact when the span raises the peak of the process, otherwise
+it is the larger of the memory in use when it started and when it finished (a lower bound).
+
+Every finished span is also logged to the 'CANELa_NP.profiling' logger (DEBUG level) with the record in extra={'span': record}.
+Only spans run in this process are collected (not the ones inside worker processes).
+"""
+import functools
+import logging
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger('CANELa_NP.profiling')
+
+class _State:
+    enabled = False
+    memory = False
+    started_tracemalloc = False # whether enable started tracemalloc (and disable has to stop it)
+    collectors = []
+
+_state = _State()
+_local = threading.local()
+
+class Profile:
+    def __init__(self,callback=None):
+        """Collects the records of every span while it is active
+
+        Args:
+            callback (callable, optional): called with each record (dict) when a span finishes. Defaults to None.
+        """
+        self.callback = callback
+        self.records = []
+
+    def add(self,record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        """Totals per span name
+
+        Returns:
+            summary (dict): {name: {'calls', 'total_s', 'mean_s', 'max_s', 'peak_mb'}}
+        """
+        summary = defaultdict(lambda: {'calls':0,'total_s':0.0,'max_s':0.0,'peak_mb':None})
+        for record in self.records:
+            stats = summary[record['span']]
+            stats['calls'] += 1
+            stats['total_s'] += record['wall_s']
+            stats['max_s'] = max(stats['max_s'],record['wall_s'])
+            if record['peak_mb'] is not None:
+                stats['peak_mb'] = max(stats['peak_mb'] or 0.0,record['peak_mb'])
+        for stats in summary.values():
+            stats['mean_s'] = stats['total_s']/stats['calls']
+        return dict(summary)
+
+    def report(self):
+        """Summary as a text table sorted by total time"""
+        rows = sorted(self.summary().items(),key=lambda item: -item[1]['total_s'])
+        width = max([len(name) for name,stats in rows] + [4])
+        lines = [f"{'span':<{width}} {'calls':>7} {'total (s)':>11} {'mean (s)':>11} {'peak (MB)':>10}"]
+        for name,stats in rows:
+            peak = '-' if stats['peak_mb'] is None else f"{stats['peak_mb']:.2f}"
+            lines.append(f"{name:<{width}} {stats['calls']:>7} {stats['total_s']:>11.4f} {stats['mean_s']:>11.4g} {peak:>10}")
+        return '\n'.join(lines)
+
+def enable(memory=False,callback=None):
+    """Turn profiling on (until disable is called)
+
+    Args:
+        memory (bool, optional): Whether to trace peak memory with tracemalloc (slows down allocations). Defaults to False.
+        callback (callable, optional): called with each record when a span finishes. Defaults to None.
+
+    Returns:
+        prof (Profile): collector of the records
+    """
+    prof = Profile(callback=callback)
+    _state.collectors = _state.collectors + [prof]
+    _state.enabled = True
+    if memory and not _state.memory:
+        _state.memory = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _state.started_tracemalloc = True
+    return prof
+
+def disable(prof=None):
+    """Turn profiling off (only stops collecting into prof if it is given and others are still active)"""
+    _state.collectors = [c for c in _state.collectors if prof is not None and c is not prof]
+    if not _state.collectors:
+        _state.enabled = False
+        if _state.memory:
+            _state.memory = False
+            if _state.started_tracemalloc: # a session started by the caller keeps running
+                _state.started_tracemalloc = False
+                tracemalloc.stop()
+
+@contextmanager
+def profile(memory=False,callback=None):
+    """Profile everything run inside the with block
+
+    Args:
+        memory (bool, optional): Whether to trace peak memory with tracemalloc. Defaults to False.
+        callback (callable, optional): called with each record when a span finishes. Defaults to None.
+
+    Yields:
+        prof (Profile): collector of the records (see Profile.report)
+    """
+    prof = enable(memory=memory,callback=callback)
+    try:
+        yield prof
+    finally:
+        disable(prof)
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return False
+
+_null_span = _NullSpan()
+
+class _Span:
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local,'stack',None)
+        if stack is None:
+            stack = _local.stack = []
+        self.memory = _state.memory and tracemalloc.is_tracing()
+        if self.memory:
+            self.start_mem,self.start_peak = tracemalloc.get_traced_memory()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*args):
+        wall = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+        peak_mb = None
+        if self.memory and tracemalloc.is_tracing():
+            current,peak = tracemalloc.get_traced_memory()
+            # a higher peak than at the start was reached inside the span, else only the end points are known
+            max_mem = peak if peak > self.start_peak else max(self.start_mem,current)
+            peak_mb = (max_mem - self.start_mem)/1024**2
+        record = {'span':self.name,'wall_s':wall,'peak_mb':peak_mb,'depth':len(stack)}
+        for collector in _state.collectors:
+            collector.add(record)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.name} {wall:.6f} s",extra={'span':record})
+        return False
+
+def span(name):
+    """Context manager timing a named stage (does nothing unless profiling is on)"""
+    if not _state.enabled:
+        return _null_span
+    return _Span(name)
+
+def profiled(name=None):
+    """Decorator that wraps every call of a function in a span (use as @profiled or @profiled('name'))
+
+    Args:
+        name (str, optional): span name. Defaults to the module and qualified name of the function (ex: 'Nanotools.make_bcm').
+    """
+    if callable(name):
+        return profiled()(name)
+    def decorator(func):
+        label = name or f"{func.__module__.rsplit('.',1)[-1]}.{func.__qualname__}"
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not _state.enabled:
+                return func(*args,**kwargs)
+            with _Span(label):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
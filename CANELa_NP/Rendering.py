@@ -0,0 +1,154 @@
+"""Headless batch rendering of NP views (full, cut and core/shell plots) with a content-hash cache
+
+Everything is drawn off screen (Agg backend, no IPython) so it can run in batch jobs and process pools.  Each file is
+named after a hash of the structure and the render settings, so unchanged structures are never rendered twice.
+
+Example)
+    python -m CANELa_NP.Rendering structures/ -o renders --views full cut core_shell --fmt gif -j 4
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from ase.io import read, write
+
+from CANELa_NP.Nanotools import Nanoparticle, plot_core_shell
+from CANELa_NP.Trajectory_Analysis import find_structure_files
+
+render_version = 1 # bump to invalidate the cached renders when the drawing code changes
+views = ['full','cut','core_shell']
+default_settings = {'full':{'fmt':'png','rotation':'0x,0y,0z','colors':None},
+                    'cut':{'fmt':'png','rotation':'0x,0y,0z','colors':None,'positive':True,
+                           'normal':None,'miller':None,'offset':0.0,'thickness':None},
+                    'core_shell':{'fmt':'png','dpi':300}}
+
+def get_settings(view,**settings):
+    """Complete render settings of a view (defaults updated with settings)"""
+    if view not in default_settings:
+        raise ValueError(f"Unknown view '{view}', use one of {views}")
+    unknown = set(settings) - set(default_settings[view])
+    if unknown:
+        raise ValueError(f"Unknown settings for the {view} view: {sorted(unknown)}")
+    return {**default_settings[view],**settings}
+
+def render_key(atoms,view,settings):
+    """Hash of everything a render depends on (positions, elements, view and settings)"""
+    h = hashlib.sha1()
+    h.update(f'{render_version}:{view}:{len(atoms)}:'.encode())
+    h.update(json.dumps(settings,sort_keys=True,default=str).encode())
+    h.update(np.ascontiguousarray(atoms.get_positions(),dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(atoms.numbers,dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+def render_path(atoms,view,out_dir,settings):
+    """File a view is (or will be) rendered to"""
+    return os.path.join(out_dir,f"{view}_{render_key(atoms,view,settings)}.{settings['fmt']}")
+
+def _draw(NP,view,settings,path):
+    """Render one view of the NP to path"""
+    if view == 'core_shell':
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        plot_core_shell(fig.add_subplot(1,1,1),NP.shells,NP.comps,NP.totals,NP.unique_metals,NP.df_colors)
+        fig.savefig(path,dpi=settings['dpi'],bbox_inches='tight',format=settings['fmt'])
+        return
+    atoms = NP.atoms
+    if view == 'cut':
+        dir = 'pos' if settings['positive'] else 'neg'
+        if settings['normal'] is None and settings['miller'] is None and settings['offset'] == 0.0 and settings['thickness'] is None:
+            atoms = NP.atom_cut if settings['positive'] else NP.atom_cut_neg
+        else:
+            atoms = NP.get_slice(normal=settings['normal'],miller=settings['miller'],offset=settings['offset'],
+                                 thickness=settings['thickness'],dir=dir)
+    if settings['fmt'] == 'gif':
+        import molgif
+        import matplotlib.pyplot as plt
+        molgif.rot_gif(atoms,optimize=True,save_path=path,overwrite=True,draw_bonds=False,draw_legend=True,colors=settings['colors'])
+        plt.close('all')
+    else:
+        write(path,atoms,format=settings['fmt'],rotation=settings['rotation'],colors=settings['colors'])
+
+def render_np(NP,view='full',out_dir='renders',**settings):
+    """Render a view of a Nanoparticle unless it is already in the cache
+
+    Args:
+        NP (Nanoparticle): the nanoparticle
+        view (str, optional): 'full', 'cut' or 'core_shell'. Defaults to 'full'.
+        out_dir (str, optional): folder of the rendered files. Defaults to 'renders'.
+        **settings: render settings, see default_settings (fmt='gif' makes a molgif rotation of the full and cut views)
+
+    Returns:
+        path (str): path of the rendered file
+    """
+    settings = get_settings(view,**settings)
+    path = render_path(NP.atoms,view,out_dir,settings)
+    if os.path.exists(path):
+        return path
+    os.makedirs(out_dir,exist_ok=True)
+    root,ext = os.path.splitext(path)
+    tmp_path = f'{root}.{os.getpid()}.tmp{ext}'
+    try:
+        _draw(NP,view,settings,tmp_path)
+        os.replace(tmp_path,path) # never leave a partial file under the cached name
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _render_structure(atoms,view_settings,out_dir,x,method):
+    NP = Nanoparticle(atoms,x=x,method=method,lazy=True)
+    return {view:render_np(NP,view=view,out_dir=out_dir,**settings) for view,settings in view_settings.items()}
+
+def render_batch(structures,views=('full','cut','core_shell'),out_dir='renders',settings=None,x=1.20,method='frac',n_jobs=None):
+    """Render views of many NPs in a process pool.  Only the structures with missing renders are sent to the pool.
+
+    Args:
+        structures (list): paths to structure files and/or atoms objects
+        views (tuple, optional): views to render for every structure. Defaults to ('full','cut','core_shell').
+        out_dir (str, optional): folder of the rendered files. Defaults to 'renders'.
+        settings (dict, optional): {view: render settings} (see default_settings). Defaults to None.
+        x (float, optional): scaling factor for the cutoffs. Defaults to 1.20.
+        method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
+        n_jobs (int, optional): number of worker processes. Defaults to None (all cores).
+
+    Returns:
+        paths (list): {view: path of the rendered file} for every structure
+    """
+    settings = settings or {}
+    view_settings = {view:get_settings(view,**settings.get(view,{})) for view in views}
+    paths,todo = [],[]
+    for structure in structures:
+        atoms = read(structure) if isinstance(structure,str) else structure
+        paths.append({view:render_path(atoms,view,out_dir,s) for view,s in view_settings.items()})
+        if not all(os.path.exists(path) for path in paths[-1].values()):
+            todo.append(atoms)
+    if todo:
+        with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_worker) as pool:
+            futures = [pool.submit(_render_structure,atoms,view_settings,out_dir,x,method) for atoms in todo]
+            for future in futures:
+                future.result()
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the full, cut and core/shell views of many NPs (headless, cached)')
+    parser.add_argument('inputs', type=str, nargs='+', help='Structure files or directories of structures')
+    parser.add_argument('-o', '--out_dir', type=str, default='renders', help="Folder of the rendered files (default='renders')")
+    parser.add_argument('--views', type=str, nargs='+', default=views, choices=views, help='Views to render (default: all)')
+    parser.add_argument('--fmt', type=str, default='png', help="Format of the full and cut views, 'png' or 'gif' (default='png')")
+    parser.add_argument('--pattern', type=str, default='*.xyz', help="Files to read from directories (default='*.xyz')")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    files = find_structure_files(args.inputs,pattern=args.pattern)
+    paths = render_batch(files,views=args.views,out_dir=args.out_dir,settings={'full':{'fmt':args.fmt},'cut':{'fmt':args.fmt}},n_jobs=args.jobs)
+    for file,file_paths in zip(files,paths):
+        print(file,*file_paths.values())
@@ -1,29 +1,20 @@
 import numpy as np
 from collections import Counter
 from ase.data import covalent_radii as CR
+import ase.neighborlist
+from scipy.spatial import cKDTree
 from ce_expansion.atomgraph.bcm import BCModel
 import ase.cluster as ac
 from ase.visualize import view
 import sys
 import os
 import argparse
+import tempfile
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
 
 
 # HELPER FUNCTIONS
-def Dir_Exist_Or_Create(MYDIR):
-    """If a directory exists then do nothing.  If not then create it.  
-    Args:
-        MYDIR (str): The name of the directory you are checking for
-    """
-    MYDIR = (MYDIR)
-    CHECK_FOLDER = os.path.isdir(MYDIR)
-    # If folder doesn't exist, then create it.
-    if not CHECK_FOLDER:
-        os.makedirs(MYDIR)
-        current_directory = os.getcwd()
-        print("created folder : ", os.path.join(current_directory,MYDIR))
-        print('\n')
-
 def get_coordination_numbers(atoms, covalent_percent=1.25):
     """Returns an array of coordination numbers and an array of existing bonds determined by
     distance and covalent radii.  By default a bond is defined as 120% of the combined radii
@@ -36,30 +27,28 @@ def get_coordination_numbers(atoms, covalent_percent=1.25):
     bonds to other excluded atomic numbers.
     """
 
-    # Get all the distances
-    distances = np.divide(atoms.get_all_distances(mic=True), covalent_percent)
-    
-    # Atomic Numbers
-    numbers = atoms.numbers
+    # Candidate pairs from a neighbor search (roughly linear in the number of atoms)
+    cr = np.take(CR, atoms.numbers)
+    cutoffs = cr*covalent_percent*(1 + 1e-8) # slightly padded so no bond on the cutoff is missed
+    if atoms.pbc.any():
+        i_idx, j_idx, dists = ase.neighborlist.neighbor_list('ijd', atoms, cutoffs, self_interaction=False)
+    else:
+        positions = atoms.get_positions()
+        candidates = cKDTree(positions).query_pairs(2*cutoffs.max(), output_type='ndarray')
+        i_idx = np.concatenate([candidates[:,0], candidates[:,1]])
+        j_idx = np.concatenate([candidates[:,1], candidates[:,0]])
+        dists = np.linalg.norm(positions[i_idx] - positions[j_idx], axis=1)
+
+    # Same bond criterion as comparing against the full distance matrix
+    is_bond = (cr[i_idx] + cr[j_idx]) >= np.divide(dists, covalent_percent)
+    pairs = np.unique(np.column_stack([i_idx[is_bond], j_idx[is_bond]]), axis=0) # sorted, one entry per (i, j) even with periodic images
+    pairs = pairs[pairs[:,0] != pairs[:,1]]
+
     # Coordination Numbers for each atom
-    cn = []
-    cr = np.take(CR, numbers)
+    cn = np.bincount(pairs[:,0], minlength=len(atoms))
     # Array of indices of bonded atoms.  len(bonded[x]) == cn[x]
-    bonded = []
-    indices = list(range(len(atoms)))
-    for i in indices:
-        bondedi = []
-        for ii in indices:
-            # Skip if measuring the same atom
-            if i == ii:
-                continue
-            if (cr[i] + cr[ii]) >= distances[i,ii]:
-                bondedi.append(ii)
-        # Add this atoms bonds to the bonded list
-        bonded.append(bondedi)
-    for i in bonded:
-        cn.append(len(i))
-    return cn, bonded
+    bonded = [b.tolist() for b in np.split(pairs[:,1], np.cumsum(cn)[:-1])]
+    return cn.tolist(), bonded
 
 def evenly_distribute(atoms,CNs,CN,Atom_Type_2):
     """ Evenly distributes a second atom type over a specified coordination environment.
@@ -74,67 +63,144 @@ def evenly_distribute(atoms,CNs,CN,Atom_Type_2):
         atoms (ase.Atoms): The modified atoms object.
     """
 
-    indices = [i for i, x in enumerate(CNs) if x == CN]
-    for i,x in enumerate(indices):
-        if i % 2:
-            atoms[x].symbol = Atom_Type_2
+    indices = np.flatnonzero(np.asarray(CNs) == CN)
+    atoms.symbols[indices[1::2]] = Atom_Type_2 # every second atom with this CN
     return atoms
 
+def get_alternating_mask(CNs):
+    """Mask of the atoms that get the second atom type: every second atom (in index order) of each coordination environment.
+    Same as calling evenly_distribute for every unique CN.
+
+    Args:
+        CNs (list): coordination number of each atom (from get_coordination_numbers)
+
+    Returns:
+        mask (np.ndarray): (N,) True for the atoms of the second atom type
+    """
+    CNs = np.asarray(CNs)
+    order = np.argsort(CNs,kind='stable') # atoms grouped by CN, in index order within each group
+    sorted_cns = CNs[order]
+    group_start = np.flatnonzero(np.r_[True,sorted_cns[1:] != sorted_cns[:-1]])
+    rank = np.arange(len(CNs)) - np.repeat(group_start,np.diff(np.r_[group_start,len(CNs)]))
+    mask = np.zeros(len(CNs),dtype=bool)
+    mask[order] = rank % 2 == 1
+    return mask
+
+cluster_shapes = ['icosahedron','cuboctahedron','decahedron']
+
+def make_cluster(shape,element,number_of_shells):
+    """Closed shell cluster (13, 55, 147, 309, ... atoms for 2, 3, 4, 5, ... shells)
+
+    Args:
+        shape (str): 'icosahedron', 'cuboctahedron' or 'decahedron'
+        element (str): element of the cluster (sets the lattice constant)
+        number_of_shells (int): number of shells, counting the center atom as the first
+
+    Returns:
+        atoms (ase.Atoms): the cluster
+    """
+    if shape == 'icosahedron':
+        return ac.Icosahedron(element,number_of_shells)
+    elif shape == 'cuboctahedron':
+        return ac.Octahedron(element,2*number_of_shells - 1,number_of_shells - 1)
+    elif shape == 'decahedron':
+        return ac.Decahedron(element,number_of_shells,number_of_shells,0)
+    raise ValueError(f"Unknown shape '{shape}', use one of {cluster_shapes}")
+
+def get_file_name(atoms,Atom_Type_1,Atom_Type_2,shape='icosahedron',number_of_shells=4):
+    """File name of a structure: its formula tagged with the shape and number of shells (ex: Au74Pd73-icosahedron-4.xyz).
+    Name the DFT calculation the same way, this is how Gamma_Value_Calc matches the structure to its energy (see DFT_Energies.split_name)."""
+    formula = f"{Atom_Type_1}{np.sum(atoms.symbols == Atom_Type_1)}{Atom_Type_2}{np.sum(atoms.symbols == Atom_Type_2)}"
+    return f"{formula}-{shape}-{number_of_shells}.xyz"
+
+def get_folder_name(Atom_Type_1,Atom_Type_2,shape='icosahedron'):
+    """Folder of a pair (ex: PdAu).  Other shapes than the icosahedron get their own tagged folder (ex: PdAu-decahedron),
+    Gamma_Value_Calc fits the structures of every shape folder of a pair together."""
+    folder_name = Atom_Type_2 + Atom_Type_1
+    return folder_name if shape == 'icosahedron' else f'{folder_name}-{shape}'
+
+def generate_pair(Atom_Type_1,Atom_Type_2,shape='icosahedron',number_of_shells=4):
+    """Make the two structures used to fit the gammas of a pair: the second atom type evenly distributed over every
+    coordination environment of a cluster of the first atom type, and the same structure with the atom types swapped.
+
+    Args:
+        Atom_Type_1 (str): The first atom type (sets the lattice constant and the bonds)
+        Atom_Type_2 (str): The second atom type
+        shape (str, optional): 'icosahedron', 'cuboctahedron' or 'decahedron'. Defaults to 'icosahedron'.
+        number_of_shells (int, optional): number of shells. Defaults to 4.
+
+    Returns:
+        atoms_1, atoms_2 (ase.Atoms): the structure and its swapped version (the CNs are stored as initial charges)
+    """
+    atoms = make_cluster(shape,Atom_Type_1,number_of_shells)
+    CNs,Bonds = get_coordination_numbers(atoms)
+    mask = get_alternating_mask(CNs)
+    atoms.set_initial_charges(CNs) # to visualize the coordination numbers
+    atoms_1 = atoms.copy()
+    atoms_1.symbols = np.where(mask,Atom_Type_2,Atom_Type_1)
+    atoms_2 = atoms.copy()
+    atoms_2.symbols = np.where(mask,Atom_Type_1,Atom_Type_2)
+    return atoms_1,atoms_2
+
+def write_structure(atoms,path):
+    """Write an xyz file atomically (concurrent runs never see a partial file)"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+    fd,tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),suffix='.xyz')
+    os.close(fd)
+    atoms.write(tmp_path,format='extxyz')
+    os.replace(tmp_path,path)
+
+def _generate_and_write(Atom_Type_1,Atom_Type_2,shape,number_of_shells,out_dir):
+    folder = os.path.join(out_dir,get_folder_name(Atom_Type_1,Atom_Type_2,shape))
+    paths = []
+    for atoms in generate_pair(Atom_Type_1,Atom_Type_2,shape=shape,number_of_shells=number_of_shells):
+        path = os.path.join(folder,get_file_name(atoms,Atom_Type_1,Atom_Type_2,shape,number_of_shells))
+        write_structure(atoms,path)
+        paths.append(path)
+    return paths
+
+def generate_training_set(pairs,shapes=('icosahedron',),shells=(4,),out_dir='Data',n_jobs=None):
+    """Write the structure pairs for every element pair, shape and number of shells in parallel (the gamma training set)
+
+    Args:
+        pairs (list): (Atom_Type_1, Atom_Type_2) pairs, or a list of elements to use every combination of them
+        shapes (tuple, optional): shapes of the clusters. Defaults to ('icosahedron',).
+        shells (tuple, optional): numbers of shells. Defaults to (4,).
+        out_dir (str, optional): folder the pair folders are written to. Defaults to 'Data'.
+        n_jobs (int, optional): number of worker processes. Defaults to None (all cores).
+
+    Returns:
+        paths (list): paths of the written xyz files
+    """
+    pairs = list(pairs)
+    if all(isinstance(p,str) for p in pairs):
+        pairs = list(combinations(pairs,2))
+    for shape in shapes:
+        if shape not in cluster_shapes:
+            raise ValueError(f"Unknown shape '{shape}', use one of {cluster_shapes}")
+    tasks = [(A,B,shape,n) for A,B in pairs for shape in shapes for n in shells]
+    paths = []
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(_generate_and_write,*task,out_dir) for task in tasks]
+        for future in futures:
+            paths.extend(future.result())
+    return paths
+
 
 if __name__ == "__main__":
     # Parse the command line arguments
     parser = argparse.ArgumentParser(description='Generates a set of NPs for gamma values')
-    parser.add_argument('Atom_Type_1', type=str, help='The first atom type')
-    parser.add_argument('Atom_Type_2', type=str, help='The second atom type')
-    parser.add_argument('-n', '--number_of_shells', type=int, default=4, help='The number of shells to use default=4')
+    parser.add_argument('elements', type=str, nargs='+', help='Atom types (two for one pair, more for every combination of them)')
+    parser.add_argument('-n', '--number_of_shells', type=int, nargs='+', default=[4], help='The number(s) of shells to use default=4')
+    parser.add_argument('-s', '--shapes', type=str, nargs='+', default=['icosahedron'], choices=cluster_shapes, help='Cluster shapes (default=icosahedron)')
+    parser.add_argument('-o', '--out_dir', type=str, default='Data', help="Folder of the pair folders (default='Data')")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes (default: all cores)')
     
     # Collect the arguments
     args = parser.parse_args()
-    Atom_Type_1 = args.Atom_Type_1
-    Atom_Type_2 = args.Atom_Type_2
-    number_of_shells = args.number_of_shells
-
-    ############################################### CALCULATIONS ####################################################
-
-    # Create the directory for the NPs
-    Dir_Exist_Or_Create(f'Data')
-    os.chdir('Data')
-    folder_name = Atom_Type_2+Atom_Type_1
-    Dir_Exist_Or_Create(folder_name)
-
-    # Create a nanoparticle with the first atom type
-    atoms = ac.Icosahedron(Atom_Type_1, number_of_shells)
-
-    # Get the coordination numbers
-    CNs, Bonds = get_coordination_numbers(atoms)
-    # Find the unique coordination numbers
-    Unique_CNs = np.unique(CNs) 
-    # Distribute the second atom type evenly across the coordination environment
-    for CN in Unique_CNs:
-        atoms = evenly_distribute(atoms,CNs,CN,Atom_Type_2)
-
-    ## Write to a file
-    file_name_1 = Atom_Type_1+str(len(atoms[atoms.symbols==Atom_Type_1]))+Atom_Type_2+str(len(atoms[atoms.symbols==Atom_Type_2]))+'.xyz'
-    atoms.set_initial_charges(CNs) # to visualize the coordination numbers
-    atoms.write(os.path.join(folder_name,file_name_1))
-
-    # Now we just swap the orderings
+    if len(args.elements) < 2:
+        parser.error('At least two atom types are required')
 
-    # Finding the indices of the first atom type
-    indices_Atom_Type_1 = [i for i,x in enumerate(atoms.symbols) if x==Atom_Type_1]
-    # Finding the indices of the second atom type
-    indices_Atom_Type_2 = [i for i,x in enumerate(atoms.symbols) if x==Atom_Type_2]
-    
-    # copy the atoms object
-    atoms2 = atoms.copy()
-
-    # swap the atom types
-    for i,x in enumerate(indices_Atom_Type_1):
-        atoms2[x].symbol = Atom_Type_2
-    for i,x in enumerate(indices_Atom_Type_2):
-        atoms2[x].symbol = Atom_Type_1
-    
-    # Saving the second file
-    atoms2.set_initial_charges(CNs) # to visualize the coordination numbers
-    file_name_2 = Atom_Type_1+str(len(atoms2[atoms2.symbols==Atom_Type_1]))+Atom_Type_2+str(len(atoms2[atoms2.symbols==Atom_Type_2]))+'.xyz'
-    atoms2.write(os.path.join(folder_name,file_name_2))
+    paths = generate_training_set(args.elements,shapes=args.shapes,shells=args.number_of_shells,out_dir=args.out_dir,n_jobs=args.jobs)
+    for path in paths:
+        print(path)
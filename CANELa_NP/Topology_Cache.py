@@ -0,0 +1,123 @@
+"""Persistent on-disk cache of bond lists keyed by a hash of the geometry
+
+The cache is off by default.  Turn it on with enable_cache() or by setting the CANELA_NP_CACHE_DIR environment variable.
+Entries are compressed .npz files; once the cache grows past max_bytes the least recently used entries are removed.
+
+The key is the geometry, the bond radius of every atom and the CN method.  The cutoffs follow the symbols, so two
+orderings of the same template only share an entry when every atom has the same cutoff in both (ex: metals with equal
+radii), i.e. when their bonds are the same.
+"""
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'CANELa_NP', 'topology')
+
+class TopologyCache:
+    def __init__(self,path=default_cache_dir,max_bytes=512*1024**2):
+        """Content addressed cache of geometry dependent arrays
+
+        Args:
+            path (str, optional): folder for the cache files. Defaults to ~/.cache/CANELa_NP/topology.
+            max_bytes (int, optional): size of the cache before the least recently used entries are evicted. Defaults to 512 MB.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path,exist_ok=True)
+
+    @staticmethod
+    def make_key(positions,cutoffs,CN_Method,kind='bcm'):
+        """Hash of everything the topology depends on
+
+        Args:
+            positions (np.ndarray): (N, 3) atom positions
+            cutoffs (list): (N,) bond radius (already scaled) of every atom, or the atomic number of every atom if the default radii are used
+            CN_Method (str): Method for calculating coordination number
+            kind (str, optional): which model the entry belongs to ('bcm' or 'int'). Defaults to 'bcm'.
+        """
+        h = hashlib.sha1()
+        h.update(f'{kind}:{CN_Method}:{len(positions)}:'.encode())
+        h.update(np.ascontiguousarray(positions,dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(cutoffs,dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def _file(self,key):
+        return os.path.join(self.path,key + '.npz')
+
+    def load(self,key):
+        """Load the arrays of an entry (None if it is not cached)"""
+        file = self._file(key)
+        try:
+            with np.load(file) as data:
+                entry = {name:data[name] for name in data.files}
+        except (FileNotFoundError,OSError,ValueError):
+            return None
+        os.utime(file) # mark as recently used
+        return entry
+
+    def save(self,key,**arrays):
+        """Store the arrays of an entry (atomic, so concurrent processes never see a partial file)"""
+        fd,tmp_path = tempfile.mkstemp(dir=self.path,suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            np.savez_compressed(f,**arrays)
+        os.replace(tmp_path,self._file(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes"""
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.path,name))
+                except FileNotFoundError: # removed by another process
+                    continue
+                files.append((stat.st_mtime,stat.st_size,name))
+        total = sum(size for mtime,size,name in files)
+        for mtime,size,name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path,name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every entry"""
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.path,name))
+
+_cache = None
+
+def enable_cache(path=default_cache_dir,max_bytes=512*1024**2):
+    """Turn on the topology cache
+
+    Returns:
+        cache (TopologyCache): the active cache
+    """
+    global _cache
+    _cache = TopologyCache(path,max_bytes=max_bytes)
+    return _cache
+
+def disable_cache():
+    """Turn off the topology cache (the files are kept)"""
+    global _cache
+    _cache = None
+
+def get_cache():
+    """The active TopologyCache (None if the cache is off)"""
+    return _cache
+
+def shell_map_to_index(shell_map,n_atoms):
+    """Convert a BCModel shell map ({shell: atom indices}) to the shell number of each atom"""
+    shell_idx = np.zeros(n_atoms,dtype=np.int32)
+    for shell in range(len(shell_map)):
+        shell_idx[np.asarray(shell_map[shell],dtype=int)] = shell
+    return shell_idx
+
+if os.environ.get('CANELA_NP_CACHE_DIR'):
+    enable_cache(os.environ['CANELA_NP_CACHE_DIR'])
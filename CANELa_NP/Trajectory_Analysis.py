@@ -0,0 +1,228 @@
+"""Streaming analysis of trajectories and directories of structures (CE, shell compositions and diameter frame by frame)
+
+Frames are read one at a time with ase.io.iread and results are written as they are computed, so memory stays bounded.
+When consecutive frames share the same geometry and metals (ex: Monte Carlo swaps) the topology of the previous frame
+is reused.
+
+Example)
+    python -m CANELa_NP.Trajectory_Analysis md.traj structures/ -o results.csv -j 4
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import queue as queue_module
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Queue
+
+import numpy as np
+from ase.io import iread
+
+from CANELa_NP.Nanotools import Nanoparticle
+
+result_columns = ['file','frame','formula','n_atoms','ce','diameter','shells','shell_comps','totals']
+
+def analyze_frames(path,index=':',x=1.20,method='frac',reuse_topology=True):
+    """Analyze every frame of a structure file
+
+    Args:
+        path (str): trajectory or structure file (any format ase can read)
+        index (str, optional): frames to read (ase index string). Defaults to ':' (all).
+        x (float, optional): scaling factor for the cutoffs. Defaults to 1.20.
+        method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
+        reuse_topology (bool, optional): Whether to relabel the previous Nanoparticle when the geometry and the metals are unchanged. Defaults to True.
+
+    Yields:
+        record (dict): one row of results per frame (see result_columns)
+    """
+    NP = None
+    for frame,atoms in enumerate(iread(path,index=index)):
+        # only the same metals: a frame without one of them gets the shells and colors of a new Nanoparticle
+        same_geometry = (reuse_topology and NP is not None and len(atoms) == len(NP)
+                         and np.array_equal(atoms.get_positions(),NP.atoms.get_positions())
+                         and set(np.unique(atoms.symbols)) == set(NP.unique_metals))
+        if same_geometry:
+            NP.relabel(atoms.symbols)
+        else:
+            NP = Nanoparticle(atoms,x=x,method=method,lazy=True)
+        shells,comps,totals = NP.core_shell_info()
+        yield {'file':path,
+               'frame':frame,
+               'formula':atoms.get_chemical_formula(),
+               'n_atoms':len(atoms),
+               'ce':float(NP.calc_ce()),
+               'diameter':NP.get_diam(),
+               'shells':json.dumps(shells),
+               'shell_comps':json.dumps({str(metal):[float(c) for c in comp] for metal,comp in comps.items()}),
+               'totals':json.dumps([int(t) for t in totals])}
+
+class ResultWriter:
+    def __init__(self,path,format=None,batch_size=1000):
+        """Incremental writer for the frame records (csv, or parquet if pyarrow is installed)
+
+        Args:
+            path (str): output file
+            format (str, optional): 'csv' or 'parquet'. Defaults to the file extension.
+            batch_size (int, optional): rows buffered before each parquet row group is written. Defaults to 1000.
+        """
+        self.path = path
+        self.format = format or ('parquet' if path.endswith('.parquet') else 'csv')
+        self.batch_size = batch_size
+        self.rows = []
+        if self.format == 'csv':
+            self._file = open(path,'w',newline='')
+            self._csv = csv.DictWriter(self._file,fieldnames=result_columns)
+            self._csv.writeheader()
+        elif self.format == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Writing parquet files requires pyarrow (pip install pyarrow)")
+            self._pa = pa
+            self._schema = pa.schema([('file',pa.string()),('frame',pa.int64()),('formula',pa.string()),('n_atoms',pa.int64()),
+                                      ('ce',pa.float64()),('diameter',pa.float64()),('shells',pa.string()),
+                                      ('shell_comps',pa.string()),('totals',pa.string())])
+            self._parquet = pq.ParquetWriter(path,self._schema)
+        else:
+            raise ValueError(f"Unknown format '{self.format}', use 'csv' or 'parquet'")
+
+    def write(self,record):
+        if self.format == 'csv':
+            self._csv.writerow(record)
+            return
+        self.rows.append(record)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.format == 'csv':
+            self._file.flush()
+        elif self.rows:
+            columns = {name:[row[name] for row in self.rows] for name in result_columns}
+            self._parquet.write_table(self._pa.table(columns,schema=self._schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.format == 'csv':
+            self._file.close()
+        else:
+            self._parquet.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def find_structure_files(inputs,pattern='*.xyz'):
+    """Expand directories into the structure files they contain
+
+    Args:
+        inputs (list): files and/or directories
+        pattern (str, optional): glob pattern for the files in directories. Defaults to '*.xyz'.
+
+    Returns:
+        files (list): structure files
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item,pattern))))
+        else:
+            files.append(item)
+    return files
+
+_queue = None
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+def _analyze_file(args):
+    """Send the rows of one file to the main process in chunks of at most chunk_size rows, then None"""
+    path,index,x,method,chunk_size = args
+    chunk = []
+    try:
+        for record in analyze_frames(path,index=index,x=x,method=method):
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                _queue.put(chunk)
+                chunk = []
+    finally: # the end of file marker is always sent, errors are raised by the future in the main process
+        _queue.put(chunk)
+        _queue.put(None)
+
+def run_pipeline(inputs,output,index=':',x=1.20,method='frac',n_jobs=1,format=None,pattern='*.xyz',chunk_size=100,poll_interval=1.0):
+    """Analyze many structure files and write every frame to one results file
+
+    With n_jobs=1 frames are streamed one at a time.  With more jobs the files are fanned out over a process pool and
+    the workers send their rows back in chunks through a bounded queue, so the memory stays bounded for any trajectory
+    length.  The frames of a file stay in order but the rows of files analyzed at the same time are interleaved.  If a
+    worker dies (ex: killed when out of memory) the pool is broken and BrokenProcessPool is raised instead of waiting forever.
+
+    Args:
+        inputs (list): files and/or directories of structures
+        output (str): results file (.csv or .parquet)
+        index (str, optional): frames to read from each file (ase index string). Defaults to ':'.
+        x (float, optional): scaling factor for the cutoffs. Defaults to 1.20.
+        method (str, optional): Method for calculating coordination number. Defaults to 'frac'.
+        n_jobs (int, optional): number of worker processes. Defaults to 1.
+        format (str, optional): 'csv' or 'parquet'. Defaults to the output extension.
+        pattern (str, optional): glob pattern for the files in directories. Defaults to '*.xyz'.
+        chunk_size (int, optional): rows sent back by a worker at a time (n_jobs > 1). Defaults to 100.
+        poll_interval (float, optional): seconds to wait for rows before checking that the workers are alive (n_jobs > 1). Defaults to 1.0.
+
+    Returns:
+        n_frames (int): number of frames written
+    """
+    files = find_structure_files(inputs,pattern=pattern)
+    n_frames = 0
+    with ResultWriter(output,format=format) as writer:
+        if n_jobs == 1:
+            for path in files:
+                for record in analyze_frames(path,index=index,x=x,method=method):
+                    writer.write(record)
+                    n_frames += 1
+                writer.flush()
+        else:
+            queue = Queue(maxsize=2*n_jobs) # workers wait while the writer is behind
+            with ProcessPoolExecutor(n_jobs,initializer=_init_worker,initargs=(queue,)) as pool:
+                futures = [pool.submit(_analyze_file,(path,index,x,method,chunk_size)) for path in files]
+                n_done = 0
+                while n_done < len(files):
+                    try:
+                        records = queue.get(timeout=poll_interval)
+                    except queue_module.Empty:
+                        # a dead worker never sends the end of its file, the pool fails its future (and stops the others)
+                        for future in futures:
+                            if future.done() and isinstance(future.exception(),BrokenProcessPool):
+                                future.result()
+                        continue
+                    if records is None: # end of a file
+                        n_done += 1
+                        writer.flush()
+                        continue
+                    for record in records:
+                        writer.write(record)
+                    n_frames += len(records)
+                for future in futures:
+                    future.result() # raises the error of a worker, if any
+    return n_frames
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate the CE, shell compositions and diameter of every frame of many structures')
+    parser.add_argument('inputs', type=str, nargs='+', help='Trajectory/structure files or directories of structures')
+    parser.add_argument('-o', '--output', type=str, default='np_analysis.csv', help='Results file (.csv or .parquet)')
+    parser.add_argument('-i', '--index', type=str, default=':', help="Frames to read from each file (default=':')")
+    parser.add_argument('-x', type=float, default=1.20, help='Scaling factor for the cutoffs (default=1.20)')
+    parser.add_argument('--method', type=str, default='frac', help="Method for calculating coordination number (default='frac')")
+    parser.add_argument('--pattern', type=str, default='*.xyz', help="Files to read from directories (default='*.xyz')")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes (default=1)')
+    args = parser.parse_args()
+
+    n_frames = run_pipeline(args.inputs,args.output,index=args.index,x=args.x,method=args.method,n_jobs=args.jobs,pattern=args.pattern)
+    print(f"Wrote {n_frames} frames to {args.output}")
@@ -0,0 +1,56 @@
+"""Cold start benchmark of a CE only worker (import CANELa_NP.Nanotools, build a Nanoparticle and call calc_ce)
+
+Every repeat runs in a fresh interpreter.  The run fails if the import is slower than --max_import_s or if one of the
+heavy packages that only the GA and the visualization need got imported.
+
+Example)
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --repeat 10 --max_import_s 1.0
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+heavy_modules = ['matplotlib.pyplot','IPython','molgif','ase.visualize','ce_expansion.ga']
+
+worker = """
+import json, sys, time
+start = time.perf_counter()
+import CANELa_NP.Nanotools as nt
+imported = time.perf_counter()
+import ase.cluster as ac
+atoms = ac.Icosahedron('Au', 4)
+atoms.symbols[::2] = 'Pd'
+built = time.perf_counter()
+nt.Nanoparticle(atoms, lazy=True).calc_ce()
+done = time.perf_counter()
+print(json.dumps({'import_s': imported - start, 'first_ce_s': done - built,
+                  'heavy': [m for m in %r if m in sys.modules]}))
+""" % (heavy_modules,)
+
+def measure_cold_start():
+    """Run one CE only worker in a new interpreter
+
+    Returns:
+        stats (dict): {'import_s', 'first_ce_s', 'heavy': heavy modules that were imported}
+    """
+    output = subprocess.run([sys.executable,'-c',worker],capture_output=True,text=True,check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start time of a CE only CANELa_NP worker')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of fresh interpreters (default=5)')
+    parser.add_argument('--max_import_s', type=float, default=None, help='Fail if the best import time is above this')
+    args = parser.parse_args()
+
+    runs = [measure_cold_start() for _ in range(args.repeat)]
+    best_import = min(run['import_s'] for run in runs)
+    best_ce = min(run['first_ce_s'] for run in runs)
+    heavy = sorted(set(m for run in runs for m in run['heavy']))
+    print(f"import CANELa_NP.Nanotools: {best_import:.3f} s (best of {args.repeat})")
+    print(f"first Nanoparticle + calc_ce: {best_ce:.3f} s")
+    if heavy:
+        print(f"Heavy modules imported by a CE only worker: {heavy}")
+    if heavy or (args.max_import_s is not None and best_import > args.max_import_s):
+        sys.exit(1)
@@ -0,0 +1,159 @@
+"""Benchmark suite for CANELa_NP (runs offline)
+
+Times every stage of the Nanoparticle workflow on icosahedra, cuboctahedra and decahedra from 55 to 10k+ atoms
+with binary and ternary compositions, and records the wall time and peak (tracemalloc) memory of each stage.  Times are
+measured with tracemalloc off, the peak memory in a separate traced run.
+
+Example)
+    python benchmarks/bench_np.py -o bench_results.json
+    python benchmarks/bench_np.py --quick
+    python benchmarks/bench_np.py --compare old_results.json new_results.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from CANELa_NP.Nanotools import Nanoparticle, get_ordering
+from CANELa_NP.BCM_Sandbox import BCM_Mod
+from CANELa_NP.Setup_NPs_for_DFT import make_cluster
+from CANELa_NP._version import __version__
+
+# Number of shells of each shape (see Setup_NPs_for_DFT.make_cluster) -> about 55, 150, 550, 2k, 4-5k and 10k atoms
+shape_sizes = {'icosahedron':[3,4,6,9,11,15],
+               'cuboctahedron':[3,4,6,9,11,14],
+               'decahedron':[3,4,6,9,12,15]}
+quick_shape_sizes = {shape:sizes[:3] for shape,sizes in shape_sizes.items()}
+compositions = {'binary':['Au','Pd'],
+                'ternary':['Au','Pd','Pt']}
+
+def make_structure(shape,size,elements,seed=0):
+    """Build a cluster and give it an even, random mix of the elements
+
+    Args:
+        shape (str): 'icosahedron', 'cuboctahedron' or 'decahedron'
+        size (int): number of shells (see Setup_NPs_for_DFT.make_cluster)
+        elements (list): element symbols
+        seed (int, optional): seed for the random ordering. Defaults to 0.
+
+    Returns:
+        atoms (ase.Atoms): the cluster
+    """
+    atoms = make_cluster(shape,elements[0],size)
+    symbols = np.array(elements)[np.arange(len(atoms)) % len(elements)]
+    atoms.symbols = np.random.default_rng(seed).permutation(symbols)
+    return atoms
+
+def measure(func,repeat=1):
+    """Record the best wall time of func (untraced runs) and its peak memory (one more run under tracemalloc, which
+    slows allocations down too much to be timed)
+
+    Returns:
+        result: the return value of the last timed call
+        stats (dict): {'time_s': best wall time, 'peak_mb': peak memory allocated during the call}
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    current,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result,{'time_s':min(times),'peak_mb':peak/1024**2}
+
+def bench_structure(atoms,repeat=3,ga=True):
+    """Benchmark every stage for one structure
+
+    Returns:
+        stages (dict): {stage: {'time_s', 'peak_mb'}}
+    """
+    stages = {}
+    NP,stages['construct_lazy'] = measure(lambda: Nanoparticle(atoms.copy(),lazy=True))
+    full_NP,stages['construct_full'] = measure(lambda: Nanoparticle(atoms.copy()))
+    NP.bcm_int # build it here so it is not counted in the shell and diameter stages
+    _,stages['calc_ce'] = measure(NP.calc_ce,repeat)
+    orderings = np.array([np.random.default_rng(i).permutation(get_ordering(atoms)) for i in range(100)])
+    _,stages['calc_ce_batch_100'] = measure(lambda: NP.calc_ce_batch(orderings),repeat)
+    _,stages['core_shell_info'] = measure(NP.core_shell_info,repeat)
+    _,stages['get_diam'] = measure(NP.get_diam,repeat)
+    bcm_mod,stages['bcm_mod_init'] = measure(lambda: BCM_Mod(atoms))
+    _,stages['bcm_mod_calc_ce'] = measure(bcm_mod.calc_ce,repeat)
+    if ga:
+        _,stages['ga_generation'] = measure(lambda: full_NP.GA_init.run(max_gens=1,max_nochange=2))
+    return stages
+
+def run_benchmarks(sizes=shape_sizes,comps=compositions,repeat=3,ga=True,max_atoms=None):
+    """Run the whole suite
+
+    Returns:
+        results (dict): machine readable results ('meta' and one 'runs' entry per structure)
+    """
+    runs = []
+    for shape,shape_params in sizes.items():
+        for size in shape_params:
+            for comp_name,elements in comps.items():
+                atoms = make_structure(shape,size,elements)
+                if max_atoms is not None and len(atoms) > max_atoms:
+                    continue
+                print(f"{shape:>13} {comp_name:>7} {len(atoms):>6} atoms",flush=True)
+                runs.append({'shape':shape,
+                             'size':size,
+                             'composition':comp_name,
+                             'formula':atoms.get_chemical_formula(),
+                             'n_atoms':len(atoms),
+                             'stages':bench_structure(atoms,repeat=repeat,ga=ga)})
+    return {'meta':{'version':__version__,
+                    'python':sys.version.split()[0],
+                    'numpy':np.__version__,
+                    'platform':platform.platform(),
+                    'time':time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'runs':runs}
+
+def compare(old_path,new_path,threshold=1.25):
+    """Print the stages that got slower than threshold x between two result files
+
+    Returns:
+        regressions (list): (run label, stage, old time, new time)
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    label = lambda run: f"{run['shape']}-{run['composition']}-{run['n_atoms']}"
+    old_runs = {label(run):run for run in old['runs']}
+    regressions = []
+    for run in new['runs']:
+        if label(run) not in old_runs:
+            continue
+        for stage,stats in run['stages'].items():
+            old_stats = old_runs[label(run)]['stages'].get(stage)
+            if old_stats and stats['time_s'] > threshold*old_stats['time_s']:
+                regressions.append((label(run),stage,old_stats['time_s'],stats['time_s']))
+                print(f"{label(run)} {stage}: {old_stats['time_s']:.4g} s -> {stats['time_s']:.4g} s")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CANELa_NP workflow stages across sizes and shapes')
+    parser.add_argument('-o', '--output', type=str, default='bench_results.json', help='Results file (json)')
+    parser.add_argument('--quick', action='store_true', help='Only run the three smallest sizes of each shape')
+    parser.add_argument('--max_atoms', type=int, default=None, help='Skip structures with more atoms than this')
+    parser.add_argument('--repeat', type=int, default=3, help='Repeats of the fast stages (best time is kept, default=3)')
+    parser.add_argument('--no_ga', action='store_true', help='Skip the GA generation stage')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('OLD','NEW'), help='Compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare)
+        sys.exit(1 if regressions else 0)
+
+    results = run_benchmarks(sizes=quick_shape_sizes if args.quick else shape_sizes,repeat=args.repeat,
+                             ga=not args.no_ga,max_atoms=args.max_atoms)
+    with open(args.output,'w') as f:
+        json.dump(results,f,indent=1)
+    print(f"Wrote {len(results['runs'])} runs to {args.output}")
@@ -13,4 +13,665 @@ def test_trimetallic_np_ce():
     AuPdPt_Path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'Example_Data', 'AuPdPt.xyz'))
     NP = Nanoparticle(AuPdPt_Path)
     cohesive_energy_AuPdPt = round(NP.calc_ce(),12)
-    assert cohesive_energy_AuPdPt == -4.0362403098
\ No newline at end of file
+    assert cohesive_energy_AuPdPt == -4.0362403098
+
+def test_element_properties_offline():
+    from CANELa_NP.Element_Properties import get_radii, get_cpk_color
+    radii = get_radii(['Au', 'Ag'], 1.2)
+    assert radii['Au'] == 1.47*1.2 # custom radius takes priority
+    assert radii['Ag'] == 1.45*1.2 # covalent radius from the bundled table
+    assert get_cpk_color('Au') == '#FFD123'
+
+
+def test_lazy_np_ce():
+    atoms = ac.Icosahedron('Au', 5)
+    atoms.symbols[100:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    assert round(NP.calc_ce(),12) == -3.397886376398
+    assert 'GA_init' not in NP._lazy_cache
+    assert NP.shells == Nanoparticle(atoms).shells
+
+
+def test_slices_built_on_access():
+    atoms = ac.Icosahedron('Au', 3)
+    atoms.symbols[::2] = 'Pd'
+    NP = Nanoparticle(atoms)
+    assert 'shell_info' in NP._lazy_cache
+    assert 'atom_cut' not in NP._lazy_cache and 'atom_cut_neg' not in NP._lazy_cache
+    assert len(NP.atom_cut) + len(NP.atom_cut_neg) >= len(atoms)
+    assert 'atom_cut' in NP._lazy_cache and 'atom_cut_neg' in NP._lazy_cache
+
+def test_bcm_mod_vectorized_matches_loop():
+    from ase.io import read
+    from CANELa_NP.BCM_Sandbox import BCM_Mod
+    AuPdPt_Path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'Example_Data', 'AuPdPt.xyz'))
+    bcm = BCM_Mod(read(AuPdPt_Path))
+    assert abs(bcm.calc_ce() - bcm.calc_ce_loop()) < 1e-12
+
+
+def test_calc_ce_batch():
+    import numpy as np
+    from CANELa_NP.Nanotools import get_ordering
+    atoms = ac.Icosahedron('Au', 5)
+    atoms.symbols[100:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    rng = np.random.default_rng(0)
+    orderings = np.array([get_ordering(atoms)] + [rng.permutation(get_ordering(atoms)) for _ in range(5)])
+    ces = NP.calc_ce_batch(orderings)
+    assert abs(ces[0] - NP.calc_ce()) < 1e-12
+    assert np.allclose(ces, [NP.bcm.calc_ce(ordering) for ordering in orderings], rtol=0, atol=1e-12)
+
+
+def test_coordination_numbers_match_shipped_data():
+    import glob
+    import numpy as np
+    from ase.io import read
+    from CANELa_NP.Setup_NPs_for_DFT import get_coordination_numbers
+    data_folder = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'CANELa_NP', 'Data'))
+    for xyz_file in glob.glob(os.path.join(data_folder, '*', '*.xyz')):
+        atoms = read(xyz_file)
+        if not atoms.has('initial_charges'): # DFT optimized structures
+            continue
+        Atom_Type_1 = os.path.basename(os.path.dirname(xyz_file))[2:4] # folders are named Atom_Type_2+Atom_Type_1
+        CNs, Bonds = get_coordination_numbers(ac.Icosahedron(Atom_Type_1, 4))
+        assert np.array_equal(atoms.get_initial_charges(), CNs) # CNs were stored as charges when the data was generated
+        assert [len(b) for b in Bonds] == CNs
+
+    # brute force reference on the full distance matrix
+    from ase.data import covalent_radii
+    for shells in range(1, 6):
+        atoms = ac.Icosahedron('Au', shells)
+        cutoff = 1.25*2*covalent_radii[79]
+        distances = atoms.get_all_distances()
+        np.fill_diagonal(distances, np.inf)
+        CNs, Bonds = get_coordination_numbers(atoms)
+        assert Bonds == [np.where(row <= cutoff)[0].tolist() for row in distances]
+
+
+def test_get_diam():
+    atoms = ac.Icosahedron('Au', 5)
+    atoms.symbols[100:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    corner_idx = list(NP.bcm_int.cn).index(min(NP.bcm_int.cn))
+    assert NP.get_diam() == max(atoms.get_all_distances()[corner_idx])
+    assert NP.get_diam('min') <= NP.get_diam('mean') <= NP.get_diam('max')
+
+
+def test_fit_gammas_recovers_gammas():
+    import numpy as np
+    from ase.io import read
+    from CANELa_NP.Gamma_Value_Calc import fit_gammas, calc_gammas, custom_calc_ce, ce_bulk_pbe_d3
+    data_folder = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'CANELa_NP', 'Data'))
+    atoms = [read(os.path.join(data_folder, 'AuAg', name)) for name in ['Ag73Au74.xyz', 'Ag74Au73.xyz']]
+    atoms.append(ac.Icosahedron('Au', 3))
+    atoms[-1].symbols[::3] = 'Ag'
+    true_gammas = {'Ag': {'Ag': 1, 'Au': 0.8}, 'Au': {'Au': 1, 'Ag': 1.2}}
+    CEs = [custom_calc_ce(a, true_gammas, ce_bulk_pbe_d3) for a in atoms]
+    gammas, residuals = fit_gammas(atoms, CEs)
+    assert abs(gammas['Ag']['Au'] - 0.8) < 1e-8 and abs(gammas['Au']['Ag'] - 1.2) < 1e-8
+    assert np.abs(residuals).max() < 1e-10
+    # noisy CEs: the default fits every structure (least squares), combine=True only matches the sum of the CEs
+    noisy = np.array(CEs) + [0.01, -0.02, 0.015]
+    gammas, residuals = fit_gammas(atoms, noisy)
+    combined_gammas, combined_residuals = fit_gammas(atoms, noisy, combine=True)
+    assert abs(combined_residuals.sum()) < 1e-10
+    combined_residuals = [custom_calc_ce(a, combined_gammas, ce_bulk_pbe_d3) - ce for a, ce in zip(atoms, noisy)]
+    assert np.sum(residuals**2) < np.sum(np.square(combined_residuals)) - 1e-8
+    assert calc_gammas(atoms, noisy) == gammas
+
+
+def test_update_gamma_file(tmp_path, monkeypatch):
+    import json
+    import pytest
+    from CANELa_NP import Gamma_Value_Calc
+    path = str(tmp_path / 'np_gammas.json')
+    with open(path, 'w') as f:
+        json.dump({'Pt': {'Pt': 1, 'Pd': 0.9}, 'Ag': {'Ag': 1, 'Au': 0.5}}, f)
+    merged = Gamma_Value_Calc.update_gamma_file({'Ag': {'Au': 0.8}, 'Au': {'Au': 1, 'Ag': 1.2}}, path=path)
+    with open(path) as f:
+        assert json.load(f) == merged == {'Pt': {'Pt': 1, 'Pd': 0.9}, 'Ag': {'Ag': 1, 'Au': 0.8}, 'Au': {'Au': 1, 'Ag': 1.2}}
+    # no-lock fallback (no fcntl on Windows)
+    monkeypatch.setattr(Gamma_Value_Calc, 'fcntl', None)
+    Gamma_Value_Calc.update_gamma_file({'Pd': {'Pd': 1}}, path=path)
+    with open(path) as f:
+        assert json.load(f)['Pd'] == {'Pd': 1}
+    # a failed replace keeps the old file and leaves no temporary file
+    def fail(src, dst):
+        raise OSError('disk full')
+    monkeypatch.setattr(Gamma_Value_Calc.os, 'replace', fail)
+    with pytest.raises(OSError):
+        Gamma_Value_Calc.update_gamma_file({'Cu': {'Cu': 1}}, path=path)
+    with open(path) as f:
+        assert 'Cu' not in json.load(f)
+    assert sorted(os.listdir(tmp_path)) == ['np_gammas.json', 'np_gammas.json.lock']
+
+
+def test_discover_pair_folders(tmp_path):
+    from CANELa_NP.Gamma_Value_Calc import discover_pair_folders
+    for name in ['AuPt-final', 'PtAu', 'PtAu-final', 'PtAu-decahedron', 'PdAu-old', 'PdAu-cuboctahedron', 'AgAu', 'Empty', 'AuPdPt']:
+        os.mkdir(tmp_path / name)
+        if name != 'Empty':
+            (tmp_path / name / 'np.xyz').write_text('')
+    os.mkdir(tmp_path / 'CuAg') # no structures
+    (tmp_path / 'AgCu').write_text('') # not a folder
+    folders = discover_pair_folders(str(tmp_path))
+    assert folders == {('Ag', 'Au'): [str(tmp_path / 'AgAu')],
+                       ('Au', 'Pd'): [str(tmp_path / 'PdAu-old'), str(tmp_path / 'PdAu-cuboctahedron')],
+                       ('Au', 'Pt'): [str(tmp_path / 'PtAu'), str(tmp_path / 'PtAu-decahedron')]}
+
+
+def test_fit_all_pairs(tmp_path):
+    import json
+    import shutil
+    from CANELa_NP.Gamma_Value_Calc import fit_all_pairs, fit_pair_folder, load_energy_tables
+    data_folder = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'CANELa_NP', 'Data'))
+    shutil.copytree(os.path.join(data_folder, 'AuAg'), tmp_path / 'data' / 'AuAg')
+    os.mkdir(tmp_path / 'data' / 'AuPt') # no structures, ignored
+    path = str(tmp_path / 'np_gammas.json')
+    with open(path, 'w') as f:
+        json.dump({'Pt': {'Pt': 1, 'Pd': 0.9}}, f)
+    results = fit_all_pairs(str(tmp_path / 'data'), n_jobs=1, path=path)
+    assert list(results) == [('Ag', 'Au')]
+    gammas, residuals = results[('Ag', 'Au')]
+    assert gammas == fit_pair_folder(os.path.join(data_folder, 'AuAg'), *load_energy_tables())[0]
+    with open(path) as f:
+        assert json.load(f) == {'Pt': {'Pt': 1, 'Pd': 0.9}, **gammas}
+
+def test_combine_reproduces_shipped_gammas():
+    import json
+    from CANELa_NP.Gamma_Value_Calc import fit_all_pairs, gamma_values_path
+    with open(gamma_values_path) as f:
+        shipped = json.load(f)
+    results = fit_all_pairs(total_atoms=147, n_jobs=2, write=False, combine=True) # --all --combine
+    assert len(results) == 10
+    for (A, B), (gammas, residuals) in results.items():
+        assert abs(gammas[A][B] - shipped[A][B]) < 1e-12 and abs(gammas[B][A] - shipped[B][A]) < 1e-12
+
+def test_island_ga_reproducible():
+    import numpy as np
+    from CANELa_NP import Island_GA
+    atoms = ac.Icosahedron('Au', 3)
+    atoms.symbols[:20] = 'Pd'
+    composition = [35, 20]
+    runs = [Island_GA.run_islands(atoms, composition, seeds=(0, 1, 2), max_gens=20, migrate_every=5, n_migrants=2, n_jobs=n_jobs)
+            for n_jobs in [1, 2, 2]]
+    for ordering, ce, history in runs[1:]: # same seeds, same result (whatever the number of workers)
+        assert np.array_equal(ordering, runs[0][0]) and ce == runs[0][1] and history == runs[0][2]
+    assert len(runs[0][2]) == 4 and np.all(np.diff(runs[0][2]) <= 0)
+
+    # ring migration: the best orderings of island 0 replace the worst of island 1, and every island keeps its GA
+    Island_GA._init_worker(atoms, 1.20, 'frac', composition, 'none', Island_GA._generate_ga)
+    try:
+        migrants, ce0 = Island_GA._run_epoch(0, 0, [], 5, 2)
+        Island_GA._run_epoch(1, 1, [], 5, 2)
+        ga1 = Island_GA._worker['islands'][1]
+        best, ce1 = Island_GA._run_epoch(1, 2, migrants, 5, 2)
+        assert len(migrants) == 2 and ce1 <= ce0 + 1e-12
+        assert Island_GA._worker['islands'][1] is ga1
+        # a spiked island starts from the given ordering (here the best one found above)
+        Island_GA._init_worker(atoms, 1.20, 'frac', composition, 'none', Island_GA._generate_ga, spike=runs[0][0])
+        assert Island_GA._run_epoch(0, 5, [], 1, 1)[1] <= runs[0][1] + 1e-12
+    finally:
+        Island_GA._worker.clear()
+
+    # run_ga(seeds=...) writes the best ordering back and keeps the topology
+    NP = Nanoparticle(atoms, lazy=True)
+    bcm = NP.bcm
+    NP.run_ga(max_gens=10, migrate_every=5, seeds=[0, 1])
+    assert NP.bcm is bcm and NP.composition == composition
+    assert abs(NP.calc_ce() - NP.ga_history[-1]) < 1e-12
+
+    # the islands use the NP's bonds and metals, also after relabel dropped a metal, and start from the current ordering
+    atoms = ac.Icosahedron('Au', 3)
+    atoms.symbols[:28] = 'Pd'
+    atoms.symbols[28:] = 'Pt'
+    atoms.symbols[0] = 'Au'
+    NP = Nanoparticle(atoms, lazy=True, spike=True)
+    atoms.symbols[0] = 'Pd'
+    NP.relabel(atoms.symbols)
+    assert NP.composition == [0, 28, 27]
+    start_ce = NP.calc_ce()
+    NP.run_ga(max_gens=4, migrate_every=2, seeds=[0, 1], n_jobs=1)
+    assert abs(NP.calc_ce() - NP.ga_history[-1]) < 1e-12 and NP.ga_history[-1] <= start_ce + 1e-12
+
+
+def test_composition_sweep(tmp_path):
+    import json
+    import numpy as np
+    from CANELa_NP.Composition_Sweep import composition_grid, composition_id, run_sweep, load_results
+    binary = composition_grid(55, ['Au', 'Pd'], 4)
+    assert [c['Au'] for c in binary] == [55, 41, 28, 14, 0] and all(sum(c.values()) == 55 for c in binary)
+    ternary = composition_grid(55, ['Au', 'Pd', 'Pt'], 3)
+    assert len(ternary) == 10 and all(sum(c.values()) == 55 for c in ternary)
+    assert {'Au': 0, 'Pd': 0, 'Pt': 55} in ternary and {'Au': 19, 'Pd': 18, 'Pt': 18} in ternary
+
+    atoms = ac.Icosahedron('Au', 3)
+    path = str(tmp_path / 'sweep.jsonl')
+    results = run_sweep(atoms, binary[:3], path, max_gens=5, n_jobs=2)
+    assert set(results) == {composition_id(c) for c in binary[:3]}
+    with open(path) as f:
+        first_lines = f.readlines()
+    with open(path, 'a') as f: # interrupted while writing a record
+        f.write('{"id": "Au14Pd4')
+    results = run_sweep(atoms, binary, path, max_gens=5, n_jobs=2)
+    with open(path) as f:
+        lines = f.readlines()
+    assert lines[:3] == first_lines and len(lines) == 6 # only the 2 new compositions were run
+    assert load_results(path).keys() == results.keys() == {composition_id(c) for c in binary}
+
+    record = results['Au28Pd27']
+    assert set(record) == {'id', 'composition', 'ce', 'elements', 'ordering', 'shells', 'shell_comps', 'totals'}
+    assert record['composition'] == {'Au': 28, 'Pd': 27} and record['elements'] == ['Au', 'Pd']
+    ordering = np.array(record['ordering'])
+    assert len(ordering) == 55 and np.bincount(ordering).tolist() == [28, 27] and sum(record['totals']) == 55
+    assert np.allclose(np.sum([record['shell_comps'][el] for el in record['elements']], axis=0), 1)
+    new_atoms = atoms.copy()
+    new_atoms.symbols = np.array(record['elements'])[ordering]
+    assert abs(Nanoparticle(new_atoms, lazy=True).calc_ce() - record['ce']) < 1e-12
+    assert json.loads(json.dumps(record)) == record
+
+
+def test_topology_cache(tmp_path):
+    import numpy as np
+    from CANELa_NP import Topology_Cache
+    from CANELa_NP.Nanotools import make_bcm
+    atoms = ac.Icosahedron('Au', 4)
+    atoms.symbols[50:] = 'Pd'
+    cache = Topology_Cache.enable_cache(str(tmp_path))
+    try:
+        bcm = make_bcm(atoms)
+        assert len(os.listdir(tmp_path)) == 1
+        cached_bcm = make_bcm(atoms) # loaded from the cache
+        assert np.array_equal(bcm.bond_list, cached_bcm.bond_list)
+        # the cutoffs follow the symbols, so a reordering of metals with different radii has its own bonds and entry
+        from ase.io import read
+        PdAu = read(os.path.join(os.path.dirname( __file__ ), '..', 'CANELa_NP', 'Data', 'PdAu', 'Au73Pd74.xyz'))
+        swapped = PdAu.copy()
+        swapped.symbols = np.where(np.asarray(PdAu.symbols) == 'Au', 'Pd', 'Au')
+        Topology_Cache.disable_cache()
+        expected = [make_bcm(PdAu, x=1.1).bond_list, make_bcm(swapped, x=1.1).bond_list]
+        Topology_Cache.enable_cache(str(tmp_path))
+        assert len(expected[0]) != len(expected[1])
+        for _ in range(2): # built, then loaded from the cache
+            assert np.array_equal(make_bcm(PdAu, x=1.1).bond_list, expected[0])
+            assert np.array_equal(make_bcm(swapped, x=1.1).bond_list, expected[1])
+        assert len(os.listdir(tmp_path)) == 3
+        # Pd and Pt have the same radius: every ordering has the same bonds and shares one entry
+        PdPt = ac.Icosahedron('Pd', 4)
+        PdPt.symbols[50:] = 'Pt'
+        reordered = PdPt.copy()
+        reordered.symbols = np.random.default_rng(0).permutation(PdPt.symbols)
+        assert np.array_equal(make_bcm(reordered).bond_list, make_bcm(PdPt).bond_list)
+        assert len(os.listdir(tmp_path)) == 4
+        cache.max_bytes = 0
+        cache.evict()
+        assert os.listdir(tmp_path) == []
+    finally:
+        Topology_Cache.disable_cache()
+
+
+def test_update_ordering_matches_rebuild():
+    import numpy as np
+    from CANELa_NP.Nanotools import get_ordering
+    atoms = ac.Icosahedron('Au', 5)
+    atoms.symbols[100:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    ordering = np.random.default_rng(0).permutation(get_ordering(atoms))
+    NP.update_ordering(ordering)
+    assert (atoms.symbols[:100] == 'Au').all() # the original atoms object is untouched
+    new_atoms = atoms.copy()
+    new_atoms.symbols = np.array(['Au', 'Pd'])[ordering]
+    rebuilt = Nanoparticle(new_atoms, lazy=True)
+    assert abs(NP.calc_ce() - rebuilt.calc_ce()) < 1e-12
+    assert NP.comps == rebuilt.comps and NP.totals == rebuilt.totals
+
+
+def test_relabel_dropping_a_metal():
+    import numpy as np
+    atoms = ac.Icosahedron('Au', 3)
+    atoms.symbols[:20] = 'Pd'
+    atoms.symbols[20:40] = 'Pt'
+    NP = Nanoparticle(atoms, lazy=True)
+    symbols = np.where(np.arange(len(atoms)) % 2 == 0, 'Pd', 'Pt') # no Au left
+    NP.relabel(symbols)
+    new_atoms = atoms.copy()
+    new_atoms.symbols = symbols
+    rebuilt = Nanoparticle(new_atoms, lazy=True)
+    ordering = np.searchsorted(NP.unique_metals, symbols)
+    assert abs(NP.calc_ce() - NP.calc_ce_batch(ordering)[0]) < 1e-12
+    assert abs(NP.calc_ce() - rebuilt.calc_ce()) < 1e-12
+
+
+def test_core_shell_info_batch():
+    import numpy as np
+    from CANELa_NP.Nanotools import get_ordering
+    AuPdPt_Path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', 'Example_Data', 'AuPdPt.xyz'))
+    NP = Nanoparticle(AuPdPt_Path, lazy=True)
+    shells, comps, totals = NP.core_shell_info()
+    # reference: count the symbols of every shell
+    shell_map = NP.bcm_int.shell_map
+    for i in shells:
+        shell_atoms = np.append(shell_map[0], shell_map[1]) if i == 1 else shell_map[i]
+        assert totals[i - 1] == len(shell_atoms)
+        for metal_type in NP.unique_metals:
+            assert comps[metal_type][i - 1] == sum(NP.atoms[shell_atoms].symbols == metal_type)/len(shell_atoms)
+
+    orderings = np.array([np.random.default_rng(seed).permutation(get_ordering(NP.atoms)) for seed in range(3)])
+    batch_shells, batch_comps, batch_totals = NP.core_shell_info_batch(orderings)
+    assert batch_shells == shells and batch_totals == totals
+    for m, ordering in enumerate(orderings):
+        NP.update_ordering(ordering)
+        for t, metal_type in enumerate(NP.unique_metals):
+            assert list(batch_comps[m, :, t]) == NP.comps[metal_type]
+
+
+def test_plane_slices():
+    import numpy as np
+    atoms = ac.Icosahedron('Au', 5)
+    atoms.symbols[100:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    core = atoms.positions[NP.bcm_int.shell_map[0][0]]
+    assert np.array_equal(NP.atom_cut.positions, atoms.positions[atoms.positions[:, 0] <= core[0]])
+    assert np.array_equal(NP.atom_cut_neg.positions, atoms.positions[atoms.positions[:, 0] >= core[0]])
+    mask = NP.slice_mask(miller=(1, 1, 1), thickness=2.0)
+    assert mask is NP.slice_mask(miller=(2, 2, 2), thickness=2.0) # cached
+    assert len(NP.get_slice(miller=(1, 1, 1), thickness=2.0)) == mask.sum()
+
+
+def test_trajectory_pipeline(tmp_path, monkeypatch):
+    import csv
+    import json
+    import numpy as np
+    import pytest
+    from ase.io import read, write
+    from CANELa_NP.Trajectory_Analysis import analyze_frames, run_pipeline, find_structure_files, ResultWriter
+    atoms = ac.Icosahedron('Au', 3)
+    frames = []
+    for seed in range(3): # same geometry, new orderings (the topology is reused)
+        frame = atoms.copy()
+        frame.symbols = np.random.default_rng(seed).choice(['Au', 'Pd'], len(atoms))
+        frames.append(frame)
+    frames.append(atoms.copy()) # Au only, a new Nanoparticle
+    cubo = ac.Octahedron('Pt', 5, 2)
+    cubo.symbols[:10] = 'Au'
+    frames.append(cubo)
+    write(str(tmp_path / 'traj.xyz'), frames)
+    (tmp_path / 'more').mkdir()
+    write(str(tmp_path / 'more' / 'single.xyz'), frames[1])
+    inputs = [str(tmp_path / 'traj.xyz'), str(tmp_path / 'more')]
+    files = find_structure_files(inputs)
+    assert files == [str(tmp_path / 'traj.xyz'), str(tmp_path / 'more' / 'single.xyz')]
+
+    def expected(path):
+        rows = {}
+        for frame, frame_atoms in enumerate(read(path, ':')):
+            NP = Nanoparticle(frame_atoms, lazy=True)
+            shells, comps, totals = NP.core_shell_info()
+            rows[(path, frame)] = (NP.calc_ce(), NP.get_diam(), shells, {m: list(c) for m, c in comps.items()}, list(totals))
+        return rows
+    reference = {**expected(files[0]), **expected(files[1])}
+    for record in analyze_frames(files[0]):
+        ce, diameter, shells, comps, totals = reference[(files[0], record['frame'])]
+        assert abs(record['ce'] - ce) < 1e-12 and abs(record['diameter'] - diameter) < 1e-12
+        assert json.loads(record['shells']) == shells and json.loads(record['totals']) == totals
+        assert json.loads(record['shell_comps']) == pytest.approx(comps)
+
+    for n_jobs in [1, 2]:
+        output = str(tmp_path / f'results_{n_jobs}.csv')
+        assert run_pipeline(inputs, output, n_jobs=n_jobs, chunk_size=2) == len(reference)
+        with open(output) as f:
+            rows = {(row['file'], int(row['frame'])): row for row in csv.DictReader(f)}
+        assert set(rows) == set(reference)
+        for key, (ce, diameter, shells, comps, totals) in reference.items():
+            assert abs(float(rows[key]['ce']) - ce) < 1e-9 and json.loads(rows[key]['totals']) == totals
+
+    # a worker that dies hard (ex: out of memory) fails the pipeline instead of hanging it
+    import multiprocessing
+    from concurrent.futures.process import BrokenProcessPool
+    from CANELa_NP import Trajectory_Analysis
+    if multiprocessing.get_start_method() == 'fork': # the workers inherit the patched function
+        def crash(path, **kwargs):
+            os._exit(1)
+        monkeypatch.setattr(Trajectory_Analysis, 'analyze_frames', crash)
+        with pytest.raises(BrokenProcessPool):
+            run_pipeline(inputs, str(tmp_path / 'crash.csv'), n_jobs=2, poll_interval=0.1)
+
+
+def test_result_writer_parquet(tmp_path):
+    import numpy as np
+    import pytest
+    from ase.io import write
+    from CANELa_NP.Trajectory_Analysis import analyze_frames, ResultWriter
+    pq = pytest.importorskip('pyarrow.parquet')
+    atoms = ac.Icosahedron('Au', 3)
+    frames = []
+    for seed in range(5):
+        frame = atoms.copy()
+        frame.symbols = np.random.default_rng(seed).choice(['Au', 'Pd'], len(atoms))
+        frames.append(frame)
+    write(str(tmp_path / 'traj.xyz'), frames)
+    records = list(analyze_frames(str(tmp_path / 'traj.xyz')))
+    with ResultWriter(str(tmp_path / 'results.parquet'), batch_size=2) as writer:
+        for record in records:
+            writer.write(record)
+    table = pq.ParquetFile(str(tmp_path / 'results.parquet'))
+    assert table.num_row_groups == 3 and table.read().column('ce').to_pylist() == [r['ce'] for r in records]
+
+
+def test_profiling_spans():
+    from CANELa_NP.Profiling import profile
+    atoms = ac.Icosahedron('Au', 3)
+    atoms.symbols[20:] = 'Pd'
+    records = []
+    with profile(memory=True, callback=records.append) as prof:
+        NP = Nanoparticle(atoms, lazy=True)
+        NP.calc_ce()
+        NP.calc_ce()
+    summary = prof.summary()
+    assert summary['Nanotools.Nanoparticle.calc_ce']['calls'] == 2
+    assert summary['Nanotools.make_bcm']['calls'] == 1 and 'build_bonds_arr' in summary
+    assert summary['Nanotools.Nanoparticle.__init__']['peak_mb'] >= summary['Nanotools.make_bcm']['peak_mb']
+    assert len(records) == len(prof.records)
+    assert 'Nanotools.get_cutoffs' in prof.report()
+    NP.calc_ce() # not recorded once the block is closed
+    assert len(prof.records) == len(records)
+
+
+def test_profiling_keeps_outer_tracemalloc():
+    import tracemalloc
+    from CANELa_NP.Profiling import profile, span
+    tracemalloc.start()
+    try:
+        block = bytearray(8*1024**2)
+        del block
+        outer_peak = tracemalloc.get_traced_memory()[1]
+        with profile(memory=True) as prof:
+            with span('alloc'):
+                block = bytearray(16*1024**2)
+                del block
+        assert tracemalloc.is_tracing() # the caller's session keeps running
+        assert tracemalloc.get_traced_memory()[1] >= outer_peak # and its peak is not reset
+        assert prof.summary()['alloc']['peak_mb'] >= 15
+    finally:
+        tracemalloc.stop()
+    with profile(memory=True):
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing() # started by profile, so stopped by it
+
+
+def test_render_cache(tmp_path):
+    from CANELa_NP.Rendering import render_np
+    atoms = ac.Icosahedron('Au', 3)
+    atoms.symbols[20:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    paths = [render_np(NP, view, out_dir=str(tmp_path)) for view in ['full', 'cut', 'core_shell']]
+    assert all(os.path.getsize(path) > 0 for path in paths)
+    mtime = os.path.getmtime(paths[0])
+    assert render_np(NP, 'full', out_dir=str(tmp_path)) == paths[0] and os.path.getmtime(paths[0]) == mtime # cached
+    assert render_np(NP, 'full', out_dir=str(tmp_path), rotation='90x') != paths[0]
+    assert len(os.listdir(tmp_path)) == 4
+
+
+def test_np_library(tmp_path):
+    import numpy as np
+    from CANELa_NP.NP_Library import write_library, NPLibrary
+    atoms = ac.Icosahedron('Au', 3)
+    structures = []
+    for seed in range(3):
+        new_atoms = atoms.copy()
+        new_atoms.symbols = np.random.default_rng(seed).choice(['Au', 'Pd'], len(atoms))
+        structures.append(new_atoms)
+    structures.append(ac.Octahedron('Pt', 4))
+    write_library(str(tmp_path / 'lib'), structures, ces=[-1.0, -2.0, -3.0, -4.0])
+    library = NPLibrary(str(tmp_path / 'lib'))
+    assert len(library) == 4 and library.header['n_geometries'] == 2 # the icosahedra share one geometry
+    assert isinstance(library.orderings, np.memmap) and library.orderings.dtype == np.uint8
+    for i, structure in enumerate(structures):
+        assert list(library[i].symbols) == list(structure.symbols)
+        assert np.allclose(library.get_positions(i), structure.positions)
+        assert library.get_composition(i) == {str(el): int(n) for el, n in zip(*np.unique(structure.symbols, return_counts=True))}
+    assert list(library.ce) == [-1.0, -2.0, -3.0, -4.0]
+    NP = Nanoparticle.from_library(str(tmp_path / 'lib'), 1, lazy=True)
+    assert abs(NP.calc_ce() - Nanoparticle(structures[1], lazy=True).calc_ce()) < 1e-12
+
+
+def test_generate_training_set(tmp_path):
+    import numpy as np
+    from ase.io import read
+    from CANELa_NP.Setup_NPs_for_DFT import (generate_training_set, get_coordination_numbers, evenly_distribute,
+                                             get_alternating_mask, make_cluster)
+    atoms = make_cluster('cuboctahedron', 'Au', 4)
+    CNs, bonds = get_coordination_numbers(atoms)
+    for CN in np.unique(CNs):
+        atoms = evenly_distribute(atoms, CNs, CN, 'Pd')
+    assert np.array_equal(atoms.symbols == 'Pd', get_alternating_mask(CNs))
+
+    paths = generate_training_set(['Au', 'Pd', 'Pt'], shapes=('icosahedron', 'decahedron'), shells=(3,), out_dir=str(tmp_path), n_jobs=2)
+    assert len(paths) == 3*2*2
+    assert sorted(os.listdir(tmp_path / 'PdAu')) == ['Au27Pd28-icosahedron-3.xyz', 'Au28Pd27-icosahedron-3.xyz']
+    swapped = [read(str(tmp_path / 'PdAu-decahedron' / name)) for name in sorted(os.listdir(tmp_path / 'PdAu-decahedron'))]
+    assert np.array_equal(swapped[0].symbols == 'Au', swapped[1].symbols == 'Pd')
+
+    # every shape is fit: each structure is matched to the energy of its own shape and number of shells
+    import pandas as pd
+    from CANELa_NP.DFT_Energies import load_energy_store, split_name
+    from CANELa_NP.Gamma_Value_Calc import discover_pair_folders, load_pair_structures, custom_calc_ce, ce_bulk_pbe_d3
+    paths = generate_training_set([('Au', 'Pd')], shapes=('icosahedron', 'cuboctahedron', 'decahedron'), shells=(3, 4),
+                                  out_dir=str(tmp_path / 'Data'), n_jobs=2)
+    folders = discover_pair_folders(str(tmp_path / 'Data'))[('Au', 'Pd')]
+    assert sorted(os.path.basename(f) for f in folders) == ['PdAu', 'PdAu-cuboctahedron', 'PdAu-decahedron']
+    store = load_energy_store(cache_dir=None)
+    gammas = {'Au': {'Au': 1, 'Pd': 1.1}, 'Pd': {'Pd': 1, 'Au': 0.9}}
+    energies = {}
+    for path in paths:
+        atoms = read(path)
+        counts = {el: int(np.sum(atoms.symbols == el)) for el in ['Au', 'Pd']}
+        energies[os.path.basename(path)[:-len('.xyz')]] = custom_calc_ce(atoms, gammas, ce_bulk_pbe_d3)*len(atoms) + \
+            sum(n*store.atom_energies[store.column[el]] for el, n in counts.items())
+    pd.DataFrame({'Folder_Name': list(energies), 'Type': 'GEO_OPT', 'Energy (eV)': list(energies.values())}).to_csv(tmp_path / 'NP_energies.csv')
+    tagged = load_energy_store(NP_energies=str(tmp_path / 'NP_energies.csv'), cache_dir=None)
+    assert len(tagged.index) == len(paths) == 12
+    assert len({split_name(path)[0] for path in paths}) < 12 # the shapes share compositions
+    structures, CEs = load_pair_structures(folders, *tagged.to_tables())
+    assert len(structures) == 12
+    assert max(abs(custom_calc_ce(a, gammas, ce_bulk_pbe_d3) - ce) for a, ce in zip(structures, CEs)) < 1e-9
+
+
+def test_dft_energy_store(tmp_path):
+    import numpy as np
+    from CANELa_NP.DFT_Energies import load_energy_store, EnergyStore
+    store = load_energy_store(cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 1 # cached for the next run
+    cached = EnergyStore.load(str(tmp_path / os.listdir(tmp_path)[0]))
+    assert cached.to_tables() == store.to_tables()
+    ces = store.cohesive_energies()
+    for i, name in enumerate(store.names):
+        assert abs(store.get_ce(name) - ces[i]) < 1e-12
+    assert store.get_ce('Pd74Ag73') == store.get_ce('Ag73Pd74') and store.get_ce('Au1000') is None
+    pure = store.select(elements=['Au'], n_atoms=147)
+    assert [store.names[i] for i in np.flatnonzero(pure)] == ['Au147']
+
+
+def test_lazy_imports():
+    import subprocess
+    import sys
+    import CANELa_NP.Nanotools as nt
+    assert nt.gammas_np is nt.load_gammas() # read once, on first use
+    code = ("import sys, CANELa_NP.Nanotools; "
+            "print([m for m in ['matplotlib.pyplot', 'IPython', 'molgif', 'ase.visualize'] if m in sys.modules])")
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == '[]'
+
+
+def test_gamma_sweep():
+    import numpy as np
+    from CANELa_NP.Gamma_Sweep import GammaSweep
+    from CANELa_NP.Nanotools import get_ce_precomps, get_bond_coeffs, get_ordering_of, calc_ce_batch
+    atoms = ac.Icosahedron('Au', 4)
+    atoms.symbols[50:] = 'Pd'
+    NP = Nanoparticle(atoms, lazy=True)
+    sweep = GammaSweep([NP])
+    assert abs(sweep.calc_ce()[0, 0] - NP.calc_ce()) < 1e-12
+    # the shared bond class reduction agrees with the per-bond batch CE
+    precomps = get_ce_precomps(NP.bcm, sweep.metal_types)
+    ordering = get_ordering_of(atoms, sweep.metal_types)
+    coeffs = get_bond_coeffs(NP.bcm.bond_list, NP.bcm.cn, ordering, 2)
+    assert abs(precomps['params'] @ coeffs.ravel()/len(atoms) - calc_ce_batch(precomps, ordering)[0]) < 1e-12
+    gammas, ce_bulk = sweep.sample(4, gamma_std=0.1, ce_bulk_std=0.1, seed=0)
+    assert np.allclose(gammas + gammas.transpose(0, 2, 1), 2) # sum constraint
+    ces = sweep.calc_ce(gammas, ce_bulk)
+    d_gamma, d_ce_bulk = sweep.gradient(gammas[0], ce_bulk[0])
+    # CE is linear in each parameter, so the derivatives give the change exactly
+    shifted = gammas[0].copy()
+    shifted[0, 1] += 0.3
+    assert abs(sweep.calc_ce(shifted, ce_bulk[0])[0, 0] - ces[0, 0] - 0.3*d_gamma[0, 0, 1]) < 1e-12
+    assert abs((d_ce_bulk[0]*ce_bulk[0]).sum() - ces[0, 0]) < 1e-12
+
+
+def test_nanoparticle_result(tmp_path):
+    import numpy as np
+    import pickle
+    from CANELa_NP.NP_Result import save_results, load_results
+    atoms = ac.Icosahedron('Au', 4)
+    results = []
+    for seed in range(3):
+        new_atoms = atoms.copy()
+        new_atoms.symbols = np.random.default_rng(seed).choice(['Au', 'Pd'], len(atoms))
+        results.append(Nanoparticle(new_atoms, lazy=True).to_result())
+    assert results[0].geometry is results[2].geometry # shared, not copied
+    assert results[0].ordering.dtype == np.uint8 and results[0].nbytes < 1024
+    save_results(str(tmp_path / 'results.npz'), results)
+    for loaded in [load_results(str(tmp_path / 'results.npz')), pickle.loads(pickle.dumps(results))]:
+        for result, original in zip(loaded, results):
+            assert result.geometry is original.geometry
+            assert np.array_equal(result.ordering, original.ordering) and result.ce == original.ce
+            assert np.array_equal(result.shell_comps, original.shell_comps) and result.diameter == original.diameter
+    NP = results[1].to_nanoparticle(lazy=True)
+    assert abs(NP.calc_ce() - results[1].ce) < 1e-12
+    assert results[1].composition == dict(zip(NP.unique_metals, map(int, NP.composition)))
+
+
+def test_symmetry_enumeration():
+    import itertools
+    import numpy as np
+    from CANELa_NP.Enumeration import get_symmetry_permutations, enumerate_orderings, count_orderings
+    atoms = ac.Icosahedron('Au', 2)
+    atoms.symbols[:3] = 'Pd'
+    perms = get_symmetry_permutations(atoms.positions, center=atoms.positions[0])
+    assert perms.shape == (120, 13) and np.array_equal(perms[0], np.arange(13))
+    orderings, degeneracy = enumerate_orderings(perms, [10, 3])
+    assert len(orderings) < count_orderings([10, 3]) and degeneracy.sum() == count_orderings([10, 3])
+    NP = Nanoparticle(atoms, lazy=True)
+    brute = np.array([np.isin(np.arange(13), sites) for sites in itertools.combinations(range(13), 3)], dtype=int)
+    brute_ces = NP.calc_ce_batch(brute)
+    best, ces, degeneracy = NP.enumerate_orderings(n_best=None, update=True)
+    assert degeneracy.sum() == len(brute) and np.all(np.diff(ces) >= 0)
+    assert abs(ces[0] - brute_ces.min()) < 1e-12 and abs(NP.calc_ce() - ces[0]) < 1e-12
+    # a composition without one of the metals (Au count 0, so the indices of the other metals shift if Au is dropped)
+    atoms = ac.Icosahedron('Pd', 2)
+    atoms.symbols[:2] = 'Au'
+    atoms.symbols[2:4] = 'Pt'
+    NP = Nanoparticle(atoms, lazy=True)
+    best, ces, degeneracy = NP.enumerate_orderings({'Au': 0, 'Pd': 11, 'Pt': 2}, n_best=3, update=True)
+    assert (np.bincount(best[0], minlength=3) == [0, 11, 2]).all() and NP.composition == [0, 11, 2]
+    assert abs(NP.calc_ce() - ces[0]) < 1e-12 and abs(NP.calc_ce_batch(best)[0] - ces[0]) < 1e-12